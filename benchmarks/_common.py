@@ -0,0 +1,21 @@
+"""Partes comuns dos benchmarks (não é um benchmark): caminho do app, percentil e import em "bare mode"."""
+import math
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, fraction):
+    """Percentil pelo método nearest-rank (0.0 sem amostras)."""
+    samples = sorted(samples)
+    return samples[max(0, math.ceil(len(samples) * fraction) - 1)] if samples else 0.0
+
+
+def import_app():
+    """Importa o primebud.py em "bare mode" num diretório temporário (o banco e os caches em disco ficam lá)."""
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp())
+    import primebud
+    return primebud
@@ -0,0 +1,120 @@
+"""Benchmark: custo por requisição de criar clientes Groq/Gemini vs. usar o registro em cache.
+
+Sobe um servidor HTTP/1.1 local que imita o endpoint de chat da Groq (com keep-alive) e compara:
+  - antes: Groq(api_key=...) novo a cada mensagem (nova conexão TCP a cada chamada)
+  - depois: get_groq_client() do primebud.py (uma conexão reaproveitada)
+Para o Gemini mede o custo local de genai.configure + GenerativeModel + criação do cliente
+gRPC (o canal é recriado após cada configure); o handshake TLS real não entra na medição.
+
+Uso: python benchmarks/bench_clients.py [--requests 200]
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from _common import import_app
+
+COMPLETION = json.dumps({
+    "id": "bench", "object": "chat.completion", "created": 0, "model": "bench",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}).encode()
+
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Mantém a conexão aberta entre requisições
+    disable_nagle_algorithm = True # Evita o atraso de ACK (~40 ms) em conexões reaproveitadas
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        FakeGroqHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(fn, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(label, samples, connections=None):
+    extra = f"  conexões TCP novas: {connections}" if connections is not None else ""
+    print(f"{label:<42} média {statistics.mean(samples):7.3f} ms  p50 {statistics.median(samples):7.3f} ms{extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGroqHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{server.server_port}"
+
+    primebud = import_app()
+    from groq import Groq
+    import google.generativeai as genai
+    from google.generativeai import client as genai_client
+
+    messages = [{"role": "user", "content": "Olá"}]
+    config = primebud.MODES_CONFIG["primebud_1_0_flash"]
+
+    def groq_before():
+        client = Groq(api_key="bench")
+        client.chat.completions.create(model=config["model"], messages=messages, max_tokens=config["max_tokens"])
+
+    def groq_after():
+        client = primebud.get_groq_client("bench")
+        client.chat.completions.create(model=config["model"], messages=messages, max_tokens=config["max_tokens"])
+
+    groq_after() # Aquece o registro (primeira chamada cria o cliente)
+    FakeGroqHandler.connections = 0
+    report("Groq antes (cliente por requisição)", measure(groq_before, args.requests), FakeGroqHandler.connections)
+    FakeGroqHandler.connections = 0
+    report("Groq depois (registro em cache)", measure(groq_after, args.requests), FakeGroqHandler.connections)
+
+    gemini = primebud.MODES_CONFIG["primebud_2_0"]
+
+    def gemini_before():
+        genai.configure(api_key="bench")
+        model = genai.GenerativeModel(
+            model_name=gemini["model"],
+            system_instruction=gemini["system_prompt"],
+            generation_config=genai.GenerationConfig(temperature=gemini["temperature"],
+                                                     max_output_tokens=gemini["max_tokens"]),
+        )
+        # generate_content cria o cliente gRPC na primeira chamada de cada modelo novo
+        model._client = genai_client.get_default_generative_client()
+
+    def gemini_after():
+        primebud.configure_gemini("bench")
+        model = primebud.get_gemini_model(gemini["model"], gemini["system_prompt"], gemini["temperature"],
+                                          gemini["max_tokens"])
+        if model._client is None:
+            model._client = genai_client.get_default_generative_client()
+
+    report("Gemini antes (configure + modelo)", measure(gemini_before, args.requests))
+    report("Gemini depois (registro em cache)", measure(gemini_after, args.requests))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
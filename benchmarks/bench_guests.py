@@ -0,0 +1,83 @@
+"""Benchmark: memória do servidor num pico de convidados, com os chats na sessão vs. no GuestStore.
+
+Simula ondas de convidados que abrem um chat e trocam --turns mensagens de --chars caracteres:
+  - antes: dicionários por aba (como st.session_state.guest_chats/guest_messages), sem limite
+  - depois: GuestStore do primebud.py (LRU com teto por convidado e total, limpeza dos inativos)
+Mede a memória alocada (tracemalloc) depois de cada onda. Também conta colisões de ids de
+convidado com randint(10000, 99999) e com secrets.token_hex(8).
+
+Uso: python benchmarks/bench_guests.py [--waves 5] [--guests 2000] [--turns 40] [--chars 800]
+"""
+import argparse
+import random
+import secrets
+import tracemalloc
+
+from _common import import_app
+
+
+def collisions(ids):
+    return len(ids) - len(set(ids))
+
+
+def run(label, args, new_session, chat):
+    rng = random.Random(0)
+    tracemalloc.start()
+    sizes = []
+    for wave in range(args.waves):
+        for index in range(args.guests):
+            guest_id = f"guest_{wave}_{index}"
+            new_session(guest_id)
+            for turn in range(args.turns):
+                chat(guest_id, "x" * rng.randint(args.chars // 2, args.chars * 3 // 2))
+        sizes.append(tracemalloc.get_traced_memory()[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    waves = "  ".join(f"{size / 2 ** 20:7.1f}" for size in sizes)
+    print(f"{label:<24} MiB por onda: {waves}   pico {peak / 2 ** 20:7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--waves", type=int, default=5)
+    parser.add_argument("--guests", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--chars", type=int, default=800)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    total = args.waves * args.guests
+    rng = random.Random(0)
+    print(f"Colisões em {total} ids: randint {collisions([rng.randint(10000, 99999) for _ in range(total)])}  "
+          f"secrets {collisions([secrets.token_hex(8) for _ in range(total)])}")
+
+    sessions = {}
+
+    def before_session(guest_id):
+        sessions[guest_id] = {"guest_chats": {"c1": {"name": "Chat 1", "mode": "primebud_1_5"}},
+                              "guest_messages": {"c1": []}}
+
+    def before_chat(guest_id, content):
+        sessions[guest_id]["guest_messages"]["c1"].append({"role": "user", "content": content})
+
+    run("Antes (session_state)", args, before_session, before_chat)
+    sessions.clear()
+
+    store = primebud.GuestStore()
+    chat_ids = {}
+
+    def after_session(guest_id):
+        chat_ids[guest_id] = store.create_chat(guest_id, "Chat 1", "primebud_1_5")
+
+    def after_chat(guest_id, content):
+        store.append_message(guest_id, chat_ids[guest_id], "user", content)
+
+    run("Depois (GuestStore)", args, after_session, after_chat)
+    count, used = store.stats()
+    print(f"GuestStore: {count} sessões, {used / 2 ** 20:.1f} MiB contabilizados "
+          f"(teto {primebud.GUEST_MAX_BYTES / 2 ** 20:.0f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
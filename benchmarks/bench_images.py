@@ -0,0 +1,82 @@
+"""Benchmark: preparação das imagens anexadas (redução + recodificação) e o tamanho do pedido ao Gemini.
+
+Gera fotos sintéticas (gradiente com ruído, parecido com uma foto de celular) em alguns tamanhos e formatos
+e mede, num diretório temporário:
+  - o tamanho enviado no upload vs. o arquivo reduzido que vai para o provedor
+  - o tempo de process_image() sem cache (decodificar, reduzir, recodificar) e com o arquivo já no cache
+  - o conteúdo de um pedido com --images imagens: arquivo original inline vs. imagem reduzida
+
+Uso: python benchmarks/bench_images.py [--images 4] [--repeat 5]
+"""
+import argparse
+import io
+import os
+import statistics
+import time
+
+from _common import import_app
+
+SAMPLES = [ # (descrição, largura, altura, formato do upload)
+    ("Foto 12 MP (JPEG)", 4000, 3000, "JPEG"),
+    ("Foto 48 MP (JPEG)", 8000, 6000, "JPEG"),
+    ("Captura de tela (PNG)", 2560, 1440, "PNG"),
+    ("Imagem pequena (PNG)", 800, 600, "PNG"),
+]
+
+
+def synthetic_photo(width, height, image_format, seed):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    channels = [np.sin((x * rng.uniform(2, 8) + y * rng.uniform(2, 8)) * np.pi) for _ in range(3)]
+    pixels = np.stack(channels, axis=-1) * 90 + 128 + rng.normal(0, 12, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buffer, image_format, quality=92)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    print(f"Formato de saída: {primebud.get_image_format()[0]}, lado máximo {primebud.IMAGE_MAX_SIDE} px, "
+          f"qualidade {primebud.IMAGE_QUALITY}\n")
+    uploads = []
+    for seed, (label, width, height, image_format) in enumerate(SAMPLES):
+        data = synthetic_photo(width, height, image_format, seed)
+        misses = []
+        for attempt in range(args.repeat):
+            variant = data + attempt.to_bytes(2, "big") # Bytes diferentes = sem cache (o decodificador ignora o final)
+            start = time.perf_counter()
+            name = primebud.process_image(variant)
+            misses.append((time.perf_counter() - start) * 1000)
+        hits = []
+        for _ in range(args.repeat * 10):
+            start = time.perf_counter()
+            primebud.process_image(variant)
+            hits.append((time.perf_counter() - start) * 1000)
+        processed = os.path.getsize(primebud.image_path(name))
+        uploads.append((data, processed))
+        print(f"{label:<24} {len(data) / 2 ** 20:6.2f} MiB -> {processed / 2 ** 10:7.1f} KiB  "
+              f"sem cache p50 {statistics.median(misses):7.1f} ms  com cache (só o SHA-256) p50 {statistics.median(hits):6.3f} ms")
+
+    # Pedido com várias fotos de 12 MP: arquivo original inline vs. a imagem reduzida que o app envia
+    raw, processed = len(uploads[0][0]), uploads[0][1]
+    print(f"\nPedido com {args.images} fotos de 12 MP: original {args.images * raw / 2 ** 20:6.2f} MiB  "
+          f"reduzido {args.images * processed / 2 ** 20:6.2f} MiB  ({(processed / raw - 1) * 100:+.0f}%)")
+
+    start = time.perf_counter()
+    primebud.prepare_images([uploads[0][0] + bytes([index]) for index in range(args.images)])
+    print(f"prepare_images() com {args.images} fotos ({primebud.IMAGE_WORKERS} workers, {os.cpu_count()} CPUs): "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark: custo do hash de senha (scrypt) e do login por cookie de sessão.
+
+Mede, num banco temporário:
+  - o custo de um hash scrypt para cada N (PRIMEBUD_SCRYPT_N), contra o SHA-256 antigo
+  - uma rajada de logins simultâneos com verify_user(): sem limite vs. com KDF_MAX_CONCURRENCY
+  - a reconexão com cookie (get_session_user), que não roda o KDF
+Use o resultado para escolher o N: o maior cujo p95 da rajada ainda caiba na latência aceitável.
+
+Uso: python benchmarks/bench_kdf.py [--logins 32] [--repeat 10]
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import threading
+import time
+
+from _common import import_app, percentile
+
+
+def timed_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def burst(label, logins, primebud):
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(logins)
+
+    def login(index):
+        barrier.wait()
+        start = time.perf_counter()
+        assert primebud.verify_user(f"user{index}", "senha123")
+        with lock:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=login, args=(index,)) for index in range(logins)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<36} {logins / elapsed:6.1f} logins/s  p50 {statistics.median(latencies):7.1f} ms  "
+          f"p95 {percentile(latencies, 0.95):7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    salt = os.urandom(primebud.PASSWORD_SALT_BYTES)
+    sha = timed_ms(lambda: hashlib.sha256(b"senha123").hexdigest(), args.repeat)
+    print(f"{'SHA-256 sem salt (antigo)':<36} p50 {statistics.median(sha):8.3f} ms")
+    for exponent in range(13, 17):
+        n = 2 ** exponent
+        samples = timed_ms(lambda: hashlib.scrypt(b"senha123", salt=salt, n=n, r=primebud.PASSWORD_SCRYPT_R,
+                                                  p=primebud.PASSWORD_SCRYPT_P, maxmem=256 * n * primebud.PASSWORD_SCRYPT_R,
+                                                  dklen=32), args.repeat)
+        marker = "  <- atual" if n == primebud.PASSWORD_SCRYPT_N else ""
+        print(f"{f'scrypt N=2**{exponent} ({128 * n * primebud.PASSWORD_SCRYPT_R // 2 ** 20} MiB)':<36} "
+              f"p50 {statistics.median(samples):8.3f} ms{marker}")
+
+    for index in range(args.logins):
+        primebud.create_user(f"user{index}", "senha123")
+
+    print(f"\nRajada de {args.logins} logins simultâneos ({os.cpu_count()} CPUs)")
+    limited = primebud.get_kdf_semaphore
+    unbounded = threading.BoundedSemaphore(args.logins)
+    primebud.get_kdf_semaphore = lambda: unbounded
+    burst("Sem limite de concorrência", args.logins, primebud)
+    primebud.get_kdf_semaphore = limited
+    burst(f"KDF_MAX_CONCURRENCY = {primebud.KDF_MAX_CONCURRENCY}", args.logins, primebud)
+
+    cookie = primebud.create_session(1)
+    samples = timed_ms(lambda: primebud.get_session_user(cookie), args.repeat * 10)
+    print(f"\n{'Reconexão com cookie de sessão':<36} p50 {statistics.median(samples):8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark: bytes enviados pelo websocket a cada execução do script, com e sem static serving.
+
+Roda o app com o AppTest do Streamlit e soma o tamanho das ForwardMsgs de cada execução:
+  - antes: server.enableStaticServing = false (CSS num <style> e logo como data URI em cada página)
+  - depois: server.enableStaticServing = true (só a tag <link> e URLs de app/static/)
+Imita o cache de mensagens do Streamlit: mensagens >= global.minCachedMessageSize já enviadas na
+sessão viram só uma referência nos reruns. Como o repositório não traz o logo, o benchmark gera
+um PNG de 256x256 numa cópia temporária do app.
+
+Uso: python benchmarks/bench_payload.py
+"""
+import os
+import random
+import shutil
+import tempfile
+
+from _common import ROOT
+
+REFERENCE_MSG_BYTES = 64 # Tamanho aproximado de uma ForwardMsg de referência (hash + metadados)
+
+
+def make_app_copy():
+    from PIL import Image
+
+    app_dir = tempfile.mkdtemp()
+    shutil.copy(os.path.join(ROOT, "primebud.py"), app_dir)
+    shutil.copytree(os.path.join(ROOT, "static"), os.path.join(app_dir, "static"))
+    rng = random.Random(0)
+    logo = Image.new("RGB", (256, 256))
+    logo.putdata([(255 - (x + y) // 4, 107 + rng.randint(-8, 8), 53) for y in range(256) for x in range(256)])
+    logo.save(os.path.join(app_dir, "static", "logo.png"))
+    return app_dir
+
+
+class PayloadMeter:
+    """Captura as ForwardMsgs de cada execução do AppTest."""
+
+    def __init__(self):
+        from streamlit.testing.v1 import local_script_runner
+
+        self.runs = []
+        parse = local_script_runner.parse_tree_from_messages
+
+        def capture(messages):
+            self.runs.append([msg for msg in messages if msg.WhichOneof("type") == "delta"])
+            return parse(messages)
+
+        local_script_runner.parse_tree_from_messages = capture
+
+    def wire_bytes(self, run, seen, min_cached):
+        total = 0
+        for msg in run:
+            size = msg.ByteSize()
+            key = msg.SerializeToString(deterministic=True)
+            if size >= min_cached and key in seen:
+                total += REFERENCE_MSG_BYTES
+            else:
+                total += size
+                seen.add(key)
+        return total
+
+
+def measure(app_path, meter, serving):
+    from streamlit import config
+    from streamlit.testing.v1 import AppTest
+
+    config.set_option("server.enableStaticServing", serving)
+    min_cached = int(config.get_option("global.minCachedMessageSize"))
+    results = {}
+    for screen in ("login", "chat"):
+        meter.runs.clear()
+        at = AppTest.from_file(app_path, default_timeout=30)
+        if screen == "chat":
+            at.session_state.user = {"id": -1, "username": "Convidado", "plan": "free", "is_guest": True}
+        at.run()
+        at.run()  # rerun (ex.: interação do usuário) na mesma sessão
+        # Uma página que quebrou também gera mensagens: medir isso daria números sem sentido
+        assert not at.exception, f"{screen}: {[e.value for e in at.exception]}"
+        seen = set()
+        results[screen] = [meter.wire_bytes(run, seen, min_cached) for run in meter.runs[-2:]]
+    return results
+
+
+def main():
+    app_dir = make_app_copy()
+    os.chdir(app_dir) # O banco é criado aqui
+    app_path = os.path.join(app_dir, "primebud.py")
+    meter = PayloadMeter()
+
+    before = measure(app_path, meter, serving=False)
+    after = measure(app_path, meter, serving=True)
+    for screen in ("login", "chat"):
+        for index, label in enumerate(("primeira carga", "rerun")):
+            b, a = before[screen][index], after[screen][index]
+            print(f"{screen:<6} {label:<15} antes {b / 1024:8.1f} KiB  depois {a / 1024:8.1f} KiB  "
+                  f"(-{(1 - a / b) * 100:.0f}%)")
+    shutil.rmtree(app_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
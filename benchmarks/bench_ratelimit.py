@@ -0,0 +1,114 @@
+"""Benchmark: cota compartilhada do provedor com um usuário insistente e vários usuários comuns.
+
+Simula, com as cotas reais de PLAN_RATE_LIMITS e PROVIDER_RATE_LIMITS (Groq):
+  - antes: sem limite no app; o provedor recusa (429) o que passar da cota da conta
+  - depois: RateLimiter do primebud.py na frente do provedor (baldes por usuário e fila justa)
+Um usuário "pro" dispara pedidos sem parar; os demais (plano free) mandam uma mensagem a cada
+--interval segundos. Mede os 429 de cada grupo e a espera na fila.
+
+Antes de simular, confere que pedidos sem usuário (os resumos) só esperam pela cota do provedor e que
+só o estouro da cota do próprio usuário sai com rate_limited (sem fallback para outro modo).
+
+Uso: python benchmarks/bench_ratelimit.py [--seconds 30] [--users 5] [--interval 20]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from _common import import_app, percentile
+
+PROVIDER_LATENCY = 0.2 # Duração simulada de cada chamada (s)
+REQUEST_TOKENS = 1500
+SUMMARY_TOKENS = 15000 # Um resumo grande: mais que a rajada de tokens de um usuário free
+
+
+def check_quotas(primebud):
+    """Falha (AssertionError) se um pedido sem usuário for limitado pela cota de algum usuário."""
+    limiter = primebud.RateLimiter()
+    tokens = SUMMARY_TOKENS
+    count = primebud.PROVIDER_RATE_LIMITS["groq"][1] // tokens
+    for _ in range(count): # Bem acima da rajada de um usuário free, dentro da cota do provedor
+        assert limiter.acquire(None, None, "groq", tokens, timeout=0.5) < 0.1, "resumo limitado por cota de usuário"
+    try:
+        limiter.acquire(None, None, "groq", tokens, timeout=0.2)
+        raise AssertionError("o provedor deveria estar sem saldo")
+    except primebud.ProviderError as e:
+        assert not e.rate_limited, "cota do provedor marcada como cota do usuário"
+
+    limiter = primebud.RateLimiter()
+    limiter.acquire("free-user", "free", "gemini", tokens)
+    try:
+        limiter.acquire("free-user", "free", "gemini", tokens, timeout=0.2)
+        raise AssertionError("o usuário free deveria estar sem saldo")
+    except primebud.ProviderError as e:
+        assert e.rate_limited, "cota do usuário sem rate_limited"
+    print(f"Cotas: {count} resumos de {tokens} tokens sem espera; estouro do usuário marcado como rate_limited\n")
+
+
+def run(label, limiter, args, primebud):
+    provider = primebud.TokenBucket(primebud.PROVIDER_RATE_LIMITS["groq"][0]) # Cota de requisições da conta
+    provider_lock = threading.Lock()
+    stats = {"heavy": {"ok": 0, "429": 0, "waits": []}, "light": {"ok": 0, "429": 0, "waits": []}}
+    stats_lock = threading.Lock()
+    stop = time.monotonic() + args.seconds
+
+    def call(group, user_key, plan):
+        wait = 0.0
+        if limiter:
+            try:
+                wait = limiter.acquire(user_key, plan, "groq", REQUEST_TOKENS)
+            except primebud.ProviderError:
+                with stats_lock:
+                    stats[group]["429"] += 1
+                return
+        with provider_lock:
+            accepted = provider.wait_time(1, time.monotonic()) == 0
+            if accepted:
+                provider.take(1)
+        time.sleep(PROVIDER_LATENCY)
+        with stats_lock:
+            stats[group]["ok" if accepted else "429"] += 1
+            stats[group]["waits"].append(wait)
+
+    def heavy():
+        while time.monotonic() < stop:
+            call("heavy", "pro-user", "pro")
+
+    def light(index):
+        time.sleep(index * args.interval / args.users) # Espalha os usuários comuns
+        while time.monotonic() < stop:
+            started = time.monotonic()
+            call("light", f"user{index}", "free")
+            time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+
+    threads = [threading.Thread(target=heavy) for _ in range(4)]
+    threads += [threading.Thread(target=light, args=(index,)) for index in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(label)
+    for group, result in stats.items():
+        print(f"  {group:<6} aceitos {result['ok']:5d}  recusados {result['429']:5d}  "
+              f"espera p50 {statistics.median(result['waits'] or [0]):6.2f} s  "
+              f"p95 {percentile(result['waits'], 0.95):6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=20)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    check_quotas(primebud)
+    run("Antes (sem limite no app)", None, args, primebud)
+    run("Depois (RateLimiter com fila justa)", primebud.RateLimiter(), args, primebud)
+
+
+if __name__ == "__main__":
+    main()
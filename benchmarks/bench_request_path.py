@@ -0,0 +1,245 @@
+"""Benchmark offline do caminho de uma mensagem: banco, contexto, provedor (simulado) e formatação.
+
+Substitui os SDKs da Groq e do Gemini por dublês locais e determinísticos (latência do primeiro
+pedaço, intervalo e tamanho dos pedaços configuráveis), então roda sem chaves de API nem rede.
+O código do app roda inteiro: orçamento de contexto, resumos, retries, limite de taxa e streaming.
+Para cada chat sintético (10 a 10k mensagens) mede:
+  - funções de banco: página mais recente, mensagens novas, chat inteiro, gravação de um turno
+  - load_job_context: histórico que um job de geração manda ao provedor
+  - format_message_with_code: formatação das mensagens da página mais recente
+  - generate_chat_response em streaming, num modo Groq e no modo Gemini (tempo total e até o 1º pedaço)
+Relata p50/p95/p99 e o pico de memória alocada (tracemalloc, numa execução separada da cronometrada).
+Com --json grava os resultados; com --baseline compara com um JSON anterior e sai com código 1 se
+algum p50 piorar mais que --tolerance (o p95 de poucas iterações é ruidoso demais para isso).
+
+Uso: python benchmarks/bench_request_path.py [--sizes 10 100 1000 10000] [--iterations 20]
+     [--first-token-ms 0] [--chunk-ms 0] [--chunk-chars 40] [--json resultados.json]
+     [--baseline anterior.json] [--tolerance 0.2] [--min-delta-ms 0.25]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from _common import import_app, percentile
+
+GROQ_MODE = "primebud_1_0" # Sem cache de respostas: toda chamada vai ao provedor simulado
+GEMINI_MODE = "primebud_2_0"
+WORDS = ("dados função consulta índice modelo resposta código lista classe objeto teste memória cache "
+         "servidor cliente rede erro banco python streamlit").split()
+
+
+def synthetic_text(rng, words, code=False):
+    text = " ".join(rng.choices(WORDS, k=words))
+    if code:
+        text += "\n```python\n" + "\n".join(f"def f{i}(x):\n    return x * {i}" for i in range(rng.randint(2, 8))) + "\n```\n"
+    return text
+
+
+class FakeProvider:
+    """Resposta determinística entregue em pedaços, com latência configurável."""
+
+    def __init__(self, args):
+        self.first_token = args.first_token_ms / 1000
+        self.chunk_interval = args.chunk_ms / 1000
+        self.chunk_chars = args.chunk_chars
+        self.text = synthetic_text(random.Random(1), 300, code=True)
+
+    def wait(self, seconds):
+        if seconds: # sleep(0) ainda custa uma troca de thread por pedaço
+            time.sleep(seconds)
+
+    def chunks(self):
+        self.wait(self.first_token)
+        for start in range(0, len(self.text), self.chunk_chars):
+            if start:
+                self.wait(self.chunk_interval)
+            yield self.text[start:start + self.chunk_chars]
+
+    def install(self):
+        import google.generativeai as genai
+        from groq.resources.chat.completions import Completions
+
+        provider = self
+
+        def groq_create(self, messages, stream=False, **kwargs):
+            usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 4,
+                                    completion_tokens=len(provider.text) // 4)
+            if not stream:
+                provider.wait(provider.first_token)
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=provider.text))],
+                                       usage=usage)
+
+            def stream_chunks():
+                for text in provider.chunks():
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], x_groq=None)
+                yield SimpleNamespace(choices=[], x_groq=SimpleNamespace(usage=usage))
+            return stream_chunks()
+
+        def gemini_generate(self, contents, stream=False, **kwargs):
+            usage = SimpleNamespace(prompt_token_count=sum(len(c["parts"][0]["text"]) for c in contents) // 4,
+                                    candidates_token_count=len(provider.text) // 4)
+            if not stream:
+                provider.wait(provider.first_token)
+                return SimpleNamespace(text=provider.text, usage_metadata=usage)
+            return (SimpleNamespace(text=text, usage_metadata=usage) for text in provider.chunks())
+
+        Completions.create = groq_create
+        genai.GenerativeModel.generate_content = gemini_generate
+
+
+def populate(sizes):
+    """Um chat por tamanho, alternando pergunta e resposta (algumas com blocos de código)."""
+    rng = random.Random(42)
+    conn = sqlite3.connect("primebud.db")
+    chats = {}
+    with conn:
+        conn.execute("INSERT INTO users (username, password_hash) VALUES ('bench', 'x')")
+        for size in sizes:
+            chat_id = conn.execute("INSERT INTO chats (user_id, name, mode) VALUES (1, ?, ?)",
+                                   (f"Chat {size}", GROQ_MODE)).lastrowid
+            conn.executemany("INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)", (
+                (chat_id, "user" if i % 2 == 0 else "assistant",
+                 synthetic_text(rng, rng.randint(5, 40) if i % 2 == 0 else rng.randint(40, 250),
+                                code=i % 2 == 1 and rng.random() < 0.3))
+                for i in range(size)))
+            chats[size] = chat_id
+    conn.close()
+    return chats
+
+
+def measure(fn, iterations):
+    fn() # Aquecimento (caches de clientes, páginas do SQLite)
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return samples, peak
+
+
+def scenarios(primebud, chat_id):
+    """[(nome, função)] para um chat; cada função roda uma vez o trecho medido."""
+    page = primebud.get_chat_messages_page(chat_id, limit=primebud.CHAT_PAGE_SIZE) or []
+    recent_id = page[0][0] - 1 if page else 0
+    user = {"id": 1, "plan": "pro"}
+    ttft = {}
+    # Os turnos gravados vão para um chat à parte, para não crescer o chat medido a cada iteração
+    scratch_chat_id = primebud.create_chat(1, f"Rascunho {chat_id}")
+
+    def stream(mode):
+        def run():
+            messages = primebud.load_job_context(chat_id, mode) + [{"role": "user", "content": "pergunta nova"}]
+            start = time.perf_counter()
+            chunks, _ = primebud.generate_chat_response(messages, mode, stream=True, chat_id=chat_id, user=user)
+            first = True
+            for _ in chunks:
+                if first:
+                    ttft.setdefault(mode, []).append((time.perf_counter() - start) * 1000)
+                    first = False
+        return run
+
+    return [
+        ("db: página mais recente", lambda: primebud.get_chat_messages_page(chat_id, limit=primebud.CHAT_PAGE_SIZE)),
+        ("db: mensagens novas (50)", lambda: primebud.get_chat_messages_since(chat_id, recent_id)),
+        ("db: chat inteiro", lambda: primebud.get_chat_messages(chat_id)),
+        ("db: save_turn", lambda: primebud.save_turn(scratch_chat_id, [("user", "oi"), ("assistant", "olá")])),
+        ("load_job_context", lambda: primebud.load_job_context(chat_id, GROQ_MODE)),
+        ("format_message_with_code (página)", lambda: [primebud.format_message_with_code(row[2]) for row in page]),
+        (f"generate_chat_response ({GROQ_MODE})", stream(GROQ_MODE)),
+        (f"generate_chat_response ({GEMINI_MODE})", stream(GEMINI_MODE)),
+    ], ttft
+
+
+def compare(results, provider, baseline_path, tolerance, min_delta_ms):
+    """Imprime os cenários cujo p50 piorou mais que tolerance (e mais que min_delta_ms). Retorna True se nenhum."""
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline_run = json.load(baseline_file)
+    if baseline_run.get("provider") != provider:
+        print(f"Aviso: a linha de base usou outro provedor simulado ({baseline_run.get('provider')})")
+    baseline = {(r["scenario"], r["messages"]): r for r in baseline_run["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["scenario"], result["messages"]))
+        if (before and result["p50_ms"] > before["p50_ms"] * (1 + tolerance)
+                and result["p50_ms"] - before["p50_ms"] > min_delta_ms): # Ignora ruído de frações de ms
+            regressions.append(f"{result['scenario']} [{result['messages']}]: p50 {before['p50_ms']:.3f} -> "
+                               f"{result['p50_ms']:.3f} ms")
+    for line in regressions:
+        print(f"REGRESSÃO {line}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--first-token-ms", type=float, default=0)
+    parser.add_argument("--chunk-ms", type=float, default=0)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--min-delta-ms", type=float, default=0.25)
+    args = parser.parse_args()
+    json_path = args.json and os.path.abspath(args.json) # Relativos ao diretório de onde o script foi chamado
+    baseline_path = args.baseline and os.path.abspath(args.baseline)
+
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    primebud = import_app()
+
+    FakeProvider(args).install()
+    provider = {"first_token_ms": args.first_token_ms, "chunk_ms": args.chunk_ms, "chunk_chars": args.chunk_chars}
+    primebud.PROVIDER_RATE_LIMITS = {} # A cota real dos provedores faria o benchmark medir a fila
+    primebud.PLAN_RATE_LIMITS = {"pro": (10 ** 9, 10 ** 12), "free": (10 ** 9, 10 ** 12)}
+    chats = populate(args.sizes)
+
+    results = []
+    print(f"{'cenário':<46} {'msgs':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'pico KiB':>9}")
+    for size, chat_id in chats.items():
+        chat_scenarios, ttft = scenarios(primebud, chat_id)
+        for name, fn in chat_scenarios:
+            samples, peak = measure(fn, args.iterations)
+            result = {
+                "scenario": name, "messages": size, "iterations": args.iterations,
+                "p50_ms": percentile(samples, 0.5), "p95_ms": percentile(samples, 0.95),
+                "p99_ms": percentile(samples, 0.99), "mean_ms": sum(samples) / len(samples),
+                "peak_alloc_bytes": peak,
+            }
+            results.append(result)
+            print(f"{name:<46} {size:>6} {result['p50_ms']:9.3f} {result['p95_ms']:9.3f} {result['p99_ms']:9.3f} "
+                  f"{peak / 1024:9.1f}")
+        for mode, samples in ttft.items():
+            samples = samples[1:1 + args.iterations] # Sem o aquecimento e a execução com tracemalloc
+            results.append({
+                "scenario": f"primeiro pedaço ({mode})", "messages": size, "iterations": len(samples),
+                "p50_ms": percentile(samples, 0.5), "p95_ms": percentile(samples, 0.95),
+                "p99_ms": percentile(samples, 0.99), "mean_ms": sum(samples) / len(samples),
+                "peak_alloc_bytes": None,
+            })
+            print(f"{'primeiro pedaço (' + mode + ')':<46} {size:>6} {results[-1]['p50_ms']:9.3f} "
+                  f"{results[-1]['p95_ms']:9.3f} {results[-1]['p99_ms']:9.3f} {'':>9}")
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as output:
+            json.dump({
+                "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                "provider": provider, "results": results,
+            }, output, ensure_ascii=False, indent=2)
+    if baseline_path and not compare(results, provider, baseline_path, args.tolerance, args.min_delta_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Benchmark: busca nas mensagens com FTS5 vs. varredura LIKE '%termo%'.
+
+Cria um banco sintético (vários usuários, chats e mensagens) num diretório temporário e compara:
+  - antes: SELECT ... WHERE content LIKE '%termo%' ORDER BY id DESC (varre todas as mensagens do usuário)
+  - depois: search_messages() do primebud.py (índice FTS5 ordenado por bm25, com trechos)
+Também mede o backfill incremental do índice para um banco criado antes do FTS.
+
+Uso: python benchmarks/bench_search.py [--messages 200000] [--queries 50]
+"""
+import argparse
+import random
+import sqlite3
+import statistics
+import time
+
+from _common import import_app
+
+
+COMMON = ("python função banco dados consulta índice streamlit mensagem modelo resposta erro código "
+          "lista dicionário classe objeto teste desempenho memória cache rede servidor cliente").split()
+USERS = 200
+CHATS_PER_USER = 20
+
+
+def measure(fn, queries):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(label, samples):
+    print(f"{label:<42} média {statistics.mean(samples):8.3f} ms  p50 {statistics.median(samples):8.3f} ms")
+
+
+def vocabulary(rng, size=20000):
+    """Vocabulário com distribuição de Zipf: poucas palavras muito comuns e uma cauda longa de raras."""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    rare = ["".join(rng.choices(letters, k=rng.randint(5, 10))) for _ in range(size)]
+    words = COMMON + rare
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    return words, weights
+
+
+def drop_fts(conn):
+    """Volta o banco ao esquema anterior à migração do FTS (versão 5)."""
+    conn.executescript('''
+        DROP TRIGGER IF EXISTS messages_fts_ai; DROP TRIGGER IF EXISTS messages_fts_ad;
+        DROP TRIGGER IF EXISTS messages_fts_au; DROP TRIGGER IF EXISTS chats_fts_bd;
+        DROP TABLE IF EXISTS messages_fts; DROP TABLE IF EXISTS fts_backfill;
+        DROP VIEW IF EXISTS messages_fts_source;
+        ALTER TABLE jobs DROP COLUMN images; -- Única migração posterior que não pode ser reaplicada
+        PRAGMA user_version = 5;
+    ''')
+
+
+def populate(messages, words, weights):
+    conn = sqlite3.connect("primebud.db")
+    drop_fts(conn)
+    rng = random.Random(42)
+    with conn:
+        conn.executemany("INSERT INTO users (username, password_hash) VALUES (?, 'x')",
+                         [(f"user{u}",) for u in range(USERS)])
+        conn.executemany("INSERT INTO chats (user_id, name, mode) VALUES (?, ?, 'primebud_1_0')",
+                         [(u + 1, f"Chat {c}") for u in range(USERS) for c in range(CHATS_PER_USER)])
+        chats = USERS * CHATS_PER_USER
+        conn.executemany("INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)",
+                         ((rng.randint(1, chats), rng.choice(("user", "assistant")),
+                           " ".join(rng.choices(words, weights, k=rng.randint(10, 60)))) for _ in range(messages)))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    # Simula um banco anterior ao FTS (o import já rodou init_db) e aplica a migração de novo
+    rng = random.Random(7)
+    words, weights = vocabulary(rng)
+    populate(args.messages, words, weights)
+    primebud.init_db.clear() # init_db roda uma vez por processo (st.cache_resource)
+    primebud.init_db()
+
+    conn = primebud.open_db_connection()
+    start = time.perf_counter()
+    batches = 0
+    while primebud.backfill_fts_index_batch(conn):
+        batches += 1
+    print(f"Backfill de {args.messages} mensagens: {time.perf_counter() - start:.2f} s em {batches + 1} lotes "
+          f"de até {primebud.FTS_BACKFILL_BATCH}")
+
+    common = [(rng.randint(1, USERS), " ".join(rng.sample(COMMON, rng.randint(1, 2)))) for _ in range(args.queries)]
+    rare = [(rng.randint(1, USERS), rng.choice(words[len(COMMON):len(COMMON) + 2000])) for _ in range(args.queries)]
+    mixed = [(user_id, f"{rng.choice(COMMON)} {text}") for user_id, text in rare]
+
+    def like_scan(query):
+        user_id, text = query
+        clauses = " AND ".join("m.content LIKE ?" for _ in text.split())
+        conn.execute(f'''
+            SELECT m.id, m.chat_id, c.name, m.role, m.content
+            FROM messages m JOIN chats c ON c.id = m.chat_id
+            WHERE c.user_id = ? AND {clauses}
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', (user_id, *[f"%{term}%" for term in text.split()], primebud.SEARCH_RESULTS_LIMIT)).fetchall()
+
+    def fts_search(query):
+        user_id, text = query
+        primebud.search_messages(user_id, text)
+
+    report("Termos comuns, antes (LIKE, mais recentes)", measure(like_scan, common))
+    report("Termos comuns, depois (FTS5 + bm25)", measure(fts_search, common))
+    report("Termos raros, antes (LIKE, mais recentes)", measure(like_scan, rare))
+    report("Termos raros, depois (FTS5 + bm25)", measure(fts_search, rare))
+    report("Comum + raro, antes (LIKE, mais recentes)", measure(like_scan, mixed))
+    report("Comum + raro, depois (FTS5 + bm25)", measure(fts_search, mixed))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Benchmark: busca semântica (TF-IDF com hashing + NumPy) e tamanho do prompt com e sem ela.
+
+Cria num diretório temporário um usuário com --messages mensagens sintéticas (vocabulário de Zipf,
+espalhadas em vários chats) num banco "anterior" à busca semântica e mede:
+  - o custo do vetor por mensagem (o que insert_turns acrescenta a cada gravação)
+  - o backfill dos vetores e a primeira carga do índice em memória
+  - search_similar_messages() com o índice quente (a meta é < 10 ms com 100 mil mensagens)
+  - os tokens enviados por turno num chat longo: histórico inteiro vs. janela + trechos recuperados
+
+Uso: python benchmarks/bench_semantic.py [--messages 100000] [--queries 200]
+"""
+import argparse
+import random
+import sqlite3
+import statistics
+import time
+
+from _common import import_app, percentile
+
+CHATS = 200
+
+
+def report(label, samples):
+    print(f"{label:<40} p50 {statistics.median(samples):7.3f} ms  p95 {percentile(samples, 0.95):7.3f} ms  "
+          f"p99 {percentile(samples, 0.99):7.3f} ms")
+
+
+def vocabulary(rng, size=20000):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(rng.choices(letters, k=rng.randint(3, 10))) for _ in range(size)]
+    return words, [1 / rank for rank in range(1, size + 1)]
+
+
+def populate(messages, words, weights, rng):
+    conn = sqlite3.connect("primebud.db")
+    with conn:
+        conn.execute("INSERT INTO users (username, password_hash) VALUES ('bench', 'x')")
+        conn.executemany("INSERT INTO chats (user_id, name) VALUES (1, ?)", [(f"Chat {i}",) for i in range(CHATS)])
+        conn.executemany("INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)",
+                         ((rng.randint(1, CHATS), rng.choice(("user", "assistant")),
+                           " ".join(rng.choices(words, weights, k=rng.randint(10, 120)))) for _ in range(messages)))
+        # Simula um banco anterior à busca semântica: tudo fica para o backfill
+        conn.execute("UPDATE embedding_backfill SET last_id = 0, target_id = (SELECT MAX(id) FROM messages)")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    rng = random.Random(3)
+    words, weights = vocabulary(rng)
+    populate(args.messages, words, weights, rng)
+
+    sample = [" ".join(rng.choices(words, weights, k=rng.randint(10, 120))) for _ in range(1000)]
+    samples = []
+    for text in sample:
+        start = time.perf_counter()
+        primebud.embedding_blob(text)
+        samples.append((time.perf_counter() - start) * 1000)
+    report("Vetor de uma mensagem (insert_turns)", samples)
+
+    conn = primebud.open_db_connection()
+    start = time.perf_counter()
+    while primebud.backfill_embeddings_batch(conn):
+        pass
+    print(f"Backfill de {args.messages} mensagens: {time.perf_counter() - start:.2f} s")
+    conn.close()
+
+    start = time.perf_counter()
+    index = primebud.load_semantic_index(1)
+    print(f"Primeira carga do índice: {(time.perf_counter() - start) * 1000:.0f} ms, "
+          f"{index.nbytes / 2 ** 20:.0f} MiB em memória")
+
+    queries = [" ".join(rng.choices(words, weights, k=rng.randint(5, 40))) for _ in range(args.queries)]
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        primebud.search_similar_messages(1, query, primebud.RETRIEVAL_TOP_K)
+        samples.append((time.perf_counter() - start) * 1000)
+    report(f"search_similar_messages ({args.messages} msgs)", samples)
+    samples = []
+    for query in queries:
+        vector = primebud.embed_text(query)
+        start = time.perf_counter()
+        with index.lock:
+            index.search(vector, primebud.RETRIEVAL_TOP_K)
+        samples.append((time.perf_counter() - start) * 1000)
+    report("  só a busca vetorial", samples)
+
+    # Tokens por turno ao longo de uma conversa que cresce (o resumo vira um texto fixo: o real chamaria o provedor)
+    primebud.summarize_messages = lambda previous_summary, messages: "resumo " * 300
+    conn = primebud.open_db_connection()
+    chat_rows = conn.execute("SELECT id, role, content FROM messages WHERE chat_id = 1 ORDER BY id").fetchall()
+    for mode in ("primebud_1_0", "primebud_2_0"):
+        averages = {}
+        for enabled in (False, True):
+            primebud.SEMANTIC_CONTEXT_ENABLED = enabled
+            with conn:
+                conn.execute("DELETE FROM chat_summaries")
+            history = [{"id": msg_id, "role": role, "content": content} for msg_id, role, content in chat_rows]
+            totals = []
+            for turn in range(1, len(history)):
+                if history[turn]["role"] != "user":
+                    continue
+                context, config = primebud.build_context(history[:turn + 1], mode, chat_id=1)
+                totals.append(primebud.estimate_tokens(config["system_prompt"])
+                              + sum(primebud.message_tokens(msg) for msg in context))
+            averages[enabled] = statistics.mean(totals)
+        print(f"Tokens por turno ({mode}, {len(chat_rows)} msgs): histórico {averages[False]:7.0f}  "
+              f"janela + trechos {averages[True]:7.0f}  ({(averages[True] / averages[False] - 1) * 100:+.0f}%)")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark: gravação de um turno (pergunta + resposta) com várias sessões simultâneas.
+
+Compara, num banco temporário:
+  - antes: save_message(pergunta) + releitura do chat + save_message(resposta) (dois commits por turno)
+  - depois: save_turn() (um commit por turno)
+  - write-behind: TurnWriter, que junta os turnos de todas as sessões no mesmo commit
+
+Uso: python benchmarks/bench_writes.py [--sessions 16] [--turns 200]
+"""
+import argparse
+import sqlite3
+import statistics
+import threading
+import time
+
+from _common import import_app
+
+ANSWER = "resposta " * 200
+
+
+def run(label, sessions, turns, turn_fn, primebud):
+    conn = sqlite3.connect(primebud.DB_NAME)
+    commits_before = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    latencies = []
+    lock = threading.Lock()
+
+    def session(chat_id):
+        samples = []
+        for i in range(turns):
+            start = time.perf_counter()
+            turn_fn(chat_id, f"pergunta {i}")
+            samples.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=session, args=(chat_id,)) for chat_id in range(1, sessions + 1)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    saved = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] - commits_before
+    conn.close()
+    latencies.sort()
+    print(f"{label:<34} {sessions * turns / elapsed:8.0f} turnos/s  p50 {statistics.median(latencies):6.2f} ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:6.2f} ms  mensagens {saved}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    primebud = import_app()
+
+    conn = sqlite3.connect(primebud.DB_NAME)
+    conn.execute("INSERT INTO users (username, password_hash) VALUES ('bench', 'x')")
+    conn.executemany("INSERT INTO chats (user_id, name) VALUES (1, ?)", [(f"Chat {i}",) for i in range(args.sessions)])
+    conn.commit()
+    conn.close()
+
+    def before(chat_id, question):
+        primebud.save_message(chat_id, "user", question)
+        primebud.get_chat_messages(chat_id)
+        primebud.save_message(chat_id, "assistant", ANSWER)
+
+    def after(chat_id, question):
+        primebud.save_turn(chat_id, [("user", question), ("assistant", ANSWER)])
+
+    writer = primebud.TurnWriter(primebud.get_db_pool())
+
+    def write_behind(chat_id, question):
+        writer.submit(chat_id, [("user", question), ("assistant", ANSWER)]).result()
+
+    # O "antes" relê o chat inteiro a cada turno, então roda primeiro, com os chats ainda vazios
+    run("Antes (2 commits + releitura)", args.sessions, args.turns, before, primebud)
+    run("Depois (save_turn, 1 commit)", args.sessions, args.turns, after, primebud)
+    run("Write-behind (commits em lote)", args.sessions, args.turns, write_behind, primebud)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,31 +3,84 @@ import sqlite3
 import hashlib # <-- Revertido para hashlib
 import re
 import os
+import sys
 import random
+import queue
 import base64
+import html
+import io
+import hmac
+import secrets
+import tempfile
+import zipfile
+import asyncio
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+import bisect
+import functools
+import inspect
+import math
+import zlib
+from collections import Counter, OrderedDict, deque
 from datetime import datetime
-from groq import Groq
 from contextlib import contextmanager
-import google.generativeai as genai 
-from PIL import Image
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+# Os SDKs da Groq e do Gemini, o httpx, o numpy e o Pillow são importados dentro das funções que os usam:
+# a tela de login não precisa de nenhum deles e cada um custa ~0.1 s ou mais na partida (ver groq_sdk/gemini_sdk)
 # IMPORTANTE: Removidas as imports de Tool/types/APIError
 # from google.generativeai import types
 # from google.generativeai.types import Tool
 # from google.generativeai.errors import APIError 
 
-# 1. Função para carregar logo
-def get_logo_base64():
-    """Carrega o logo e converte para base64 para usar no HTML."""
+logger = logging.getLogger("primebud") # Erros das threads de fundo, que não têm tela para exibir
+
+# 1. Arquivos estáticos (CSS e logo)
+# Servidos pelo próprio Streamlit em app/static/ (server.enableStaticServing no .streamlit/config.toml).
+# Se o static serving estiver desligado, volta ao modo antigo: CSS e logo embutidos na página.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+LEGACY_ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets") # Onde ficava o logo antes
+
+@st.cache_resource
+def read_static_asset(name, directory=STATIC_DIR):
+    """Lê um arquivo de static/ uma vez por processo. Retorna (bytes, versão) ou None se não existir."""
     try:
-        logo_path = os.path.join(os.path.dirname(__file__), "assets", "logo.png")
-        if os.path.exists(logo_path):
-            with open(logo_path, "rb") as f:
-                return base64.b64encode(f.read()).decode()
-    except:
-        pass
-    return None
+        with open(os.path.join(directory, name), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # A versão muda a URL quando o arquivo muda, invalidando o cache do navegador
+    return data, hashlib.blake2b(data, digest_size=6).hexdigest()
+
+def static_serving_enabled():
+    return bool(st.get_option("server.enableStaticServing"))
+
+@st.cache_resource
+def static_asset_url(name, mime, serving=True, directory=STATIC_DIR):
+    """URL de um arquivo de static/ (versionada) ou, sem static serving, um data URI. None se não existir."""
+    asset = read_static_asset(name, directory)
+    if asset is None:
+        return None
+    data, version = asset
+    if serving:
+        return f"app/static/{name}?v={version}"
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+def load_styles():
+    """Aplica o CSS do app: um <link> para o arquivo estático ou, sem static serving, o <style> inline."""
+    if static_serving_enabled():
+        st.markdown(f'<link rel="stylesheet" href="{static_asset_url("primebud.css", "text/css")}">',
+                    unsafe_allow_html=True)
+    else:
+        asset = read_static_asset("primebud.css")
+        if asset is not None:
+            st.markdown(f"<style>\n{asset[0].decode()}\n</style>", unsafe_allow_html=True)
 
-LOGO_BASE64 = get_logo_base64()
+# Instalações antigas têm o logo em assets/logo.png: o static serving só publica static/, então ele vai embutido
+LOGO_URL = (static_asset_url("logo.png", "image/png", static_serving_enabled())
+            or static_asset_url("logo.png", "image/png", serving=False, directory=LEGACY_ASSETS_DIR))
 
 # 2. Configuração da Página
 st.set_page_config(
@@ -49,6 +102,8 @@ MODES_CONFIG = {
         "system_prompt": "Você é o PrimeBud 1.0 Flash. Forneça respostas extremamente rápidas, diretas e concisas. Vá direto ao ponto sem rodeios.",
         "temperature": 0.3,
         "max_tokens": 500,
+        "context_tokens": 4000, # Orçamento de tokens do histórico enviado ao provedor
+        "cache_responses": True, # Opt-in: respostas repetidas vêm do cache (modo quase determinístico)
         "api_provider": "groq",
         "model": "openai/gpt-oss-120b"
     },
@@ -59,6 +114,7 @@ MODES_CONFIG = {
         "system_prompt": "Você é o PrimeBud 1.0, a versão clássica. Forneça respostas equilibradas, completas e bem estruturadas, mantendo clareza e objetividade.",
         "temperature": 0.7,
         "max_tokens": 2000,
+        "context_tokens": 8000,
         "api_provider": "groq",
         "model": "openai/gpt-oss-120b"
     },
@@ -69,6 +125,7 @@ MODES_CONFIG = {
         "system_prompt": "Você é o PrimeBud 1.5, a versão híbrida premium. Combine clareza com profundidade, sendo detalhado quando necessário mas sempre mantendo objetividade e estrutura clara. Quando fornecer código, use blocos de código markdown com ```linguagem para melhor formatação.",
         "temperature": 0.75,
         "max_tokens": 3000,
+        "context_tokens": 12000,
         "api_provider": "groq",
         "model": "openai/gpt-oss-120b"
     },
@@ -79,294 +136,205 @@ MODES_CONFIG = {
         "system_prompt": "Você é o PrimeBud 2.0, rodando no Gemini 2.5. Você é a versão mais avançada. Forneça análises profundas, respostas extremamente detalhadas e completas, explorando múltiplas perspectivas e nuances. Seja o mais abrangente possível. Quando fornecer código, sempre use blocos de código markdown com ```linguagem.",
         "temperature": 0.85,
         "max_tokens": 4000,
+        "context_tokens": 32000,
         "api_provider": "gemini",
         "model": "gemini-2.5-flash",
+        "multimodal": True, # Aceita imagens anexadas
         # REMOVIDA A CHAVE "tools"
     },
 }
+for mode_key, mode_config in MODES_CONFIG.items():
+    mode_config["key"] = mode_key # Cada config conhece o próprio modo (rótulo das métricas)
 
 # 3. Estilos CSS
-# (O seu CSS completo está aqui)
-st.markdown("""
-<style>
-    /* ... Seu CSS completo vai aqui ... */
-    /* Tema escuro elegante */
-    .main {
-        background-color: #1a1d23;
-    }
-    
-    .block-container {
-        padding-top: 3rem; /* <-- CORREÇÃO DO CSS APLICADA AQUI */
-        padding-bottom: 0.5rem;
-        max-width: 1200px;
-    }
-    
-    /* Inputs */
-    .stTextInput > div > div > input,
-    .stTextArea > div > div > textarea {
-        background-color: #2d3139;
-        color: #e8e8e8;
-        border: 2px solid #3d4149;
-        border-radius: 10px;
-        font-size: 0.95rem;
-    }
-    
-    .stTextInput > div > div > input:focus,
-    .stTextArea > div > div > textarea:focus {
-        border-color: #ff6b35;
-        box-shadow: 0 0 0 2px rgba(255, 107, 53, 0.3);
-    }
-    
-    .stTextArea > div > div > textarea {
-        min-height: 60px !important;
-        max-height: 60px !important;
-    }
-    
-    .stSelectbox > div > div > select {
-        background-color: #2d3139;
-        color: #e8e8e8;
-        border: 2px solid #3d4149;
-        border-radius: 8px;
-        font-weight: 600;
-    }
-    
-    /* Mensagens do chat */
-    .chat-message {
-        padding: 1.2rem;
-        border-radius: 16px;
-        margin-bottom: 1rem;
-        max-width: 80%;
-        word-wrap: break-word;
-        line-height: 1.6;
-        animation: fadeIn 0.3s ease-in;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.08);
-    }
-    
-    @keyframes fadeIn {
-        from { opacity: 0; transform: translateY(10px); }
-        to { opacity: 1; transform: translateY(0); }
-    }
-    
-    .user-message {
-        background: linear-gradient(135deg, #ff6b35 0%, #ff8555 100%);
-        color: white;
-        margin-left: auto;
-        margin-right: 0;
-    }
-    
-    .assistant-message {
-        background-color: #2d3139;
-        color: #e8e8e8;
-        border: 2px solid #3d4149;
-        margin-right: auto;
-        margin-left: 0;
-    }
-    
-    .message-label {
-        font-size: 0.7rem;
-        opacity: 0.7;
-        margin-bottom: 0.5rem;
-        font-weight: 700;
-        text-transform: uppercase;
-        letter-spacing: 0.5px;
-    }
-    
-    /* Botões */
-    .stButton > button {
-        background: linear-gradient(135deg, #ff6b35 0%, #ff8555 100%);
-        color: white;
-        border: none;
-        border-radius: 10px;
-        padding: 0.7rem 1.5rem;
-        font-weight: 600;
-        width: 100%;
-        transition: all 0.3s ease;
-        box-shadow: 0 2px 8px rgba(255, 107, 53, 0.2);
-    }
-    
-    .stButton > button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 6px 20px rgba(255, 107, 53, 0.4);
-    }
-    
-    /* Botão de copiar código */
-    .copy-button {
-        background: #4CAF50;
-        color: white;
-        border: none;
-        border-radius: 6px;
-        padding: 0.4rem 1rem;
-        font-size: 0.8rem;
-        font-weight: 600;
-        cursor: pointer;
-        transition: all 0.2s;
-        margin-top: 0.5rem;
-    }
-    
-    .copy-button:hover {
-        background: #45a049;
-        transform: scale(1.05);
-    }
-    
-    /* Títulos */
-    h1 {
-        color: #ff6b35;
-        font-weight: 800;
-        font-size: 2.5rem;
-        margin-bottom: 0.5rem;
-    }
-    
-    h2, h3 {
-        color: #ff6b35;
-        font-weight: 700;
-    }
-    
-    /* Sidebar */
-    [data-testid="stSidebar"] {
-        background-color: #1a1d23;
-        border-right: 2px solid #2d3139;
-    }
-    
-    [data-testid="stSidebar"] .stButton > button {
-        background: #2d3139;
-        border: 2px solid #3d4149;
-        color: #e8e8e8;
-    }
-    
-    [data-testid="stSidebar"] .stButton > button:hover {
-        background: linear-gradient(135deg, #ff6b35 0%, #ff8555 100%);
-        border: none;
-        color: white;
-    }
-    
-    /* Scrollbar */
-    ::-webkit-scrollbar {
-        width: 10px;
-        height: 10px;
-    }
-    
-    ::-webkit-scrollbar-track {
-        background: #1a1d23;
-    }
-    
-    ::-webkit-scrollbar-thumb {
-        background: linear-gradient(135deg, #ff6b35 0%, #ff8555 100%);
-        border-radius: 5px;
-    }
-    
-    ::-webkit-scrollbar-thumb:hover {
-        background: #ff8555;
-    }
-    
-    /* Info boxes */
-    .stInfo {
-        background-color: #1e3a5f;
-        border-left: 4px solid #2196F3;
-        border-radius: 8px;
-        color: #e8e8e8;
-    }
-    
-    .stSuccess {
-        background-color: #1e4620;
-        border-left: 4px solid #4CAF50;
-        color: #e8e8e8;
-    }
-    
-    /* Tabs */
-    .stTabs [data-baseweb="tab-list"] {
-        gap: 12px;
-        background-color: transparent;
-    }
-    
-    .stTabs [data-baseweb="tab"] {
-        background-color: #2d3139;
-        border-radius: 10px;
-        color: #888;
-        padding: 12px 24px;
-        font-weight: 600;
-        border: 2px solid #3d4149;
-    }
-    
-    .stTabs [aria-selected="true"] {
-        background: linear-gradient(135deg, #ff6b35 0%, #ff8555 100%);
-        color: white;
-        border: none;
-    }
-    
-    /* Badge do modo */
-    .mode-badge {
-        display: inline-block;
-        padding: 0.3rem 0.8rem;
-        border-radius: 20px;
-        font-size: 0.75rem;
-        font-weight: 700;
-        background: linear-gradient(135deg, #ff6b35 0%, #ff8555 100%);
-        color: white;
-        margin-left: 0.5rem;
-    }
-    
-    /* Container de chat */
-    .chat-container {
-        background-color: #0f1115;
-        border-radius: 12px;
-        padding: 1rem;
-        margin-bottom: 1rem;
-        border: 2px solid #2d3139;
-    }
-    
-    /* Código com syntax highlighting */
-    pre {
-        background-color: #1e1e1e !important;
-        color: #d4d4d4 !important;
-        padding: 1rem !important;
-        border-radius: 8px !important;
-        overflow-x: auto !important;
-        margin: 1rem 0 !important;
-        border: 2px solid #333 !important;
-    }
+# O CSS fica em static/primebud.css e é servido pelo Streamlit (server.enableStaticServing), então
+# cada rerun envia só a tag <link>; o navegador guarda o arquivo em cache entre recarregamentos.
+load_styles()
+
+
+# 4. Funções Utilitárias (Helpers)
+
+# --- Métricas (latência e tokens) ---
+# Histogramas em memória (baratos: um bisect e uma soma sob lock), descarregados periodicamente na
+# tabela metrics e exportados no formato texto do Prometheus (painel de admin e PRIMEBUD_METRICS_FILE).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # segundos
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+METRICS = { # nome -> (descrição, limites dos buckets)
+    "primebud_db_seconds": ("Duração das funções de banco", LATENCY_BUCKETS),
+    "primebud_render_seconds": ("Duração de format_message_with_code", LATENCY_BUCKETS),
+    "primebud_provider_seconds": ("Duração das chamadas aos provedores, por função", LATENCY_BUCKETS),
+    "primebud_mode_seconds": ("Latência da resposta completa do provedor, por modo", LATENCY_BUCKETS),
+    "primebud_mode_ttft_seconds": ("Tempo até o primeiro pedaço da resposta em streaming, por modo", LATENCY_BUCKETS),
+    "primebud_rate_limit_wait_seconds": ("Espera na fila do limite de taxa, por provedor", LATENCY_BUCKETS),
+    "primebud_prompt_tokens": ("Tokens de entrada informados pelo provedor, por modo", TOKEN_BUCKETS),
+    "primebud_completion_tokens": ("Tokens de saída informados pelo provedor, por modo", TOKEN_BUCKETS),
+    "primebud_request_payload_bytes": ("Tamanho do conteúdo enviado ao provedor (texto + imagens), por modo", BYTE_BUCKETS),
+    "primebud_image_upload_bytes": ("Tamanho das imagens recebidas no upload, por formato", BYTE_BUCKETS),
+    "primebud_image_bytes": ("Tamanho das imagens depois de reduzidas e recodificadas, por formato original", BYTE_BUCKETS),
+    "primebud_image_seconds": ("Preparação de cada imagem anexada, por resultado do cache", LATENCY_BUCKETS),
+}
+METRICS_FLUSH_INTERVAL = 30 # Intervalo (s) entre descargas dos histogramas no banco
+METRICS_FILE = os.getenv("PRIMEBUD_METRICS_FILE") # Opcional: arquivo .prom para o textfile collector
+# Usuários (separados por vírgula) que veem o painel de métricas
+ADMIN_USERS = {name.strip() for name in os.getenv("PRIMEBUD_ADMIN_USERS", "").split(",") if name.strip()}
+
+class MetricsRegistry:
+    """Histogramas por (métrica, rótulos) acumulados desde a última descarga no banco."""
     
-    code {
-        background-color: #1e1e1e !important;
-        color: #d4d4d4 !important;
-        padding: 0.2rem 0.4rem !important;
-        border-radius: 4px !important;
-        font-family: 'Courier New', monospace !important;
-    }
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
     
-    /* Download button */
-    .download-button {
-        background: #2196F3;
-        color: white;
-        border: none;
-        border-radius: 8px;
-        padding: 0.5rem 1rem;
-        font-size: 0.85rem;
-        font-weight: 600;
-        cursor: pointer;
-        transition: all 0.2s;
-        margin-top: 0.5rem;
-        display: inline-block;
-    }
+    def observe(self, name, labels, value):
+        bounds = METRICS[name][1]
+        key = (name, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(bounds) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(bounds, value)] += 1
+            series[1] += value
+            series[2] += 1
     
-    .download-button:hover {
-        background: #1976D2;
-        transform: scale(1.05);
-    }
-</style>
-""", unsafe_allow_html=True)
+    def drain(self):
+        """Retorna {(métrica, rótulos): [contagens por bucket, soma, total]} e zera o registro."""
+        with self._lock:
+            series, self._series = self._series, {}
+        return series
 
+@st.cache_resource
+def get_metrics():
+    return MetricsRegistry()
 
-# 4. Funções Utilitárias (Helpers)
+# Resolvido uma vez por execução do script: observe roda em caminhos quentes e a busca no
+# st.cache_resource custaria mais que a própria medição
+METRICS_REGISTRY = get_metrics()
+
+def observe(name, value, **labels):
+    METRICS_REGISTRY.observe(name, tuple(sorted(labels.items())), value)
+
+def timed(name):
+    """Decorator que mede a duração de cada chamada em name, com o rótulo function=<nome da função>.
+
+    Funciona com funções comuns, geradores (mede até o fim da iteração) e corrotinas.
+    """
+    def decorator(fn):
+        function = fn.__name__
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    yield from fn(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - start, function=function)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - start, function=function)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - start, function=function)
+        return wrapper
+    return decorator
+
+def record_token_usage(config, prompt_tokens, completion_tokens):
+    """Registra o uso de tokens informado pelo provedor (usage da Groq, usage_metadata do Gemini)."""
+    if prompt_tokens is not None:
+        observe("primebud_prompt_tokens", prompt_tokens, mode=config["key"])
+    if completion_tokens is not None:
+        observe("primebud_completion_tokens", completion_tokens, mode=config["key"])
+
+def observe_stream(chunks, mode, start):
+    """Repassa os pedaços do stream medindo o tempo até o primeiro e até o fim (só streams completos)."""
+    first = True
+    for chunk in chunks:
+        if first:
+            observe("primebud_mode_ttft_seconds", time.perf_counter() - start, mode=mode)
+            first = False
+        yield chunk
+    observe("primebud_mode_seconds", time.perf_counter() - start, mode=mode)
+
+def histogram_quantile(quantile, bounds, counts):
+    """Quantil estimado de um histograma (interpolação linear dentro do bucket, como no Prometheus)."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if seen + count >= rank and count:
+            if index == len(bounds): # Bucket +Inf: o melhor palpite é o último limite
+                return bounds[-1]
+            lower = bounds[index - 1] if index else 0
+            return lower + (bounds[index] - lower) * (rank - seen) / count
+        seen += count
+    return bounds[-1]
+
+def metrics_table(rows, name, label, scale=1):
+    """Uma linha por valor do rótulo: chamadas, média e quantis (valores multiplicados por scale)."""
+    bounds = METRICS[name][1]
+    table = []
+    for metric, labels, counts, total, count in rows:
+        if metric != name or not count:
+            continue
+        table.append({
+            label: json.loads(labels).get(label),
+            "chamadas": count,
+            "média": round(total / count * scale, 2),
+            **{f"p{int(q * 100)}": round(histogram_quantile(q, bounds, counts) * scale, 2) for q in (0.5, 0.95, 0.99)},
+        })
+    return table
+
+def format_prometheus_metrics(rows):
+    """Formato texto do Prometheus para linhas (nome, rótulos JSON, contagens por bucket, soma, total)."""
+    lines = []
+    by_name = {}
+    for name, labels, counts, total, count in rows:
+        by_name.setdefault(name, []).append((json.loads(labels), counts, total, count))
+    for name, series in sorted(by_name.items()):
+        description, bounds = METRICS.get(name, ("", ()))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, counts, total, count in series:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, bucket_count in zip(list(bounds) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label_text}}} {total}")
+            lines.append(f"{name}_count{{{label_text}}} {count}")
+    return "\n".join(lines) + "\n"
+
+# Padrões pré-compilados uma vez (format_message_with_code roda para cada mensagem exibida)
+CODE_BLOCK_PATTERN = re.compile(r'```(\w+)?\n(.*?)```', re.DOTALL)
+INLINE_CODE_PATTERN = re.compile(r'`([^`]+)`')
+
+@timed("primebud_render_seconds")
 def format_message_with_code(content):
-    """Detecta blocos de código e adiciona syntax highlighting e botão de copiar."""
-    code_pattern = r'```(\w+)?\n(.*?)```'
-    
+    """Detecta blocos de código e adiciona syntax highlighting e botão de copiar.
+
+    Todo o texto é escapado: mensagens (do usuário ou do modelo) nunca viram HTML ativo na página.
+    """
     def replace_code(match):
         language = match.group(1) or 'text'
         code = match.group(2)
-        # Escapar HTML e backticks para o JS
-        code_html_escaped = code.replace('<', '&lt;').replace('>', '&gt;')
-        code_js_escaped = code.replace('`', '\\`').replace('\\', '\\\\')
+        # Escapar HTML e, para o template literal do JS, barras invertidas antes de crases e ${
+        code_html_escaped = html.escape(code, quote=False)
+        code_js_escaped = code.replace('\\', '\\\\').replace('`', '\\`').replace('${', '\\${')
+        # O JS fica dentro de um atributo onclick: aspas e < viram entidades (o navegador as desfaz antes do JS)
+        code_js_escaped = html.escape(code_js_escaped)
         
         return f'''
         <div style="position: relative; margin: 1rem 0;">
@@ -375,95 +343,625 @@ def format_message_with_code(content):
         </div>
         '''
     
-    formatted = re.sub(code_pattern, replace_code, content, flags=re.DOTALL)
-    inline_pattern = r'`([^`]+)`'
-    formatted = re.sub(inline_pattern, r'<code>\1</code>', formatted)
+    def format_text(text):
+        return INLINE_CODE_PATTERN.sub(r'<code>\1</code>', html.escape(text, quote=False))
     
-    return formatted
+    parts = []
+    last = 0
+    for match in CODE_BLOCK_PATTERN.finditer(content):
+        parts.append(format_text(content[last:match.start()]))
+        parts.append(replace_code(match))
+        last = match.end()
+    parts.append(format_text(content[last:]))
+    return "".join(parts)
 
-def export_chat_to_text(messages, chat_name):
-    """Exporta o histórico do chat para texto"""
-    text = f"# {chat_name}\n"
-    text += f"Exportado em: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n\n"
-    text += "="*50 + "\n\n"
+# --- Cache de Renderização ---
+RENDER_CACHE_MAX_ENTRIES = 2000
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024 # Limite do HTML memorizado por processo
+
+class RenderCache:
+    """LRU limitado (em entradas e bytes) do HTML já gerado para cada mensagem."""
     
-    for msg in messages:
-        if isinstance(msg, dict):
-            role, content = msg['role'], msg['content']
-        else:
-            role, content, _ = msg
-        
-        if role == "user":
-            text += f"👤 VOCÊ:\n{content}\n\n"
-        else:
-            # Lidar com 'assistant' (Groq) e 'model' (Gemini)
-            text += f"🤖 PRIMEBUD:\n{content}\n\n"
-        
-        text += "-"*50 + "\n\n"
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
     
-    return text
+    def get(self, key):
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+            return rendered
+    
+    def put(self, key, rendered):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = rendered
+            self._bytes += len(rendered)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+@st.cache_resource
+def get_render_cache():
+    return RenderCache()
+
+def render_message_html(content, message_id=None):
+    """format_message_with_code memorizado: mensagens salvas são imutáveis, então só as novas são processadas.
+
+    A chave é o id da mensagem quando existe (sem custo de hash) ou um hash do conteúdo.
+    """
+    if message_id is not None:
+        key = ("id", message_id)
+    else:
+        key = ("sha", hashlib.blake2b(content.encode(), digest_size=16).digest())
+    cache = get_render_cache()
+    rendered = cache.get(key)
+    if rendered is None:
+        rendered = format_message_with_code(content)
+        cache.put(key, rendered)
+    return rendered
+
+# --- Exportação ---
+# Cada exportador é um gerador que recebe linhas (role, content, created_at) e devolve pedaços de
+# texto, então nada é montado por concatenação e as linhas podem vir direto de um cursor.
+EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # Acima disso o arquivo gerado vai para o disco
+
+def export_author(role):
+    # Lidar com 'assistant' (Groq) e 'model' (Gemini)
+    return "👤 VOCÊ" if role == "user" else "🤖 PRIMEBUD"
+
+def export_txt(rows, chat_name):
+    """Exporta o histórico do chat para texto"""
+    yield f"# {chat_name}\nExportado em: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n\n" + "="*50 + "\n\n"
+    for role, content, _ in rows:
+        yield f"{export_author(role).upper()}:\n{content}\n\n" + "-"*50 + "\n\n"
+
+def export_markdown(rows, chat_name):
+    yield f"# {chat_name}\n\n_Exportado em: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}_\n\n"
+    for role, content, created_at in rows:
+        when = f" · {created_at}" if created_at else ""
+        yield f"### {export_author(role)}{when}\n\n{content}\n\n---\n\n"
+
+def export_jsonl(rows, chat_name):
+    for role, content, created_at in rows:
+        yield json.dumps({"chat": chat_name, "role": role, "content": content, "created_at": created_at},
+                         ensure_ascii=False) + "\n"
+
+def export_html(rows, chat_name):
+    title = html.escape(chat_name)
+    yield (f"<!DOCTYPE html>\n<html lang=\"pt-BR\"><head><meta charset=\"utf-8\"><title>{title}</title>"
+           "<style>body{font-family:sans-serif;max-width:800px;margin:auto;padding:1rem}"
+           ".user{background:#fff3e0}.assistant{background:#f5f5f5}"
+           "div{border-radius:8px;padding:.75rem;margin:.75rem 0;white-space:pre-wrap}</style></head><body>\n"
+           f"<h1>{title}</h1>\n<p>Exportado em: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}</p>\n")
+    for role, content, _ in rows:
+        css_class = "user" if role == "user" else "assistant"
+        yield f"<div class=\"{css_class}\"><b>{export_author(role)}</b>\n{html.escape(content)}</div>\n"
+    yield "</body></html>\n"
+
+# formato -> (rótulo, exportador, extensão, mime)
+EXPORT_FORMATS = {
+    "txt": ("Texto (.txt)", export_txt, "txt", "text/plain"),
+    "md": ("Markdown (.md)", export_markdown, "md", "text/markdown"),
+    "jsonl": ("JSON Lines (.jsonl)", export_jsonl, "jsonl", "application/x-ndjson"),
+    "html": ("HTML (.html)", export_html, "html", "text/html"),
+}
+
+def export_file_name(chat_name, fmt):
+    """Nome de arquivo seguro (sem barras ou caracteres reservados) para o chat exportado."""
+    safe_name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', '_', chat_name).strip(' .') or "chat"
+    return f"{safe_name}.{EXPORT_FORMATS[fmt][2]}"
+
+def write_export(chunks, binary_file):
+    """Grava os pedaços de texto de um exportador num arquivo binário, sem juntá-los em memória."""
+    for chunk in chunks:
+        binary_file.write(chunk.encode('utf-8'))
+
+def export_chat_bytes(rows, chat_name, fmt):
+    """Gera a exportação de um chat num arquivo temporário e devolve os bytes (para st.download_button)."""
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as spool:
+        write_export(EXPORT_FORMATS[fmt][1](rows, chat_name), spool)
+        spool.seek(0)
+        return spool.read()
+
+# --- Imagens Anexadas ---
+# Anexos são decodificados, reduzidos e recodificados (WebP; JPEG se o Pillow não tiver WebP) num
+# pool de threads, fora da thread do script. O resultado vai para um cache em disco endereçado pelo
+# SHA-256 do arquivo enviado: a mesma imagem reenviada depois não é reprocessada, e o banco guarda
+# só o nome do arquivo (tabela message_images), nunca os bytes.
+IMAGE_CACHE_DIR = os.getenv("PRIMEBUD_IMAGE_DIR", "primebud_images")
+IMAGE_UPLOAD_TYPES = ["png", "jpg", "jpeg", "webp", "gif", "bmp"]
+IMAGE_MAX_FILES = 4
+IMAGE_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+IMAGE_MAX_PIXELS = 50_000_000   # Recusa "bombas de descompressão" antes de decodificar
+IMAGE_MAX_SIDE = 1536           # Lado maior depois da redução (px)
+IMAGE_QUALITY = 80
+IMAGE_WORKERS = 2
+IMAGE_TOKENS = 258              # Custo aproximado de cada imagem no contexto do Gemini
+IMAGE_PREVIEW_WIDTH = 240
+IMAGE_MIME_TYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+
+@st.cache_resource
+def get_image_format():
+    """(formato do Pillow, extensão) da saída: WebP se o Pillow tiver suporte, senão JPEG."""
+    from PIL import features
+    return ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+@st.cache_resource
+def get_image_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="primebud-image")
+
+def image_path(name):
+    return os.path.join(IMAGE_CACHE_DIR, name)
+
+def image_mime_type(name):
+    return IMAGE_MIME_TYPES[name.rsplit(".", 1)[1]]
+
+def process_image(data):
+    """Reduz e recodifica uma imagem enviada. Retorna o nome do arquivo no cache ("<sha256>.<ext>").
+
+    Levanta ValueError (com mensagem para o usuário) se o arquivo não for uma imagem válida.
+    """
+    from PIL import Image, ImageOps
+
+    start = time.perf_counter()
+    output_format, extension = get_image_format()
+    name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+    path = image_path(name)
+    if os.path.exists(path):
+        observe("primebud_image_seconds", time.perf_counter() - start, cache="hit")
+        return name
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            source_format = source.format or "?"
+            if source.width * source.height > IMAGE_MAX_PIXELS:
+                raise ValueError("Imagem grande demais (resolução acima do limite).")
+            source.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE)) # JPEG: já decodifica numa escala menor
+            image = ImageOps.exif_transpose(source)
+            keep_alpha = output_format == "WEBP" and image.has_transparency_data
+            image = image.convert("RGBA" if keep_alpha else "RGB")
+            image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, output_format, quality=IMAGE_QUALITY)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError("Arquivo de imagem inválido ou corrompido.") from e
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    # Troca atômica: quem lê o cache nunca vê um arquivo pela metade
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as image_file:
+        image_file.write(buffer.getvalue())
+    os.replace(temp_path, path)
+    observe("primebud_image_upload_bytes", len(data), format=source_format)
+    observe("primebud_image_bytes", buffer.tell(), format=source_format)
+    observe("primebud_image_seconds", time.perf_counter() - start, cache="miss")
+    return name
+
+def prepare_images(files):
+    """Processa os anexos (bytes) em paralelo no pool; a thread do script só espera. Retorna os nomes no cache."""
+    futures = [get_image_executor().submit(process_image, data) for data in files]
+    return [future.result() for future in futures]
+
+def load_image_bytes(name):
+    """Bytes da imagem processada, ou None se o arquivo sumiu do cache."""
+    try:
+        with open(image_path(name), "rb") as image_file:
+            return image_file.read()
+    except FileNotFoundError:
+        return None
 
 # 5. Funções de Banco de Dados (SQLite)
 DB_NAME = 'primebud.db'
+DB_POOL_SIZE = 8           # Conexões ociosas mantidas abertas por processo
+DB_BUSY_TIMEOUT_MS = 5000  # Espera por locks em vez de falhar com "database is locked"
+DB_CACHE_SIZE_KB = 8192    # Cache de páginas por conexão (PRAGMA cache_size negativo = KiB)
+
+def open_db_connection():
+    """Abre uma conexão SQLite já configurada (WAL, synchronous=NORMAL, busy timeout, foreign keys)."""
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA foreign_keys=ON')  # Necessário para o ON DELETE CASCADE
+    return conn
+
+class ConnectionPool:
+    """Pool simples de conexões SQLite reutilizadas entre reruns e sessões do Streamlit."""
+    
+    def __init__(self, size=DB_POOL_SIZE):
+        self._idle = queue.LifoQueue(maxsize=size)
+    
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return open_db_connection()
+    
+    def release(self, conn):
+        # Nunca devolve ao pool uma conexão com transação pendente
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@st.cache_resource
+def get_db_pool():
+    """Pool compartilhado pelo processo (o script é reexecutado a cada rerun, o pool não)."""
+    return ConnectionPool()
 
 @contextmanager
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+    pool = get_db_pool()
+    conn = pool.acquire()
     try:
         yield conn
     except Exception as e:
         conn.rollback()
+        if get_script_run_ctx(suppress_warning=True) is None:
+            # Threads de fundo (pool de jobs etc.): st.error não chega a nenhuma tela, então o erro sobe
+            logger.exception("Erro no banco de dados")
+            raise
         st.error(f"Erro no banco de dados: {e}")
     finally:
-        conn.close()
+        pool.release(conn)
 
+# Migrações do schema, aplicadas em ordem e registradas em PRAGMA user_version.
+# Cada item é uma lista de comandos SQL; para evoluir o schema, acrescente um novo item no final
+# (nunca edite uma migração já publicada).
+MIGRATIONS = [
+    # 1: schema original
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            plan TEXT DEFAULT 'free',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            mode TEXT DEFAULT 'primebud_1_5',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id)
+        )
+        ''',
+    ],
+    # 2: ON DELETE CASCADE (SQLite exige recriar a tabela) e índices das consultas quentes
+    [
+        '''
+        CREATE TABLE chats_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            mode TEXT DEFAULT 'primebud_1_5',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        ''',
+        'INSERT INTO chats_new (id, user_id, name, mode, created_at, updated_at) '
+        'SELECT id, user_id, name, mode, created_at, updated_at FROM chats',
+        'DROP TABLE chats',
+        'ALTER TABLE chats_new RENAME TO chats',
+        '''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+        )
+        ''',
+        'INSERT INTO messages_new (id, chat_id, role, content, created_at) '
+        'SELECT id, chat_id, role, content, created_at FROM messages',
+        'DROP TABLE messages',
+        'ALTER TABLE messages_new RENAME TO messages',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages (chat_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_chats_user_id_updated_at ON chats (user_id, updated_at)',
+    ],
+    # 3: resumo acumulado das mensagens que saíram da janela de contexto
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+        )
+        ''',
+    ],
+    # 4: cache de respostas para prompts idênticos (modos com "cache_responses")
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            mode TEXT NOT NULL,
+            response TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_response_cache_last_access ON response_cache (last_access)',
+    ],
+    # 5: busca de chats pelo título na barra lateral
+    [
+        'CREATE INDEX IF NOT EXISTS idx_chats_user_id_name ON chats (user_id, name COLLATE NOCASE)',
+    ],
+    # 6: busca full-text (FTS5) nas mensagens. Cada linha do índice leva o dono ("u<user_id>") para
+    # que a busca fique restrita ao usuário dentro do próprio MATCH. Mensagens novas entram pelos
+    # triggers; as que já existiam (id <= target_id) são indexadas aos poucos por backfill_fts_index.
+    [
+        '''
+        CREATE VIEW IF NOT EXISTS messages_fts_source AS
+        SELECT m.id, m.content, 'u' || c.user_id AS owner
+        FROM messages m JOIN chats c ON c.id = m.chat_id
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, owner, content='messages_fts_source', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS fts_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL
+        )
+        ''',
+        'INSERT OR IGNORE INTO fts_backfill (id, last_id, target_id) SELECT 1, 0, COALESCE(MAX(id), 0) FROM messages',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, owner)
+            SELECT new.id, new.content, 'u' || user_id FROM chats WHERE id = new.chat_id;
+        END
+        ''',
+        # O 'delete' do FTS5 só pode ser aplicado a linhas realmente indexadas, com os mesmos valores.
+        # Quando a mensagem some pelo ON DELETE CASCADE o chat já não existe: quem limpa é o trigger de chats.
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+        WHEN old.id > (SELECT target_id FROM fts_backfill) OR old.id <= (SELECT last_id FROM fts_backfill)
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, owner)
+            SELECT 'delete', old.id, old.content, 'u' || user_id FROM chats WHERE id = old.chat_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages
+        WHEN old.id > (SELECT target_id FROM fts_backfill) OR old.id <= (SELECT last_id FROM fts_backfill)
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, owner)
+            SELECT 'delete', old.id, old.content, 'u' || user_id FROM chats WHERE id = old.chat_id;
+            INSERT INTO messages_fts (rowid, content, owner)
+            SELECT new.id, new.content, 'u' || user_id FROM chats WHERE id = new.chat_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS chats_fts_bd BEFORE DELETE ON chats BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, owner)
+            SELECT 'delete', id, content, 'u' || old.user_id FROM messages
+            WHERE chat_id = old.id
+              AND (id > (SELECT target_id FROM fts_backfill) OR id <= (SELECT last_id FROM fts_backfill));
+        END
+        ''',
+    ],
+    # 7: fila de gerações em segundo plano (status: pending, running, done, error)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            mode TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            partial TEXT NOT NULL DEFAULT '',
+            error TEXT,
+            attempt INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_chat_id_status ON jobs (chat_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_user_id_status ON jobs (user_id, status)',
+    ],
+    # 8: histogramas acumulados (rótulos em JSON, contagens por bucket não cumulativas em JSON)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            buckets TEXT NOT NULL,
+            sum REAL NOT NULL,
+            count INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        )
+        ''',
+    ],
+    # 9: sessões persistentes (só o SHA-256 do token fica no banco) e configurações internas
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)',
+        'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    ],
+    # 10: vetores da busca semântica (TF-IDF com hashing, float16). seq cresce a cada vetor gravado,
+    # inclusive os do backfill, e é por ele que o índice em memória de cada usuário se atualiza
+    # (AUTOINCREMENT a partir da migração 12).
+    # Mensagens novas ganham vetor em insert_turns; as antigas (id <= target_id), no backfill.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS message_embeddings (
+            seq INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_message_embeddings_user_seq ON message_embeddings (user_id, seq)',
+        '''
+        CREATE TABLE IF NOT EXISTS embedding_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL
+        )
+        ''',
+        'INSERT OR IGNORE INTO embedding_backfill (id, last_id, target_id) SELECT 1, 0, COALESCE(MAX(id), 0) FROM messages',
+    ],
+    # 11: imagens anexadas (nomes no cache em disco, na ordem do anexo) e as de jobs ainda não concluídos
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS message_images (
+            message_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            PRIMARY KEY (message_id, position),
+            FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+        )
+        ''',
+        "ALTER TABLE jobs ADD COLUMN images TEXT NOT NULL DEFAULT '[]'",
+    ],
+    # 12: seq com AUTOINCREMENT. Sem ele o SQLite reaproveita o maior seq quando as últimas linhas são
+    # apagadas (ex.: exclusão do chat mais novo), e o índice em memória de outro processo, que só lê
+    # seq > last_seq, perderia os vetores gravados com esses seq.
+    [
+        '''
+        CREATE TABLE message_embeddings_new (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+        )
+        ''',
+        'INSERT INTO message_embeddings_new (seq, message_id, user_id, chat_id, vector) '
+        'SELECT seq, message_id, user_id, chat_id, vector FROM message_embeddings',
+        'DROP TABLE message_embeddings',
+        'ALTER TABLE message_embeddings_new RENAME TO message_embeddings',
+        'CREATE INDEX IF NOT EXISTS idx_message_embeddings_user_seq ON message_embeddings (user_id, seq)',
+    ],
+]
+
+@st.cache_resource
 def init_db():
-    with get_db_connection() as conn:
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                plan TEXT DEFAULT 'free',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                mode TEXT DEFAULT 'primebud_1_5',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES chats(id)
-            )
-        ''')
-        conn.commit()
+    """Aplica as migrações pendentes, de forma atômica, usando PRAGMA user_version como versão do schema.
+
+    Roda uma vez por processo: sem o cache, cada rerun abriria uma conexão e pegaria o lock de escrita.
+    """
+    # Conexão dedicada: foreign_keys precisa ficar OFF durante a recriação de tabelas
+    # e esse PRAGMA não tem efeito dentro de uma transação.
+    conn = open_db_connection()
+    conn.isolation_level = None
+    try:
+        conn.execute('PRAGMA foreign_keys=OFF')
+        # IMMEDIATE: outra sessão migrando ao mesmo tempo espera aqui e depois relê a versão
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(f'PRAGMA user_version = {number}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
 
 # --- Funções de Autenticação (DB) ---
+# Senhas: scrypt com salt aleatório, no formato "scrypt$n$r$p$salt$hash" (base64). Hashes antigos
+# (SHA-256 sem salt) e hashes com parâmetros desatualizados são refeitos no próximo login.
+# Custo medido com benchmarks/bench_kdf.py: ~65 ms e 16 MiB por hash com n=2**14, r=8.
+PASSWORD_SCRYPT_N = int(os.getenv("PRIMEBUD_SCRYPT_N", 2 ** 14)) # Custo (potência de 2); hashes com outro N são refeitos
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_SALT_BYTES = 16
+KDF_MAX_CONCURRENCY = 4   # Hashes simultâneos por processo (limita CPU e memória em rajadas de login)
+KDF_WAIT_TIMEOUT = 10     # Espera máxima (s) por uma vaga antes de recusar o login
+SESSION_TTL = 30 * 24 * 3600 # Validade (s) do login lembrado
+SESSION_COOKIE = "primebud_session"
+
+@st.cache_resource
+def get_kdf_semaphore():
+    return threading.BoundedSemaphore(KDF_MAX_CONCURRENCY)
+
+def scrypt_hash(password, salt, n, r, p):
+    if not get_kdf_semaphore().acquire(timeout=KDF_WAIT_TIMEOUT):
+        raise TimeoutError("Muitos logins ao mesmo tempo.")
+    try:
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+    finally:
+        get_kdf_semaphore().release()
+
 def hash_password(password):
-    # Revertido para hashlib
-    return hashlib.sha256(password.encode()).hexdigest()
+    salt = os.urandom(PASSWORD_SALT_BYTES)
+    derived = scrypt_hash(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return "$".join(["scrypt", str(PASSWORD_SCRYPT_N), str(PASSWORD_SCRYPT_R), str(PASSWORD_SCRYPT_P),
+                     base64.b64encode(salt).decode(), base64.b64encode(derived).decode()])
+
+def check_password(password, stored_hash):
+    """Compara em tempo constante. Retorna (senha correta, hash precisa ser refeito)."""
+    if stored_hash.startswith("scrypt$"):
+        _, n, r, p, salt, expected = stored_hash.split("$")
+        derived = scrypt_hash(password, base64.b64decode(salt), int(n), int(r), int(p))
+        ok = hmac.compare_digest(derived, base64.b64decode(expected))
+        return ok, ok and (int(n), int(r), int(p)) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    # Formato antigo: SHA-256 sem salt
+    ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored_hash)
+    return ok, ok
+
+# Usado quando o usuário não existe, para a resposta levar o mesmo tempo (não revela quais usuários existem)
+DUMMY_PASSWORD_HASH = "scrypt${}${}${}${}${}".format(
+    PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P,
+    base64.b64encode(bytes(PASSWORD_SALT_BYTES)).decode(), base64.b64encode(bytes(32)).decode())
 
 def create_user(username, password):
-    # Revertido para hashlib
     try:
+        password_hash = hash_password(password) # Fora do with: não segura uma conexão durante o KDF
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                      (username, hash_password(password)))
+                      (username, password_hash))
             conn.commit()
         return True, "Conta criada com sucesso!"
     except sqlite3.IntegrityError:
@@ -471,15 +969,103 @@ def create_user(username, password):
     except Exception as e:
         return False, f"Erro inesperado: {e}"
 
+@timed("primebud_db_seconds")
 def verify_user(username, password):
-    # Revertido para hashlib
+    """Retorna (id, username, plan) se a senha confere, senão None. Refaz hashes antigos na hora."""
+    row = None
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id, username, plan, password_hash FROM users WHERE username = ?', (username,))
+        row = c.fetchone()
+    # O KDF roda fora do with: a conexão volta ao pool enquanto o hash é calculado
+    ok, needs_rehash = check_password(password, row[3] if row else DUMMY_PASSWORD_HASH)
+    if not row or not ok:
+        return None
+    if needs_rehash:
+        new_hash = hash_password(password)
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?', (new_hash, row[0], row[3]))
+            conn.commit()
+    return row[:3]
+
+@st.cache_resource
+def get_session_secret():
+    """Chave HMAC que assina os tokens de sessão (PRIMEBUD_SESSION_SECRET ou gerada e guardada no banco)."""
+    secret = get_api_key("PRIMEBUD_SESSION_SECRET")
+    if secret:
+        return secret.encode()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('session_secret', ?)", (secrets.token_hex(32),))
+        conn.commit()
+        c.execute("SELECT value FROM settings WHERE key = 'session_secret'")
+        return c.fetchone()[0].encode()
+
+def sign_session_token(token):
+    return hmac.new(get_session_secret(), token.encode(), hashlib.sha256).hexdigest()[:32]
+
+def session_token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+@timed("primebud_db_seconds")
+def create_session(user_id):
+    """Abre uma sessão persistente e retorna o valor do cookie ("token.assinatura")."""
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+        c.execute('INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                  (session_token_hash(token), user_id, now, now + SESSION_TTL))
+        conn.commit()
+    return f"{token}.{sign_session_token(token)}"
+
+@timed("primebud_db_seconds")
+def get_session_user(cookie):
+    """Usuário (id, username, plan) de um cookie de sessão válido, sem rodar o KDF; None se inválido/expirado.
+
+    A assinatura é conferida antes de qualquer consulta, então cookies forjados nem chegam ao banco.
+    """
+    if not isinstance(cookie, str):
+        return None
+    token, _, signature = cookie.partition(".")
+    # Em bytes: compare_digest recusa (TypeError) strs com caracteres não ASCII, que um cookie forjado pode ter
+    if not token or not hmac.compare_digest(signature.encode(), sign_session_token(token).encode()):
+        return None
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT id, username, plan FROM users WHERE username = ? AND password_hash = ?',
-                    (username, hash_password(password)))
+        c.execute('''
+            SELECT u.id, u.username, u.plan FROM sessions s JOIN users u ON u.id = s.user_id
+            WHERE s.token_hash = ? AND s.expires_at > ?
+        ''', (session_token_hash(token), time.time()))
         return c.fetchone()
 
+def delete_session(cookie):
+    token = cookie.partition(".")[0] if isinstance(cookie, str) else ""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM sessions WHERE token_hash = ?', (session_token_hash(token),))
+        conn.commit()
+
+def session_cookie_script(value, max_age):
+    """JS que grava (ou apaga, com max_age=0) o cookie de sessão no navegador."""
+    return f"""<script>
+    document.cookie = "{SESSION_COOKIE}={value}; path=/; max-age={max_age}; SameSite=Strict"
+        + (location.protocol === "https:" ? "; Secure" : "");
+    </script>"""
+
+@timed("primebud_db_seconds")
+def get_user_plan(user_id):
+    """Plano do usuário (usado pelo limite de taxa fora da sessão, ex.: nos jobs)."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT plan FROM users WHERE id = ?', (user_id,))
+        row = c.fetchone()
+        return row[0] if row else None
+
 # --- Funções de Chat (DB) ---
+@timed("primebud_db_seconds")
 def create_chat(user_id, name, mode='primebud_1_5'):
     with get_db_connection() as conn:
         c = conn.cursor()
@@ -489,20 +1075,96 @@ def create_chat(user_id, name, mode='primebud_1_5'):
         conn.commit()
         return chat_id
 
-def get_user_chats(user_id):
+@timed("primebud_db_seconds")
+def get_user_chats(user_id, limit=-1, search=None):
+    """Chats do usuário, mais recentes primeiro. limit=-1 traz todos; search filtra pelo início do título."""
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT id, name, mode, created_at FROM chats WHERE user_id = ? ORDER BY updated_at DESC',
-                    (user_id,))
+        if search:
+            # Prefixo sem curingas iniciais: o LIKE (case-insensitive) usa o índice (user_id, name COLLATE NOCASE)
+            pattern = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            c.execute("SELECT id, name, mode, created_at FROM chats WHERE user_id = ? AND name LIKE ? ESCAPE '\\' "
+                      "ORDER BY updated_at DESC LIMIT ?", (user_id, pattern, limit))
+        else:
+            c.execute('SELECT id, name, mode, created_at FROM chats WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?',
+                        (user_id, limit))
         return c.fetchall()
 
+@timed("primebud_db_seconds")
+def count_user_chats(user_id):
+    """COUNT(*) coberto pelo índice (user_id, updated_at), sem trazer as linhas."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM chats WHERE user_id = ?', (user_id,))
+        return c.fetchone()[0]
+
+@timed("primebud_db_seconds")
 def get_chat_messages(chat_id):
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT role, content, created_at FROM messages WHERE chat_id = ? ORDER BY created_at',
+        c.execute('SELECT role, content, created_at FROM messages WHERE chat_id = ? ORDER BY id',
                     (chat_id,))
         return c.fetchall()
 
+EXPORT_BATCH_SIZE = 500  # Linhas por fetchmany na exportação
+
+def iter_chat_messages(chat_id, batch_size=EXPORT_BATCH_SIZE):
+    """Gera (role, content, created_at) do chat direto do cursor, em lotes, sem carregar o histórico inteiro."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute('SELECT role, content, created_at FROM messages WHERE chat_id = ? ORDER BY id', (chat_id,))
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            c.close() # Não deixa um SELECT pendente na conexão que volta ao pool
+
+def export_user_chats_zip(user_id, fmt):
+    """Exporta todos os chats do usuário num .zip, um arquivo por chat.
+
+    Cada chat é escrito direto do cursor para dentro do zip (compressão em streaming) e o zip fica
+    num arquivo temporário que vai para o disco quando cresce, então a memória usada não depende
+    do tamanho do histórico até a leitura final dos bytes.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as spool:
+        with zipfile.ZipFile(spool, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            used_names = set()
+            for chat_id, chat_name, _, _ in get_user_chats(user_id) or []:
+                file_name = export_file_name(chat_name, fmt)
+                if file_name in used_names:
+                    file_name = f"{chat_id}_{file_name}"
+                used_names.add(file_name)
+                with archive.open(file_name, 'w', force_zip64=True) as member:
+                    write_export(EXPORT_FORMATS[fmt][1](iter_chat_messages(chat_id), chat_name), member)
+        spool.seek(0)
+        return spool.read()
+
+@timed("primebud_db_seconds")
+def get_chat_messages_since(chat_id, last_id):
+    """Busca só as mensagens com id maior que o cursor (usa o índice (chat_id, id))."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id, role, content, created_at FROM messages WHERE chat_id = ? AND id > ? ORDER BY id',
+                    (chat_id, last_id))
+        return c.fetchall()
+
+@timed("primebud_db_seconds")
+def get_chat_messages_page(chat_id, before_id=None, limit=50):
+    """Página (keyset) das mensagens mais recentes anteriores a before_id, em ordem cronológica."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        if before_id is None:
+            c.execute('SELECT id, role, content, created_at FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?',
+                        (chat_id, limit))
+        else:
+            c.execute('SELECT id, role, content, created_at FROM messages WHERE chat_id = ? AND id < ? '
+                      'ORDER BY id DESC LIMIT ?', (chat_id, before_id, limit))
+        return c.fetchall()[::-1]
+
+@timed("primebud_db_seconds")
 def get_chat_info(chat_id):
     with get_db_connection() as conn:
         c = conn.cursor()
@@ -510,15 +1172,631 @@ def get_chat_info(chat_id):
         return c.fetchone()
 
 def save_message(chat_id, role, content):
-    # Garante que o role do Gemini ('model') seja salvo como 'assistant'
-    db_role = "assistant" if role == "model" else role
+    save_turn(chat_id, [(role, content)]) # Sem @timed: a escrita já é medida uma vez, em save_turn
+
+@timed("primebud_db_seconds")
+def get_message_images(message_ids):
+    """{message_id: [nomes no cache de imagens]} das mensagens que têm anexos."""
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)',
-                    (chat_id, db_role, content))
+        c.execute(f'''
+            SELECT message_id, file FROM message_images WHERE message_id IN ({",".join("?" * len(message_ids))})
+            ORDER BY message_id, position
+        ''', list(message_ids))
+        images = {}
+        for message_id, name in c.fetchall():
+            images.setdefault(message_id, []).append(name)
+        return images
+
+def attach_message_images(messages):
+    """Preenche msg['images'] das mensagens salvas que ainda não têm (uma consulta; fica guardado no dict)."""
+    missing = [msg for msg in messages if "images" not in msg and msg.get("id") is not None]
+    if missing:
+        found = get_message_images([msg["id"] for msg in missing]) or {}
+        for msg in missing:
+            msg["images"] = found.get(msg["id"], [])
+    return messages
+
+# --- Gravação de turnos ---
+WRITE_BEHIND_ENABLED = os.getenv("PRIMEBUD_WRITE_BEHIND") == "1" # Fila de escrita para implantações com muito tráfego
+WRITE_BEHIND_MAX_BATCH = 64     # Turnos por commit
+WRITE_BEHIND_TIMEOUT = 10       # Prazo (s) para a fila confirmar a gravação
+
+def insert_turns(c, turns):
+    """Insere turnos [(chat_id, [(role, content), ...])] na transação corrente do cursor.
+
+    Uma mensagem pode trazer as imagens anexadas: (role, content, [nomes no cache de imagens]).
+
+    Retorna, por turno, (maior id do chat antes do turno, ids das mensagens novas). O primeiro valor
+    permite ao chamador saber se alguém mais escreveu no chat desde a última leitura.
+    """
+    results = []
+    for chat_id, messages in turns:
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM messages WHERE chat_id = ?', (chat_id,))
+        previous_id = c.fetchone()[0]
+        c.execute('SELECT user_id FROM chats WHERE id = ?', (chat_id,))
+        owner = c.fetchone()
+        ids = []
+        for message in messages:
+            role, content = message[:2]
+            # Garante que o role do Gemini ('model') seja salvo como 'assistant'
+            db_role = "assistant" if role == "model" else role
+            c.execute('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)', (chat_id, db_role, content))
+            message_id = c.lastrowid
+            ids.append(message_id)
+            if owner:
+                # Índice semântico atualizado na mesma transação (vetor de ~0.1 ms por mensagem)
+                c.execute('INSERT INTO message_embeddings (message_id, user_id, chat_id, vector) VALUES (?, ?, ?, ?)',
+                          (message_id, owner[0], chat_id, embedding_blob(content)))
+            if len(message) > 2:
+                c.executemany('INSERT INTO message_images (message_id, position, file) VALUES (?, ?, ?)',
+                              [(message_id, position, name) for position, name in enumerate(message[2])])
         c.execute('UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (chat_id,))
+        results.append((previous_id, ids))
+    return results
+
+def write_turns(conn, turns):
+    """Grava turnos (ver insert_turns) numa única transação (um commit só)."""
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    results = insert_turns(c, turns)
+    conn.commit()
+    return results
+
+@timed("primebud_db_seconds")
+def save_turn(chat_id, messages):
+    """Grava as mensagens de um turno (ex.: pergunta e resposta) e o updated_at do chat numa transação."""
+    with get_db_connection() as conn:
+        return write_turns(conn, [(chat_id, messages)])[0]
+
+class TurnWriter:
+    """Fila de escrita (write-behind): uma thread grava os turnos de todas as sessões em lotes.
+
+    Com muitas sessões simultâneas, os turnos que chegam enquanto um lote está sendo gravado dividem
+    o commit seguinte em vez de disputarem o lock de escrita um a um (sem espera artificial: com
+    pouco tráfego cada turno é gravado na hora). submit() devolve um Future com o resultado de write_turns.
+    """
+    
+    def __init__(self, pool, max_batch=WRITE_BEHIND_MAX_BATCH):
+        self._pool = pool
+        self._queue = queue.Queue()
+        self.max_batch = max_batch
+        threading.Thread(target=self._run, name="primebud-turn-writer", daemon=True).start()
+    
+    def submit(self, chat_id, messages):
+        future = concurrent.futures.Future()
+        self._queue.put((chat_id, messages, future))
+        return future
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e: # Ex.: sem conexão no pool; a thread segue atendendo os próximos lotes
+                logger.exception("Falha ao gravar um lote de turnos")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+    
+    def _write(self, batch):
+        conn = self._pool.acquire()
+        try:
+            try:
+                results = write_turns(conn, [(chat_id, messages) for chat_id, messages, _ in batch])
+            except Exception: # sqlite3.Error, ou TypeError/ValueError de uma linha inválida
+                conn.rollback()
+            else:
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+                return
+            # Um turno inválido (ex.: chat excluído no meio do caminho) não derruba o lote: grava um a um
+            for chat_id, messages, future in batch:
+                try:
+                    future.set_result(write_turns(conn, [(chat_id, messages)])[0])
+                except Exception as e:
+                    conn.rollback()
+                    future.set_exception(e)
+        finally:
+            self._pool.release(conn)
+
+@st.cache_resource
+def get_turn_writer():
+    return TurnWriter(get_db_pool())
+
+def persist_turn(chat_id, messages):
+    """Grava o turno pela fila write-behind (se habilitada) ou direto. Retorna (id anterior, ids) ou None."""
+    if not WRITE_BEHIND_ENABLED:
+        return save_turn(chat_id, messages)
+    try:
+        # Espera a confirmação do lote (milissegundos): a janela da sessão precisa dos ids novos
+        return get_turn_writer().submit(chat_id, messages).result(timeout=WRITE_BEHIND_TIMEOUT)
+    except (sqlite3.Error, concurrent.futures.TimeoutError) as e:
+        st.error(f"Erro no banco de dados: {e}")
+        return None
+
+# --- Jobs de geração (DB) ---
+JOB_RETENTION = 24 * 3600  # Jobs concluídos são apagados depois disso (s)
+
+@timed("primebud_db_seconds")
+def create_job(chat_id, user_id, mode, prompt, images=()):
+    """Enfileira uma geração. Retorna o id do job ou None se o chat já tiver uma em andamento."""
+    now = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO jobs (chat_id, user_id, mode, prompt, images, created_at, updated_at)
+            SELECT ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE chat_id = ? AND status IN ('pending', 'running'))
+        ''', (chat_id, user_id, mode, prompt, json.dumps(list(images)), now, now, chat_id))
+        conn.commit()
+        return c.lastrowid if c.rowcount else None
+
+@timed("primebud_db_seconds")
+def claim_job(job_id):
+    """Marca o job como 'running' (só um worker consegue). Retorna (chat_id, user_id, mode, prompt, imagens, attempt) ou None.
+
+    O attempt identifica esta execução: se o job for devolvido à fila e pego por outro worker, as
+    gravações da execução antiga passam a ser ignoradas.
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE jobs SET status = 'running', attempt = attempt + 1, partial = '', updated_at = ?
+            WHERE id = ? AND status = 'pending'
+        ''', (time.time(), job_id))
+        conn.commit()
+        if not c.rowcount:
+            return None
+        c.execute('SELECT chat_id, user_id, mode, prompt, images, attempt FROM jobs WHERE id = ?', (job_id,))
+        chat_id, user_id, mode, prompt, images, attempt = c.fetchone()
+        return chat_id, user_id, mode, prompt, json.loads(images), attempt
+
+@timed("primebud_db_seconds")
+def update_job_partial(job_id, attempt, partial):
+    """Grava o texto parcial do job; o updated_at também serve de heartbeat do worker."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE jobs SET partial = ?, updated_at = ? WHERE id = ? AND attempt = ? AND status = 'running'",
+                  (partial, time.time(), job_id, attempt))
         conn.commit()
 
+@timed("primebud_db_seconds")
+def finish_job(job_id, attempt, chat_id, turn, error=None):
+    """Encerra o job e grava o turno no histórico na mesma transação (sem turno duplicado nem perdido).
+
+    Não grava nada se o job já não pertence a esta execução (devolvido à fila ou chat excluído).
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('''
+            UPDATE jobs SET status = ?, partial = '', error = ?, updated_at = ?
+            WHERE id = ? AND attempt = ? AND status = 'running'
+        ''', ('error' if error else 'done', error, time.time(), job_id, attempt))
+        if not c.rowcount:
+            conn.rollback()
+            return
+        insert_turns(c, [(chat_id, turn)])
+        conn.commit()
+
+def fail_job(job_id, attempt, error):
+    """Marca o job como erro sem gravar o turno (quando a própria gravação do turno falhou)."""
+    with get_db_connection() as conn:
+        conn.execute('''
+            UPDATE jobs SET status = 'error', partial = '', error = ?, updated_at = ?
+            WHERE id = ? AND attempt = ? AND status = 'running'
+        ''', (error, time.time(), job_id, attempt))
+        conn.commit()
+
+@timed("primebud_db_seconds")
+def get_job(job_id):
+    """Retorna (status, partial, error, updated_at) ou None (ex.: chat excluído)."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT status, partial, error, updated_at FROM jobs WHERE id = ?', (job_id,))
+        return c.fetchone()
+
+@timed("primebud_db_seconds")
+def get_active_job(chat_id):
+    """Retorna (job_id, prompt, imagens) da geração em andamento no chat, ou None."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, prompt, images FROM jobs WHERE chat_id = ? AND status IN ('pending', 'running')", (chat_id,))
+        row = c.fetchone()
+        return (row[0], row[1], json.loads(row[2])) if row else None
+
+@timed("primebud_db_seconds")
+def get_active_job_chats(user_id):
+    """Ids dos chats do usuário com geração em andamento."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT chat_id FROM jobs WHERE user_id = ? AND status IN ('pending', 'running')", (user_id,))
+        return {row[0] for row in c.fetchall()}
+
+def requeue_stale_jobs(stale_after, job_id=None):
+    """Devolve à fila jobs 'running' sem heartbeat há mais de stale_after s (worker morto). Retorna os ids pendentes.
+
+    Sem job_id, também apaga jobs concluídos antigos e considera todos os jobs do banco.
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        if job_id is not None:
+            c.execute("UPDATE jobs SET status = 'pending' WHERE id = ? AND status = 'running' AND updated_at < ?",
+                      (job_id, now - stale_after))
+            conn.commit()
+            return [job_id] if c.rowcount else []
+        c.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running' AND updated_at < ?", (now - stale_after,))
+        c.execute("DELETE FROM jobs WHERE status IN ('done', 'error') AND updated_at < ?", (now - JOB_RETENTION,))
+        conn.commit()
+        c.execute("SELECT id FROM jobs WHERE status = 'pending' ORDER BY id")
+        return [row[0] for row in c.fetchall()]
+
+@timed("primebud_db_seconds")
+def get_chat_summary(chat_id):
+    """Retorna (resumo, id da última mensagem coberta) ou None."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = ?', (chat_id,))
+        return c.fetchone()
+
+@timed("primebud_db_seconds")
+def save_chat_summary(chat_id, summary, last_message_id):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO chat_summaries (chat_id, summary, last_message_id) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary,
+                last_message_id = excluded.last_message_id, updated_at = CURRENT_TIMESTAMP
+        ''', (chat_id, summary, last_message_id))
+        conn.commit()
+
+# --- Cache de Respostas (DB) ---
+RESPONSE_CACHE_TTL = 24 * 3600       # segundos
+RESPONSE_CACHE_MAX_ENTRIES = 1000   # Acima disso, as menos acessadas recentemente saem (LRU)
+
+@timed("primebud_db_seconds")
+def get_cached_response(key):
+    """Retorna (texto, role) se a chave estiver no cache e dentro do TTL, atualizando o último acesso."""
+    now = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT response, role FROM response_cache WHERE key = ? AND created_at >= ?',
+                    (key, now - RESPONSE_CACHE_TTL))
+        row = c.fetchone()
+        if row:
+            c.execute('UPDATE response_cache SET last_access = ? WHERE key = ?', (now, key))
+            conn.commit()
+        return row
+
+@timed("primebud_db_seconds")
+def store_cached_response(key, mode, response, role):
+    """Grava a resposta e aplica o TTL e o limite de tamanho (remove as menos usadas)."""
+    now = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('INSERT OR REPLACE INTO response_cache (key, mode, response, role, created_at, last_access) '
+                  'VALUES (?, ?, ?, ?, ?, ?)', (key, mode, response, role, now, now))
+        c.execute('DELETE FROM response_cache WHERE created_at < ?', (now - RESPONSE_CACHE_TTL,))
+        c.execute('DELETE FROM response_cache WHERE key IN '
+                  '(SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+                    (RESPONSE_CACHE_MAX_ENTRIES,))
+        conn.commit()
+
+# --- Busca Full-Text (DB) ---
+FTS_BACKFILL_BATCH = 2000   # Mensagens antigas indexadas por transação
+FTS_BACKFILL_PAUSE = 0.05   # Pausa (s) entre lotes para não segurar o lock de escrita
+SEARCH_RESULTS_LIMIT = 20
+SEARCH_COMMON_TERM_DOCS = 20000  # Acima disso o termo é tratado como "stopword" na ordenação
+
+def backfill_fts_index_batch(conn, batch_size=FTS_BACKFILL_BATCH):
+    """Indexa um lote de mensagens anteriores à migração do FTS. Retorna False quando não há mais nada."""
+    with conn:
+        last_id, target_id = conn.execute('SELECT last_id, target_id FROM fts_backfill WHERE id = 1').fetchone()
+        if last_id >= target_id:
+            return False
+        rows = conn.execute('''
+            SELECT m.id, m.content, 'u' || c.user_id FROM messages m JOIN chats c ON c.id = m.chat_id
+            WHERE m.id > ? AND m.id <= ? ORDER BY m.id LIMIT ?
+        ''', (last_id, target_id, batch_size)).fetchall()
+        conn.executemany('INSERT INTO messages_fts (rowid, content, owner) VALUES (?, ?, ?)', rows)
+        new_last_id = rows[-1][0] if rows else target_id
+        conn.execute('UPDATE fts_backfill SET last_id = ? WHERE id = 1', (new_last_id,))
+        return new_last_id < target_id
+
+def backfill_fts_index():
+    """Indexa incrementalmente, em lotes curtos, as mensagens de bancos criados antes do FTS."""
+    conn = open_db_connection()
+    try:
+        while backfill_fts_index_batch(conn):
+            time.sleep(FTS_BACKFILL_PAUSE)
+    finally:
+        conn.close()
+
+@st.cache_resource
+def start_fts_backfill():
+    """Dispara o backfill do índice FTS uma vez por processo, em segundo plano."""
+    thread = threading.Thread(target=backfill_fts_index, name="primebud-fts-backfill", daemon=True)
+    thread.start()
+    return thread
+
+def parse_search_terms(text):
+    """Converte o texto digitado em frases FTS5 seguras.
+
+    Cada termo vai entre aspas (operadores do FTS5 digitados pelo usuário viram texto); um "*" no
+    fim do termo vira busca por prefixo.
+    """
+    terms = []
+    for term in text.split():
+        prefix = term.endswith('*')
+        term = term.rstrip('*')
+        if term:
+            terms.append('"' + term.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return terms
+
+def is_common_search_term(c, term):
+    """Indica se o termo aparece em mais de SEARCH_COMMON_TERM_DOCS mensagens (de todos os usuários).
+
+    O bm25 conta as ocorrências globais de cada termo a cada consulta, o que custa dezenas de ms para
+    termos presentes em quase todas as mensagens, e o IDF deles é praticamente zero. A sondagem
+    para no limite, então custa no máximo alguns ms.
+    """
+    c.execute('SELECT 1 FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?',
+              (f'content : {term}', SEARCH_COMMON_TERM_DOCS))
+    return c.fetchone() is not None
+
+@timed("primebud_db_seconds")
+def search_messages(user_id, text, limit=SEARCH_RESULTS_LIMIT):
+    """Busca nas mensagens do usuário. Retorna (message_id, chat_id, nome do chat, role, trecho).
+
+    O dono ("u<user_id>") faz parte do MATCH, então o FTS5 só percorre as mensagens do usuário, e o
+    join com messages/chats só toca os resultados finais. A relevância (bm25) usa só os termos
+    incomuns; os comuns viram filtro por mensagem e, se todos forem comuns, a ordem é das mais
+    recentes. O trecho vem com \\x02/\\x03 marcando os termos (escape o HTML antes de destacá-los).
+    """
+    terms = parse_search_terms(text)
+    if not terms:
+        return []
+    owner = f'owner : "u{int(user_id)}"'
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        common = [term for term in terms if is_common_search_term(c, term)]
+        rare = [term for term in terms if term not in common]
+        params = [f'{owner} AND content : ({" ".join(rare or common)})']
+        if not rare:
+            score, order, common_filter = '-rowid', 'rowid DESC', ''
+        else:
+            score, order, common_filter = 'rank', 'rank', ''
+            if common:
+                common_filter = '''AND EXISTS (
+                    SELECT 1 FROM messages_fts AS common WHERE common.messages_fts MATCH ? AND common.rowid = messages_fts.rowid
+                )'''
+                params.append(f'content : ({" ".join(common)})')
+        c.execute(f'''
+            SELECT m.id, m.chat_id, c.name, m.role, hits.snippet
+            FROM (
+                SELECT rowid, snippet(messages_fts, 0, char(2), char(3), '…', 16) AS snippet, {score} AS score
+                FROM messages_fts
+                WHERE messages_fts MATCH ? {common_filter}
+                ORDER BY {order}
+                LIMIT ?
+            ) AS hits
+            JOIN messages m ON m.id = hits.rowid
+            JOIN chats c ON c.id = m.chat_id
+            ORDER BY hits.score
+        ''', (*params, limit))
+        return c.fetchall()
+
+# --- Busca Semântica (DB) ---
+# Cada mensagem vira um vetor TF-IDF com hashing (SEMANTIC_DIM dimensões, sem modelo nem dependência
+# além do NumPy): termos -> crc32 -> coluna e sinal, peso 1 + log(tf), vetor normalizado. O IDF é
+# aplicado só na consulta, com as frequências do próprio usuário, então o índice cresce sem recálculo.
+# Em memória, cada usuário tem uma matriz float32 (SEMANTIC_DIM x mensagens) e a consulta só lê as
+# colunas dos seus termos: ~2 ms para 100 mil mensagens (benchmarks/bench_semantic.py).
+SEMANTIC_DIM = 256
+SEMANTIC_MAX_CHARS = 4000           # Só o começo de mensagens muito longas entra no vetor
+SEMANTIC_QUERY_TERMS = 32           # Dimensões mais pesadas da consulta usadas na busca
+SEMANTIC_INDEX_MAX_BYTES = 256 * 1024 * 1024 # Índices em memória de todos os usuários (LRU)
+SEMANTIC_BACKFILL_BATCH = 2000
+SEMANTIC_BACKFILL_PAUSE = 0.05
+SEMANTIC_TOKEN_PATTERN = re.compile(r"\w{2,}")
+
+def embed_text(text):
+    """Vetor TF-IDF com hashing (float32, norma 1; zeros se o texto não tem termos)."""
+    import numpy as np
+
+    vector = np.zeros(SEMANTIC_DIM, dtype=np.float32)
+    counts = Counter(SEMANTIC_TOKEN_PATTERN.findall(text[:SEMANTIC_MAX_CHARS].lower()))
+    if not counts:
+        return vector
+    hashes = np.fromiter((zlib.crc32(term.encode()) for term in counts), dtype=np.uint32, count=len(counts))
+    weights = np.fromiter((1 + math.log(n) for n in counts.values()), dtype=np.float32, count=len(counts))
+    signs = np.where(hashes & 0x80000000, -1, 1).astype(np.float32)
+    np.add.at(vector, hashes % SEMANTIC_DIM, signs * weights)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def embedding_blob(text):
+    import numpy as np
+
+    return embed_text(text).astype(np.float16).tobytes()
+
+class SemanticIndex:
+    """Vetores de um usuário em colunas (crescimento amortizado), com a frequência de cada dimensão."""
+    
+    def __init__(self):
+        import numpy as np
+
+        self.lock = threading.Lock()
+        self.vectors = np.zeros((SEMANTIC_DIM, 0), dtype=np.float32)
+        self.message_ids = np.zeros(0, dtype=np.int64)
+        self.doc_freq = np.zeros(SEMANTIC_DIM, dtype=np.float32)
+        self.size = 0
+        self.last_seq = 0
+    
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + self.message_ids.nbytes
+    
+    def append(self, rows):
+        """Acrescenta linhas (seq, message_id, vetor float16 em bytes) vindas do banco."""
+        import numpy as np
+
+        block = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float16)
+        block = block.reshape(len(rows), SEMANTIC_DIM).T.astype(np.float32)
+        needed = self.size + len(rows)
+        if needed > self.vectors.shape[1]:
+            capacity = max(needed, 2 * self.vectors.shape[1], 256)
+            vectors = np.zeros((SEMANTIC_DIM, capacity), dtype=np.float32)
+            vectors[:, :self.size] = self.vectors[:, :self.size]
+            message_ids = np.zeros(capacity, dtype=np.int64)
+            message_ids[:self.size] = self.message_ids[:self.size]
+            self.vectors, self.message_ids = vectors, message_ids
+        self.vectors[:, self.size:needed] = block
+        self.message_ids[self.size:needed] = [row[1] for row in rows]
+        self.doc_freq += np.count_nonzero(block, axis=1)
+        self.size = needed
+        self.last_seq = rows[-1][0]
+    
+    def search(self, query, limit):
+        """[(message_id, similaridade)] das mensagens mais parecidas com o vetor da consulta."""
+        import numpy as np
+
+        if not self.size or not query.any():
+            return []
+        idf = np.log((1 + self.size) / (1 + self.doc_freq)) + 1
+        weights = query * idf
+        terms = np.flatnonzero(weights)
+        if len(terms) > SEMANTIC_QUERY_TERMS:
+            terms = terms[np.argpartition(np.abs(weights[terms]), -SEMANTIC_QUERY_TERMS)[-SEMANTIC_QUERY_TERMS:]]
+        weights = weights[terms] / np.linalg.norm(weights[terms])
+        scores = weights @ self.vectors[terms, :self.size]
+        limit = min(limit, self.size)
+        top = np.argpartition(scores, -limit)[-limit:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(self.message_ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+class SemanticIndexCache:
+    """LRU dos índices por usuário, limitado em bytes."""
+    
+    def __init__(self, max_bytes=SEMANTIC_INDEX_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()
+        self.max_bytes = max_bytes
+    
+    def get(self, user_id):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                index = self._indexes[user_id] = SemanticIndex()
+            self._indexes.move_to_end(user_id)
+            return index
+    
+    def discard(self, user_id):
+        with self._lock:
+            self._indexes.pop(user_id, None)
+    
+    def trim(self):
+        with self._lock:
+            total = sum(index.nbytes for index in self._indexes.values())
+            while len(self._indexes) > 1 and total > self.max_bytes:
+                _, evicted = self._indexes.popitem(last=False)
+                total -= evicted.nbytes
+
+@st.cache_resource
+def get_semantic_indexes():
+    return SemanticIndexCache()
+
+def load_semantic_index(user_id):
+    """Índice do usuário em memória, trazendo do banco só os vetores gravados desde a última leitura."""
+    indexes = get_semantic_indexes()
+    index = indexes.get(user_id)
+    with index.lock:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT seq, message_id, vector FROM message_embeddings WHERE user_id = ? AND seq > ? ORDER BY seq',
+                      (user_id, index.last_seq))
+            rows = c.fetchall()
+        if rows:
+            index.append(rows)
+    if rows:
+        indexes.trim()
+    return index
+
+@timed("primebud_db_seconds")
+def search_similar_messages(chat_id, text, limit, exclude_ids=()):
+    """Mensagens do dono do chat (em qualquer chat dele) mais parecidas com o texto.
+
+    Retorna [{'id', 'chat_id', 'role', 'content', 'score'}] por similaridade decrescente, sem as de exclude_ids.
+    """
+    query = embed_text(text)
+    if not query.any():
+        return []
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT user_id FROM chats WHERE id = ?', (chat_id,))
+        owner = c.fetchone()
+    if not owner:
+        return []
+    index = load_semantic_index(owner[0])
+    with index.lock:
+        hits = index.search(query, limit + len(exclude_ids))
+    scores = {message_id: score for message_id, score in hits if message_id not in exclude_ids}
+    if not scores:
+        return []
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT id, chat_id, role, content FROM messages WHERE id IN ({",".join("?" * len(scores))})',
+                  list(scores))
+        rows = c.fetchall()
+    found = [{'id': msg_id, 'chat_id': msg_chat_id, 'role': role, 'content': content, 'score': scores[msg_id]}
+             for msg_id, msg_chat_id, role, content in rows]
+    found.sort(key=lambda msg: msg['score'], reverse=True)
+    return found[:limit]
+
+def backfill_embeddings_batch(conn, batch_size=SEMANTIC_BACKFILL_BATCH):
+    """Gera os vetores de um lote de mensagens anteriores à busca semântica. Retorna False quando acabou."""
+    last_id, target_id = conn.execute('SELECT last_id, target_id FROM embedding_backfill WHERE id = 1').fetchone()
+    if last_id >= target_id:
+        return False
+    rows = conn.execute('''
+        SELECT m.id, c.user_id, m.chat_id, m.content FROM messages m JOIN chats c ON c.id = m.chat_id
+        WHERE m.id > ? AND m.id <= ? ORDER BY m.id LIMIT ?
+    ''', (last_id, target_id, batch_size)).fetchall()
+    # Os vetores são calculados fora da transação (não seguram o lock de escrita)
+    vectors = [(msg_id, user_id, chat_id, embedding_blob(content)) for msg_id, user_id, chat_id, content in rows]
+    with conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO message_embeddings (message_id, user_id, chat_id, vector)
+            SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE id = ?)
+        ''', [(*row, row[0]) for row in vectors])
+        new_last_id = rows[-1][0] if rows else target_id
+        conn.execute('UPDATE embedding_backfill SET last_id = ? WHERE id = 1', (new_last_id,))
+    return new_last_id < target_id
+
+def backfill_embeddings():
+    """Gera, em lotes curtos, os vetores das mensagens de bancos criados antes da busca semântica."""
+    conn = open_db_connection()
+    try:
+        while backfill_embeddings_batch(conn):
+            time.sleep(SEMANTIC_BACKFILL_PAUSE)
+    finally:
+        conn.close()
+
+@st.cache_resource
+def start_embedding_backfill():
+    """Dispara o backfill dos vetores uma vez por processo, em segundo plano."""
+    thread = threading.Thread(target=backfill_embeddings, name="primebud-embedding-backfill", daemon=True)
+    thread.start()
+    return thread
+
+@timed("primebud_db_seconds")
 def update_chat_mode(chat_id, mode):
     with get_db_connection() as conn:
         c = conn.cursor()
@@ -526,152 +1804,1493 @@ def update_chat_mode(chat_id, mode):
                     (mode, chat_id))
         conn.commit()
 
+@timed("primebud_db_seconds")
 def delete_chat(chat_id):
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        c.execute('SELECT user_id FROM chats WHERE id = ?', (chat_id,))
+        owner = c.fetchone()
+        # As mensagens (e os vetores delas) saem junto via ON DELETE CASCADE
         c.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
         conn.commit()
+    if owner:
+        get_semantic_indexes().discard(owner[0]) # O índice em memória não sabe remover linhas: é recarregado
+
+# --- Métricas (DB) ---
+def flush_metrics():
+    """Soma na tabela metrics os histogramas acumulados em memória desde a última descarga."""
+    series = METRICS_REGISTRY.drain()
+    if not series:
+        return
+    now = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        for (name, labels), (counts, total, count) in series.items():
+            labels_json = json.dumps(dict(labels), ensure_ascii=False, sort_keys=True)
+            c.execute('SELECT buckets, sum, count FROM metrics WHERE name = ? AND labels = ?', (name, labels_json))
+            row = c.fetchone()
+            if row:
+                counts = [a + b for a, b in zip(json.loads(row[0]), counts)]
+                total += row[1]
+                count += row[2]
+            c.execute('''
+                INSERT OR REPLACE INTO metrics (name, labels, buckets, sum, count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (name, labels_json, json.dumps(counts), total, count, now))
+        conn.commit()
+
+def load_metrics():
+    """Descarrega o que está em memória e retorna [(nome, rótulos JSON, contagens por bucket, soma, total)]."""
+    flush_metrics()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT name, labels, buckets, sum, count FROM metrics ORDER BY name, labels')
+        return [(name, labels, json.loads(buckets), total, count) for name, labels, buckets, total, count in c.fetchall()]
+    return []
+
+def export_prometheus_metrics():
+    """Métricas acumuladas no formato texto do Prometheus (também gravadas em PRIMEBUD_METRICS_FILE)."""
+    text = format_prometheus_metrics(load_metrics())
+    if METRICS_FILE:
+        # Troca atômica: o textfile collector nunca lê um arquivo pela metade
+        temp_path = f"{METRICS_FILE}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(text)
+        os.replace(temp_path, METRICS_FILE)
+    return text
+
+def run_metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            export_prometheus_metrics() if METRICS_FILE else flush_metrics()
+        except Exception: # Métrica perdida não pode derrubar a thread
+            pass
+
+@st.cache_resource
+def start_metrics_flusher():
+    """Dispara a descarga periódica das métricas uma vez por processo, em segundo plano."""
+    thread = threading.Thread(target=run_metrics_flusher, name="primebud-metrics", daemon=True)
+    thread.start()
+    return thread
+
+# --- Cache de Mensagens da Sessão ---
+# Cada chat guarda na sessão só uma janela com as mensagens mais recentes: a primeira carga traz
+# CHAT_PAGE_SIZE mensagens, os reruns buscam apenas as novas (id > last_id) e as antigas só vêm
+# sob demanda (botão "carregar anteriores" ou quando o orçamento de contexto precisa delas).
+CHAT_PAGE_SIZE = 50
+CHATS_PAGE_SIZE = 30 # Chats por página na barra lateral
+
+def get_message_window(chat_id):
+    """Janela de mensagens do chat no cache da sessão (carrega a página mais recente na primeira vez)."""
+    cache = st.session_state.message_cache.get(chat_id)
+    if cache is None:
+        rows = get_chat_messages_page(chat_id, limit=CHAT_PAGE_SIZE) or []
+        cache = {
+            'messages': [{"id": msg_id, "role": role, "content": content} for msg_id, role, content, _ in rows],
+            'last_id': rows[-1][0] if rows else 0,
+            'has_more': len(rows) == CHAT_PAGE_SIZE,
+        }
+        st.session_state.message_cache[chat_id] = cache
+    return cache
+
+def load_chat_messages(chat_id):
+    """Retorna a janela do chat a partir do cache da sessão, buscando no banco só as mensagens novas."""
+    cache = get_message_window(chat_id)
+    for msg_id, role, content, _ in get_chat_messages_since(chat_id, cache['last_id']) or []:
+        cache['messages'].append({"id": msg_id, "role": role, "content": content})
+        cache['last_id'] = msg_id
+    return cache['messages']
+
+def append_saved_turn(chat_id, saved, messages):
+    """Acrescenta à janela um turno recém-gravado (saved = retorno de persist_turn) sem reler o banco.
+
+    Se outra sessão escreveu no chat desde a última leitura, cai na leitura incremental.
+    """
+    cache = get_message_window(chat_id)
+    if saved is None or saved[0] != cache['last_id']:
+        return load_chat_messages(chat_id)
+    for msg_id, message in zip(saved[1], messages):
+        role, content = message[:2]
+        cache['messages'].append({"id": msg_id, "role": "assistant" if role == "model" else role, "content": content,
+                                  "images": list(message[2]) if len(message) > 2 else []})
+        cache['last_id'] = msg_id
+    return cache['messages']
+
+def load_older_chat_messages(chat_id):
+    """Acrescenta ao início da janela a página anterior (keyset por id). Retorna quantas vieram."""
+    cache = get_message_window(chat_id)
+    if not cache['has_more'] or not cache['messages']:
+        return 0
+    rows = get_chat_messages_page(chat_id, before_id=cache['messages'][0]['id'], limit=CHAT_PAGE_SIZE) or []
+    cache['messages'][:0] = [{"id": msg_id, "role": role, "content": content} for msg_id, role, content, _ in rows]
+    cache['has_more'] = len(rows) == CHAT_PAGE_SIZE
+    return len(rows)
+
+def load_context_messages(chat_id, mode):
+    """Janela do chat estendida até cobrir o orçamento de contexto do modo (ou até o resumo persistido).
+
+    A leitura fica limitada ao orçamento, não ao tamanho do chat. Em chats antigos, anteriores ao
+    resumo, o que estiver além do orçamento simplesmente fica fora do contexto.
+    """
+    messages = load_chat_messages(chat_id)
+    cache = get_message_window(chat_id)
+    budget = MODES_CONFIG[mode]["context_tokens"]
+    covered_id = (get_chat_summary(chat_id) or (None, 0))[1]
+    while cache['has_more'] and messages and messages[0]['id'] > covered_id + 1:
+        pending_tokens = sum(message_tokens(msg) for msg in messages if msg['id'] > covered_id)
+        if pending_tokens > budget or not load_older_chat_messages(chat_id):
+            break
+    return cache['messages']
+
+def forget_chat_messages(chat_id):
+    """Descarta o cache de mensagens de um chat (ex.: chat excluído)."""
+    st.session_state.message_cache.pop(chat_id, None)
+    st.session_state.visible_messages.pop(chat_id, None)
 
 # 6. Funções de Cliente de API (REVERTIDAS)
 
-def get_groq_response(messages, config):
-    """Chama a API Groq (Llama 3).""" 
-    try:
-        api_key = os.getenv("GROQ_API_KEY") or st.secrets.get("GROQ_API_KEY")
-        if not api_key:
-            return "❌ Erro: GROQ_API_KEY não configurada."
-        
-        client = Groq(api_key=api_key)
-        
-        # Groq precisa de 'system' no início
-        full_messages = [
-            {"role": "system", "content": config["system_prompt"]}
-        ] + messages
-        
-        response = client.chat.completions.create(
-            model=config["model"],
-            messages=full_messages,
-            temperature=config["temperature"],
-            max_tokens=config["max_tokens"],
-        )
-        
-        return response.choices[0].message.content, "assistant" # Retorna role
-    except Exception as e:
-        st.error(f"Erro ao contatar a API Groq: {e}")
-        return f"❌ Erro ao processar: {str(e)}", "assistant"
+# Intervalo mínimo (s) entre redesenhos da resposta em streaming
+STREAM_RENDER_INTERVAL = 0.05
 
-# FUNÇÃO GEMINI REVERTIDA PARA O MODO SIMPLES (SEM TOOLS)
-def get_gemini_response(messages, config):
-    """Chama a API Gemini (REVERTIDA PARA MODO BÁSICO)."""
-    try:
-        api_key = os.getenv("GEMINI_API_KEY") or st.secrets.get("GEMINI_API_KEY")
-        if not api_key:
-            return "❌ Erro: GEMINI_API_KEY não configurada."
-        
-        genai.configure(api_key=api_key)
-        
-        # Formatar mensagens para o Gemini: 'assistant' -> 'model'
-        gemini_messages_formatted = []
-        for msg in messages:
-            role = "model" if msg["role"] == "assistant" else msg["role"]
-            gemini_messages_formatted.append({"role": role, "parts": [{"text": msg["content"]}]})
+# --- Resiliência (prazos, retries e circuit breaker) ---
+PROVIDER_TIMEOUTS = {"groq": 30, "gemini": 60} # Prazo (s) de cada tentativa, por provedor
+DEFAULT_PROVIDER_TIMEOUT = 30
+REQUEST_DEADLINE = 90          # Prazo total (s) de uma requisição; só começa uma tentativa que caiba inteira nele
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5         # Backoff exponencial com jitter: até 0.5s, 1s, 2s... (limitado)
+RETRY_MAX_DELAY = 8
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+CIRCUIT_FAILURE_THRESHOLD = 5  # Requisições seguidas que esgotaram as tentativas e abrem o circuito
+CIRCUIT_RESET_TIMEOUT = 30     # Tempo (s) com o circuito aberto antes de deixar uma tentativa passar
+# Modo reserva quando o provedor do modo escolhido falha ou está com o circuito aberto
+FALLBACK_MODES = {"gemini": "primebud_1_5", "groq": "primebud_2_0"}
+
+@st.cache_resource
+def get_provider_error_class():
+    """A classe ProviderError, uma só por processo.
+
+    O Streamlit reexecuta o script num módulo novo a cada rerun, redefinindo as classes. Objetos
+    compartilhados (ex.: o RateLimiter) levantariam a classe do rerun em que foram criados, e o
+    `except ProviderError` dos reruns seguintes não a pegaria.
+    """
+    class ProviderError(Exception):
+        """Falha de um provedor de LLM (mensagem pronta para exibir). Nunca vai para o histórico."""
         
-        # Otimização: remove mensagens consecutivas da mesma role
-        cleaned_messages = []
-        if gemini_messages_formatted:
-            cleaned_messages.append(gemini_messages_formatted[0])
-            for i in range(1, len(gemini_messages_formatted)):
-                if gemini_messages_formatted[i]["role"] != cleaned_messages[-1]["role"]:
-                    cleaned_messages.append(gemini_messages_formatted[i])
-                else:
-                    # Se for a mesma role, concatena o conteúdo (caso raro)
-                    cleaned_messages[-1]["parts"][0]["text"] += "\n" + gemini_messages_formatted[i]["parts"][0]["text"]
+        def __init__(self, message, retryable=False, rate_limited=False):
+            super().__init__(message)
+            self.retryable = retryable
+            self.rate_limited = rate_limited # Cota do próprio usuário esgotada: não adianta cair para outro modo
+    
+    return ProviderError
+
+ProviderError = get_provider_error_class()
+
+class CircuitBreaker:
+    """Abre após falhas seguidas de disponibilidade e falha rápido até CIRCUIT_RESET_TIMEOUT."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+    
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT:
+                # Half-open: deixa esta tentativa passar e reinicia o prazo para as demais
+                self.opened_at = time.monotonic()
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                self.opened_at = time.monotonic()
+
+@st.cache_resource
+def get_circuit_breakers():
+    """Circuit breakers por provedor, compartilhados por todas as sessões do processo."""
+    return {}
 
-        # Adiciona o system prompt no início se o primeiro for 'user' (melhor prática para chat)
-        system_content = {"role": "system", "parts": [{"text": config["system_prompt"]}]}
-        if not cleaned_messages or cleaned_messages[0]["role"] != "system":
-             cleaned_messages.insert(0, system_content)
+def get_circuit_breaker(provider):
+    return get_circuit_breakers().setdefault(provider, CircuitBreaker())
 
-        # Remove o system prompt se ele estiver duplicado ou fora do lugar esperado (Gemini)
-        final_messages = [msg for msg in cleaned_messages if msg.get("role") != "system"]
+# --- Limite de Taxa (token bucket) ---
+# Cada usuário (convidados inclusive) tem um balde de requisições/min e outro de tokens/min, conforme
+# o plano, e cada provedor tem os seus com a cota da conta, compartilhada por todos. Quem não tem
+# saldo não recebe erro: entra numa fila justa (rodízio entre usuários, FIFO dentro de cada usuário).
+PLAN_RATE_LIMITS = { # plano -> (requisições/min, tokens/min) por usuário
+    "free": (10, 60000),
+    "pro": (30, 240000),
+}
+PROVIDER_RATE_LIMITS = {"groq": (30, 120000), "gemini": (60, 1000000)} # Cota da conta por provedor
+USER_RATE_LIMIT_BURST = 20 # Rajada máxima (s de cota) de um usuário, para ninguém esvaziar a cota do provedor sozinho
+RATE_LIMIT_MAX_WAIT = 30   # Espera máxima (s) na fila antes de desistir
+RATE_LIMIT_POLL = 1.0      # Quem está atrás na fila reavalia a vez pelo menos nesse intervalo (s)
+RATE_LIMIT_MAX_BUCKETS = 10000 # Acima disso, baldes cheios (usuários ociosos) são descartados
+
+class TokenBucket:
+    """Balde que enche continuamente (per_minute por minuto) e é esvaziado a cada requisição.
+
+    Por padrão cabe um minuto de cota; burst_seconds limita a rajada a menos que isso.
+    """
+    
+    def __init__(self, per_minute, burst_seconds=60):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+    
+    def wait_time(self, amount, now):
+        """Segundos até caber amount (pedidos maiores que o balde só esperam ele encher)."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+    
+    def take(self, amount):
+        self.level -= amount # Pode ficar negativo: o excesso é pago com espera nos próximos pedidos
 
+class RateLimiter:
+    """Baldes por usuário e por provedor com fila justa para quem estoura."""
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._queues = OrderedDict() # user_key -> deque de pedidos; a ordem das chaves é o rodízio
+    
+    def _buckets_for(self, key, limits, burst_seconds=60):
+        if key not in self._buckets:
+            self._buckets[key] = (TokenBucket(limits[0], burst_seconds), TokenBucket(limits[1], burst_seconds))
+        return self._buckets[key]
+    
+    def _prune(self, now):
+        for key, buckets in list(self._buckets.items()):
+            if key[0] == "user" and all(bucket.wait_time(bucket.capacity, now) == 0 for bucket in buckets):
+                del self._buckets[key]
+    
+    @staticmethod
+    def _user_wait(request, now):
+        """Espera (s) pela cota do próprio usuário; 0 para pedidos sem usuário (só a cota do provedor)."""
+        _, user_buckets, _, tokens = request
+        if user_buckets is None:
+            return 0
+        return max(user_buckets[0].wait_time(1, now), user_buckets[1].wait_time(tokens, now))
+    
+    def _wait_time(self, request, now):
+        """Espera (s) até o pedido poder passar, ou None se ele depende de outro pedido passar antes."""
+        user_key, _, provider_buckets, tokens = request
+        if self._queues[user_key][0] is not request:
+            return None
+        wait = self._user_wait(request, now)
+        if wait or provider_buckets is None:
+            return wait
+        # O saldo do provedor vai primeiro para quem está antes no rodízio e já tem saldo próprio
+        for other_key, other_queue in self._queues.items():
+            if other_key == user_key:
+                break
+            head = other_queue[0]
+            if head[2] is provider_buckets and self._user_wait(head, now) == 0:
+                return None
+        return max(provider_buckets[0].wait_time(1, now), provider_buckets[1].wait_time(tokens, now))
+    
+    def acquire(self, user_key, plan, provider, tokens, timeout=RATE_LIMIT_MAX_WAIT):
+        """Bloqueia até o usuário e o provedor terem saldo e desconta o pedido. Retorna a espera (s).
 
-        model = genai.GenerativeModel(
-            model_name=config["model"],
-            #system_instruction=config["system_prompt"], # Movido para generate_content implicitamente pelo contexto
-            generation_config=genai.GenerationConfig(
-                temperature=config["temperature"],
-                max_output_tokens=config["max_tokens"]
+        Sem user_key (ex.: resumos) o pedido só conta na cota do provedor. Levanta ProviderError se a
+        vez não chegar em timeout segundos, com rate_limited=True quando foi a cota do próprio usuário
+        que acabou (outro modo não resolveria).
+        """
+        start = time.monotonic()
+        with self._cond:
+            provider_limits = PROVIDER_RATE_LIMITS.get(provider)
+            user_buckets = None
+            if user_key is not None:
+                user_limits = PLAN_RATE_LIMITS.get(plan, PLAN_RATE_LIMITS["free"])
+                user_buckets = self._buckets_for(("user", user_key, plan), user_limits, USER_RATE_LIMIT_BURST)
+            request = (
+                user_key,
+                user_buckets,
+                self._buckets_for(("provider", provider), provider_limits) if provider_limits else None,
+                tokens,
             )
+            self._queues.setdefault(user_key, deque()).append(request)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._wait_time(request, now)
+                    if wait == 0:
+                        break
+                    if now - start >= timeout:
+                        # Atrás de outro pedido do mesmo usuário ou sem saldo próprio: a cota é do usuário
+                        rate_limited = user_buckets is not None and (
+                            self._queues[user_key][0] is not request or self._user_wait(request, now) > 0)
+                        raise ProviderError("Muitas solicitações no momento. Aguarde alguns segundos e tente de novo.",
+                                            rate_limited=rate_limited)
+                    self._cond.wait(min(RATE_LIMIT_POLL if wait is None else wait, start + timeout - now))
+                for buckets in (request[1], request[2]):
+                    if buckets:
+                        buckets[0].take(1)
+                        buckets[1].take(tokens)
+            finally:
+                user_queue = self._queues[user_key]
+                user_queue.remove(request)
+                if user_queue:
+                    self._queues.move_to_end(user_key) # Próximo pedido deste usuário vai para o fim do rodízio
+                else:
+                    del self._queues[user_key]
+                if len(self._buckets) > RATE_LIMIT_MAX_BUCKETS:
+                    self._prune(time.monotonic())
+                self._cond.notify_all()
+        return time.monotonic() - start
+
+@st.cache_resource
+def get_rate_limiter():
+    """Limitador compartilhado por todas as sessões do processo."""
+    return RateLimiter()
+
+def acquire_rate_limit(user, config, messages):
+    """Espera a vez na fila do limite de taxa antes de chamar o provedor (sem user, só a cota do provedor).
+
+    Os tokens reservados são os do prompt mais o max_tokens da resposta, como os provedores contam.
+    """
+    tokens = (estimate_tokens(config["system_prompt"]) + sum(message_tokens(msg) for msg in messages)
+              + config["max_tokens"])
+    user_key, plan = (user['id'], user.get('plan')) if user else (None, None)
+    provider = config.get("api_provider", "groq")
+    wait = get_rate_limiter().acquire(user_key, plan, provider, tokens)
+    observe("primebud_rate_limit_wait_seconds", wait, provider=provider)
+    return wait
+
+def error_status(e):
+    """Status HTTP de uma exceção da Groq (status_code) ou do Google API Core (code)."""
+    status = getattr(e, "status_code", None)
+    if status is None and isinstance(getattr(e, "code", None), int):
+        status = e.code
+    return status
+
+def is_retryable(e):
+    """Timeouts, falhas de conexão, 429 e 5xx valem nova tentativa; o resto (ex.: chave inválida) não."""
+    if isinstance(e, ProviderError):
+        return e.retryable
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    httpx = sys.modules.get("httpx") # Sem o httpx carregado (nenhum cliente criado), a exceção não veio dele
+    if httpx is not None and isinstance(e, httpx.TransportError):
+        return True
+    groq = sys.modules.get("groq") # Sem o SDK carregado, a exceção não veio da Groq
+    if groq is not None and isinstance(e, groq.APIConnectionError):
+        return True
+    return error_status(e) in RETRYABLE_STATUS
+
+def retry_delay(attempt, e):
+    """Backoff exponencial com jitter total, respeitando Retry-After quando o provedor envia."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        delay = max(delay, float(headers.get("retry-after", 0)))
+    except ValueError:
+        pass
+    return min(delay, RETRY_MAX_DELAY)
+
+def describe_provider_error(provider, e):
+    if isinstance(e, ProviderError):
+        return str(e)
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        timeout = PROVIDER_TIMEOUTS.get(provider, DEFAULT_PROVIDER_TIMEOUT)
+        return f"A API {provider.capitalize()} não respondeu em {timeout}s."
+    if provider == "gemini":
+        return format_gemini_error(e)
+    return f"Erro ao contatar a API {provider.capitalize()}: {e}"
+
+def circuit_open_error(provider):
+    return ProviderError(f"A API {provider.capitalize()} está instável; novas tentativas em até {CIRCUIT_RESET_TIMEOUT}s.")
+
+def can_retry(provider, delay, deadline):
+    """Nova tentativa só se a espera e uma tentativa inteira (PROVIDER_TIMEOUTS) couberem no prazo total."""
+    timeout = PROVIDER_TIMEOUTS.get(provider, DEFAULT_PROVIDER_TIMEOUT)
+    return time.monotonic() + delay + timeout <= deadline
+
+def call_with_retries(provider, request):
+    """Executa request() com retries, prazo total e circuit breaker. Levanta ProviderError."""
+    breaker = get_circuit_breaker(provider)
+    deadline = time.monotonic() + REQUEST_DEADLINE
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        if not breaker.allow():
+            raise circuit_open_error(provider)
+        try:
+            result = request()
+        except Exception as e:
+            retryable = is_retryable(e)
+            delay = retry_delay(attempt, e)
+            if not retryable or attempt == RETRY_MAX_ATTEMPTS - 1 or not can_retry(provider, delay, deadline):
+                if retryable: # Só falhas de disponibilidade contam, uma vez por requisição (não por tentativa)
+                    breaker.record_failure()
+                raise ProviderError(describe_provider_error(provider, e)) from e
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+def stream_with_retries(provider, open_stream):
+    """Versão em streaming de call_with_retries: só tenta de novo se nenhum pedaço foi entregue."""
+    breaker = get_circuit_breaker(provider)
+    deadline = time.monotonic() + REQUEST_DEADLINE
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        if not breaker.allow():
+            raise circuit_open_error(provider)
+        started = False
+        try:
+            for chunk in open_stream():
+                started = True
+                yield chunk
+        except Exception as e:
+            retryable = is_retryable(e)
+            delay = retry_delay(attempt, e)
+            if (started or not retryable or attempt == RETRY_MAX_ATTEMPTS - 1
+                    or not can_retry(provider, delay, deadline)):
+                if retryable:
+                    breaker.record_failure()
+                raise ProviderError(describe_provider_error(provider, e)) from e
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return
+
+async def call_with_retries_async(provider, request):
+    """Versão assíncrona de call_with_retries; request() cria uma nova corrotina a cada tentativa."""
+    breaker = get_circuit_breaker(provider)
+    timeout = PROVIDER_TIMEOUTS.get(provider, DEFAULT_PROVIDER_TIMEOUT)
+    deadline = time.monotonic() + REQUEST_DEADLINE
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        if not breaker.allow():
+            raise circuit_open_error(provider)
+        try:
+            result = await asyncio.wait_for(request(), timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            retryable = is_retryable(e)
+            delay = retry_delay(attempt, e)
+            if not retryable or attempt == RETRY_MAX_ATTEMPTS - 1 or not can_retry(provider, delay, deadline):
+                if retryable:
+                    breaker.record_failure()
+                raise ProviderError(describe_provider_error(provider, e)) from e
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+# --- Registro de Clientes dos Provedores ---
+# Clientes criados uma vez por processo (st.cache_resource) e reaproveitados entre reruns,
+# mantendo as conexões HTTP/gRPC abertas (keep-alive) em vez de refazer TCP+TLS a cada mensagem.
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 120 # segundos
+GEMINI_MODEL_CACHE_SIZE = 32 # Um por modo + variações de system prompt (ex.: com resumo)
+
+def get_api_key(name):
+    """Lê a chave da variável de ambiente ou de st.secrets (None se não configurada)."""
+    try:
+        return os.getenv(name) or st.secrets.get(name)
+    except FileNotFoundError: # Sem .streamlit/secrets.toml
+        return None
+
+def require_api_key(name):
+    api_key = get_api_key(name)
+    if not api_key:
+        raise ProviderError(f"{name} não configurada.")
+    return api_key
+
+def groq_sdk():
+    """Módulo groq, importado na primeira vez que um modo da Groq é usado (~0.2 s; depois vem do sys.modules)."""
+    import groq
+    return groq
+
+def gemini_sdk():
+    """Módulo google.generativeai, importado na primeira vez que um modo Gemini é usado (~0.6 s)."""
+    import google.generativeai as genai
+    return genai
+
+@st.cache_resource
+def get_groq_client(api_key):
+    """Cliente Groq compartilhado, com pool de conexões HTTP keep-alive."""
+    import httpx
+
+    groq = groq_sdk()
+    http_client = groq.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
         )
-        
-        # Gera a resposta
-        response = model.generate_content(
-            final_messages, 
-            system_instruction=config["system_prompt"]
+    )
+    # Os retries ficam por conta de call_with_retries (o SDK faria até 2 por conta própria)
+    return groq.Groq(api_key=api_key, http_client=http_client, timeout=PROVIDER_TIMEOUTS["groq"], max_retries=0)
+
+@st.cache_resource
+def configure_gemini(api_key):
+    """Configura o SDK Gemini uma única vez (genai.configure recria o cliente global a cada chamada)."""
+    gemini_sdk().configure(api_key=api_key)
+    return api_key
+
+@st.cache_resource(max_entries=GEMINI_MODEL_CACHE_SIZE)
+def get_gemini_model(model_name, system_prompt, temperature, max_tokens):
+    """Um GenerativeModel por combinação de modelo/system prompt/geração (na prática, um por modo)."""
+    # O system prompt vai no construtor do modelo (generate_content não aceita system_instruction)
+    genai = gemini_sdk()
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=system_prompt,
+        generation_config=genai.GenerationConfig(
+            temperature=temperature,
+            max_output_tokens=max_tokens
         )
-        
+    )
+
+def build_groq_messages(messages, config):
+    """Monta a lista de mensagens no formato da Groq (system prompt no início)."""
+    # A Groq rejeita campos extras (ex.: o 'id' vindo do cache de mensagens) e a role 'model' do Gemini
+    groq_messages = [
+        {"role": "system", "content": config["system_prompt"]}
+    ] + [
+        {"role": "assistant" if msg["role"] == "model" else msg["role"], "content": msg["content"]}
+        for msg in messages
+    ]
+    observe("primebud_request_payload_bytes", sum(len(msg["content"].encode()) for msg in groq_messages),
+            mode=config["key"])
+    return groq_messages
+
+@timed("primebud_provider_seconds")
+def get_groq_response(messages, config):
+    """Chama a API Groq (Llama 3). Falhas sobem como exceção para a camada de resiliência."""
+    client = get_groq_client(require_api_key("GROQ_API_KEY"))
+    
+    response = client.chat.completions.create(
+        model=config["model"],
+        messages=build_groq_messages(messages, config),
+        temperature=config["temperature"],
+        max_tokens=config["max_tokens"],
+    )
+    
+    if response.usage:
+        record_token_usage(config, response.usage.prompt_tokens, response.usage.completion_tokens)
+    return response.choices[0].message.content, "assistant" # Retorna role
+
+@timed("primebud_provider_seconds")
+def stream_groq_response(messages, config):
+    """Chama a API Groq com stream=True, produzindo o texto pedaço a pedaço."""
+    client = get_groq_client(require_api_key("GROQ_API_KEY"))
+    
+    stream = client.chat.completions.create(
+        model=config["model"],
+        messages=build_groq_messages(messages, config),
+        temperature=config["temperature"],
+        max_tokens=config["max_tokens"],
+        stream=True,
+    )
+    
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        usage = getattr(chunk.x_groq, "usage", None) # A Groq manda o uso no último pedaço
+        if usage:
+            record_token_usage(config, usage.prompt_tokens, usage.completion_tokens)
+
+def build_gemini_request(messages, config):
+    """Obtém o modelo Gemini do registro e formata o histórico ('assistant' -> 'model')."""
+    configure_gemini(require_api_key("GEMINI_API_KEY"))
+    
+    # Formatar mensagens para o Gemini: 'assistant' -> 'model'; imagens anexadas viram partes inline
+    gemini_messages_formatted = []
+    payload_bytes = len(config["system_prompt"].encode())
+    for msg in attach_message_images(messages):
+        role = "model" if msg["role"] == "assistant" else msg["role"]
+        parts = [{"text": msg["content"]}] if msg["content"] else []
+        for name in msg.get("images") or ():
+            data = load_image_bytes(name)
+            if data:
+                parts.append({"mime_type": image_mime_type(name), "data": data})
+                payload_bytes += len(data)
+        payload_bytes += len(msg["content"].encode())
+        gemini_messages_formatted.append({"role": role, "parts": parts or [{"text": ""}]})
+    observe("primebud_request_payload_bytes", payload_bytes, mode=config["key"])
+    
+    # Otimização: remove mensagens consecutivas da mesma role
+    cleaned_messages = []
+    if gemini_messages_formatted:
+        cleaned_messages.append(gemini_messages_formatted[0])
+        for i in range(1, len(gemini_messages_formatted)):
+            if gemini_messages_formatted[i]["role"] != cleaned_messages[-1]["role"]:
+                cleaned_messages.append(gemini_messages_formatted[i])
+            else:
+                # Se for a mesma role, junta as partes numa mensagem só (caso raro)
+                cleaned_messages[-1]["parts"].extend(gemini_messages_formatted[i]["parts"])
+
+    model = get_gemini_model(config["model"], config["system_prompt"], config["temperature"], config["max_tokens"])
+    return model, cleaned_messages
+
+def format_gemini_error(e):
+    """Tenta extrair uma mensagem de erro mais clara da resposta da API Gemini."""
+    error_details = str(e)
+    if "API key not valid" in error_details:
+        return "A chave da API Gemini não é válida. Verifique seus secrets."
+    if "quota" in error_details:
+        return "Você excedeu sua cota na API Gemini."
+    
+    return f"Erro ao processar com Gemini: {error_details}"
+
+def gemini_request_options():
+    return {"timeout": PROVIDER_TIMEOUTS["gemini"]}
+
+def record_gemini_usage(config, response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        record_token_usage(config, usage.prompt_token_count, usage.candidates_token_count)
+
+# FUNÇÃO GEMINI REVERTIDA PARA O MODO SIMPLES (SEM TOOLS)
+@timed("primebud_provider_seconds")
+def get_gemini_response(messages, config):
+    """Chama a API Gemini (REVERTIDA PARA MODO BÁSICO). Falhas sobem como exceção."""
+    model, contents = build_gemini_request(messages, config)
+    
+    # Gera a resposta
+    response = model.generate_content(contents, request_options=gemini_request_options())
+    record_gemini_usage(config, response)
+    try:
         return response.text, "model" # Retorna role
-    except Exception as e:
-        st.error(f"Erro ao contatar a API Gemini: {e}")
-        # Tenta extrair uma mensagem de erro mais clara da resposta da API
-        error_details = str(e)
-        if "API key not valid" in error_details:
-            return "❌ Erro: A chave da API Gemini não é válida. Verifique seus secrets.", "model"
-        if "quota" in error_details:
-            return "❌ Erro: Você excedeu sua cota na API Gemini.", "model"
-        
-        return f"❌ Erro ao processar com Gemini: {str(e)}", "model"
+    except ValueError: # Resposta sem texto (ex.: bloqueada pelos filtros de segurança)
+        raise ProviderError("O Gemini não retornou texto para esta mensagem (possível bloqueio de segurança).")
+
+@timed("primebud_provider_seconds")
+def stream_gemini_response(messages, config):
+    """Chama a API Gemini com stream=True, produzindo o texto pedaço a pedaço."""
+    model, contents = build_gemini_request(messages, config)
+    
+    chunk = None
+    for chunk in model.generate_content(contents, stream=True, request_options=gemini_request_options()):
+        # Pedaços sem texto (ex.: só metadados de segurança) levantam ValueError em .text
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+    record_gemini_usage(config, chunk) # O último pedaço traz o uso total
 
 def get_deepseek_response(messages, config):
     """Chama a API DeepSeek V3 (compatível com OpenAI)."""
     # (Manutenção do placeholder do código original)
-    return "❌ DeepSeek desativado. API Key 'openai' ausente na versão mínima fornecida.", "assistant"
+    raise ProviderError("DeepSeek desativado. API Key 'openai' ausente na versão mínima fornecida.")
 
 def get_manus_response(messages, config):
     """Chama a API Manus (compatível com OpenAI)."""
     # (Manutenção do placeholder do código original)
-    return "❌ Manus desativado. API Key 'openai' ausente na versão mínima fornecida.", "assistant"
+    raise ProviderError("Manus desativado. API Key 'openai' ausente na versão mínima fornecida.")
 
+def stream_single_response(response_fn, messages, config):
+    """Adapta um provedor sem streaming para o formato de gerador (um único pedaço)."""
+    text, _ = response_fn(messages, config)
+    yield text
 
-def generate_chat_response(messages, mode):
-    """Roteador: Chama a API correta com base no modo (REVERTIDO)."""
-    config = MODES_CONFIG[mode]
+
+def call_provider(messages, config, stream=False):
+    """Chama o provedor configurado em config["api_provider"], com prazos, retries e circuit breaker.
+
+    Com stream=True retorna (gerador de pedaços de texto, role) em vez de (texto, role).
+    Falhas levantam ProviderError (no modo streaming, ao iterar o gerador).
+    """
     provider = config.get("api_provider", "groq") # Padrão é Groq
     
     if provider == "gemini":
-        return get_gemini_response(messages, config)
+        request, open_stream, role = get_gemini_response, stream_gemini_response, "model"
     elif provider == "deepseek": 
-        return get_deepseek_response(messages, config)
+        request, role = get_deepseek_response, "assistant"
+        open_stream = lambda m, c: stream_single_response(get_deepseek_response, m, c)
     elif provider == "manus": 
-        return get_manus_response(messages, config)
+        request, role = get_manus_response, "assistant"
+        open_stream = lambda m, c: stream_single_response(get_manus_response, m, c)
     else: # 'groq'
-        return get_groq_response(messages, config)
+        request, open_stream, role = get_groq_response, stream_groq_response, "assistant"
+    
+    if stream:
+        return stream_with_retries(provider, lambda: open_stream(messages, config)), role
+    return call_with_retries(provider, lambda: request(messages, config))
+
+
+# --- Orçamento de Contexto ---
+SUMMARY_MODE = "primebud_1_0_flash" # Modo barato usado para resumir o histórico antigo
+SUMMARY_MAX_TOKENS = 600
+SUMMARY_PROMPT = (
+    "Você resume conversas entre um usuário e o assistente PrimeBud. "
+    "Atualize o resumo existente incorporando os novos trechos, preservando fatos, decisões, "
+    "preferências do usuário, nomes, números e trechos de código relevantes. "
+    "Responda apenas com o resumo, em no máximo 300 palavras."
+)
+# Contexto semântico: em chats salvos, o histórico recente ocupa no máximo RETRIEVAL_RECENT_SHARE do
+# orçamento e, quando não cabe, no lugar do resto vão só as mensagens antigas (de qualquer chat do
+# usuário) mais parecidas com a pergunta. PRIMEBUD_SEMANTIC_CONTEXT=0 volta a mandar o histórico inteiro.
+SEMANTIC_CONTEXT_ENABLED = os.getenv("PRIMEBUD_SEMANTIC_CONTEXT", "1") == "1"
+RETRIEVAL_RECENT_SHARE = 0.5
+RETRIEVAL_TOP_K = 4
+RETRIEVAL_MIN_SCORE = 0.25      # Similaridade mínima (cosseno) para um trecho entrar no contexto
+RETRIEVAL_BUDGET_SHARE = 0.125  # Fração do orçamento reservada aos trechos recuperados
+RETRIEVAL_SNIPPET_CHARS = 1200
+
+def estimate_tokens(text):
+    """Estimativa barata de tokens (~4 caracteres por token), suficiente para orçamento."""
+    return len(text) // 4 + 1
+
+def message_tokens(msg):
+    """Tokens de uma mensagem, calculados uma vez e guardados no próprio dict (cache por mensagem/id)."""
+    if "tokens" not in msg:
+        msg["tokens"] = estimate_tokens(msg["content"]) + IMAGE_TOKENS * len(msg.get("images") or ())
+    return msg["tokens"]
+
+def newest_within_budget(messages, budget):
+    """Retorna o maior sufixo do histórico que cabe no orçamento, começando por uma mensagem do usuário."""
+    used = 0
+    start = len(messages)
+    while start > 0 and used + message_tokens(messages[start - 1]) <= budget:
+        start -= 1
+        used += message_tokens(messages[start])
+    # Sempre mantém a última mensagem, mesmo que sozinha estoure o orçamento
+    start = min(start, len(messages) - 1) if messages else 0
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        start += 1
+    return messages[start:]
+
+def summarize_messages(previous_summary, messages):
+    """Gera um resumo acumulado (resumo anterior + mensagens que saíram da janela). Retorna None em caso de erro."""
+    transcript = "\n\n".join(
+        f"{'Usuário' if msg['role'] == 'user' else 'PrimeBud'}: {msg['content']}" for msg in messages
+    )
+    prompt = f"Resumo atual:\n{previous_summary or '(vazio)'}\n\nNovos trechos da conversa:\n{transcript}"
+    config = dict(MODES_CONFIG[SUMMARY_MODE], system_prompt=SUMMARY_PROMPT,
+                  max_tokens=SUMMARY_MAX_TOKENS, temperature=0.2)
+    summary_messages = [{"role": "user", "content": prompt}]
+    try:
+        acquire_rate_limit(None, config, summary_messages)
+        text, _ = call_provider(summary_messages, config)
+    except ProviderError:
+        return None
+    return text.strip() or None
+
+def build_context(messages, mode, chat_id=None):
+    """Ajusta o histórico ao orçamento de tokens do modo, compartilhado por todos os provedores.
+
+    Mensagens já cobertas pelo resumo persistido do chat não são reenviadas. Quando o restante
+    estoura o orçamento, as mais antigas são resumidas (somente para chats com chat_id) e a janela
+    cai para metade do orçamento, para que o resumo não precise ser refeito a cada turno. Com o
+    contexto semântico ligado, a janela fica sempre nessa metade e as mensagens antigas entram só
+    como trechos recuperados (retrieve_related_messages).
+    Retorna (mensagens, config), com o resumo e os trechos anexados ao system prompt.
+    """
+    config = MODES_CONFIG[mode]
+    budget = config["context_tokens"]
+    
+    summary, covered_id = None, 0
+    if chat_id is not None:
+        summary, covered_id = get_chat_summary(chat_id) or (None, 0)
+    
+    pending = [msg for msg in messages if msg.get("id") is None or msg["id"] > covered_id]
+    summary_tokens = estimate_tokens(summary) if summary else 0
+    if summary_tokens + sum(message_tokens(msg) for msg in pending) > budget:
+        window = newest_within_budget(pending, budget // 2)
+        dropped = pending[:len(pending) - len(window)]
+        if chat_id is not None and dropped and dropped[-1].get("id") is not None:
+            new_summary = summarize_messages(summary, dropped)
+            if new_summary:
+                summary = new_summary
+                save_chat_summary(chat_id, summary, dropped[-1]["id"])
+        pending = window
+    
+    system_prompt = config["system_prompt"]
+    if summary:
+        system_prompt += f"\n\nResumo da conversa até aqui:\n{summary}"
+    if chat_id is not None and SEMANTIC_CONTEXT_ENABLED and pending:
+        window = newest_within_budget(pending, int(budget * RETRIEVAL_RECENT_SHARE))
+        if len(window) < len(pending):
+            # O que saiu da janela só volta como trecho se for parecido com a pergunta
+            pending = window
+            related = retrieve_related_messages(chat_id, pending, budget)
+            if related:
+                system_prompt += "\n\nTrechos de conversas anteriores que podem ser relevantes:\n" + related
+    if system_prompt != config["system_prompt"]:
+        config = dict(config, system_prompt=system_prompt)
+    return pending, config
+
+def retrieve_related_messages(chat_id, window, budget):
+    """Trechos (já formatados) das mensagens antigas mais parecidas com a última pergunta da janela."""
+    exclude_ids = {msg["id"] for msg in window if msg.get("id") is not None}
+    hits = search_similar_messages(chat_id, window[-1]["content"], RETRIEVAL_TOP_K, exclude_ids) or []
+    lines, used = [], 0
+    for msg in hits:
+        if msg["score"] < RETRIEVAL_MIN_SCORE:
+            break
+        content = msg["content"][:RETRIEVAL_SNIPPET_CHARS]
+        used += estimate_tokens(content)
+        if used > budget * RETRIEVAL_BUDGET_SHARE:
+            break
+        lines.append(f"- {'Usuário' if msg['role'] == 'user' else 'PrimeBud'}: {content}")
+    return "\n".join(lines)
+
+
+# --- Cache de Respostas ---
+class ResponseCacheStats:
+    """Contadores de acertos/falhas do cache de respostas, compartilhados pelo processo."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+@st.cache_resource
+def get_response_cache_stats():
+    return ResponseCacheStats()
+
+def response_cache_key(mode, config, messages):
+    """Hash de modo, system prompt, modelo, temperatura e histórico normalizado (espaços e role).
+
+    Imagens anexadas entram pelo nome no cache (o SHA-256 do arquivo), só nas mensagens que as têm.
+    """
+    history = [
+        ("assistant" if msg["role"] == "model" else msg["role"], " ".join(msg["content"].split()))
+        + ((msg["images"],) if msg.get("images") else ())
+        for msg in messages
+    ]
+    payload = json.dumps(
+        [mode, config["system_prompt"], config["model"], config["temperature"], history],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def cache_streamed_response(key, mode, chunks, role):
+    """Repassa os pedaços do stream e grava o texto completo no cache ao final."""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    # Se o stream falhar, a ProviderError interrompe o gerador antes daqui e nada é gravado
+    text = "".join(parts)
+    if text:
+        store_cached_response(key, mode, text, role)
+
+
+def request_provider(messages, config, user=None, stream=False):
+    """call_provider passando antes pelo limite de taxa e medindo a latência (e o TTFT) do modo."""
+    acquire_rate_limit(user, config, messages)
+    start = time.perf_counter()
+    response, role = call_provider(messages, config, stream=stream)
+    if stream:
+        return observe_stream(response, config["key"], start), role
+    observe("primebud_mode_seconds", time.perf_counter() - start, mode=config["key"])
+    return response, role
+
+def generate_mode_response(messages, mode, stream=False, chat_id=None, user=None):
+    """Aplica o orçamento de contexto e chama a API correta para um único modo (sem fallback).
+
+    Modos com "cache_responses" consultam antes o cache de respostas. Só chamadas que vão de fato
+    ao provedor passam pelo limite de taxa do usuário (user = dict com 'id' e 'plan').
+    """
+    context_messages, config = build_context(messages, mode, chat_id)
+    if not config.get("cache_responses"):
+        return request_provider(context_messages, config, user, stream=stream)
+    
+    key = response_cache_key(mode, config, context_messages)
+    cached = get_cached_response(key)
+    get_response_cache_stats().record(hit=cached is not None)
+    if cached:
+        text, role = cached
+        return (iter([text]) if stream else text), role
+    
+    response, role = request_provider(context_messages, config, user, stream=stream)
+    if stream:
+        return cache_streamed_response(key, mode, response, role), role
+    store_cached_response(key, mode, response, role)
+    return response, role
+
+def turn_has_images(messages):
+    """Se a última mensagem (a pergunta do turno) traz imagens anexadas."""
+    return bool(messages) and bool(attach_message_images(messages[-1:])[0].get("images"))
+
+def fallback_chain(mode, messages=()):
+    """O modo pedido seguido do modo reserva do seu provedor (FALLBACK_MODES), se houver.
+
+    Um turno com imagens só cai para um modo reserva multimodal: os outros descartariam as imagens
+    sem aviso e responderiam como se não houvesse anexo. Sem reserva, o erro do modo pedido aparece.
+    """
+    modes = [mode]
+    fallback = FALLBACK_MODES.get(MODES_CONFIG[mode].get("api_provider", "groq"))
+    if fallback and fallback != mode and (MODES_CONFIG[fallback].get("multimodal") or not turn_has_images(messages)):
+        modes.append(fallback)
+    return modes
+
+def stream_with_fallback(messages, modes, chat_id=None, user=None):
+    """Streaming com fallback: se um modo falhar antes do primeiro pedaço, passa para o próximo."""
+    for index, mode in enumerate(modes):
+        started = False
+        try:
+            chunks, _ = generate_mode_response(messages, mode, stream=True, chat_id=chat_id, user=user)
+            for chunk in chunks:
+                started = True
+                yield chunk
+            return
+        except ProviderError as e:
+            if started or e.rate_limited or index == len(modes) - 1:
+                raise
+
+def generate_chat_response(messages, mode, stream=False, chat_id=None, user=None):
+    """Roteador: responde com o modo pedido e, se o provedor falhar ou estiver com o circuito
+    aberto, cai automaticamente para o modo reserva (ex.: Gemini -> Groq). Cota do usuário
+    esgotada (rate_limited) não cai: o modo reserva passaria pela mesma cota.
+
+    Com stream=True retorna (gerador de pedaços de texto, role) em vez de (texto, role).
+    Falhas levantam ProviderError; o texto do erro nunca deve ser salvo no histórico.
+    """
+    modes = fallback_chain(mode, messages)
+    if stream:
+        role = "model" if MODES_CONFIG[mode].get("api_provider") == "gemini" else "assistant"
+        return stream_with_fallback(messages, modes, chat_id, user), role
+    
+    for index, candidate in enumerate(modes):
+        try:
+            return generate_mode_response(messages, candidate, chat_id=chat_id, user=user)
+        except ProviderError as e:
+            if e.rate_limited or index == len(modes) - 1:
+                raise
+
+
+# --- Despacho Assíncrono (Comparação de Modos) ---
+# Um event loop persistente em uma thread própria: os clientes assíncronos (httpx/gRPC) ficam
+# presos ao loop em que foram criados, então o loop precisa sobreviver entre reruns.
+MAX_COMPARE_MODES = 3
+
+@st.cache_resource
+def get_async_loop():
+    """Event loop compartilhado pelo processo, rodando em uma thread daemon."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="primebud-async", daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_async_groq_client(api_key):
+    """Cliente AsyncGroq compartilhado (usado somente dentro do loop de get_async_loop)."""
+    import httpx
+
+    groq = groq_sdk()
+    http_client = groq.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+    )
+    return groq.AsyncGroq(api_key=api_key, http_client=http_client, timeout=PROVIDER_TIMEOUTS["groq"], max_retries=0)
+
+@timed("primebud_provider_seconds")
+async def get_groq_response_async(client, messages, config):
+    response = await client.chat.completions.create(
+        model=config["model"],
+        messages=build_groq_messages(messages, config),
+        temperature=config["temperature"],
+        max_tokens=config["max_tokens"],
+    )
+    if response.usage:
+        record_token_usage(config, response.usage.prompt_tokens, response.usage.completion_tokens)
+    return response.choices[0].message.content, "assistant"
+
+@timed("primebud_provider_seconds")
+async def get_gemini_response_async(model, contents, config):
+    response = await model.generate_content_async(contents, request_options=gemini_request_options())
+    record_gemini_usage(config, response)
+    try:
+        return response.text, "model"
+    except ValueError:
+        raise ProviderError("O Gemini não retornou texto para esta mensagem (possível bloqueio de segurança).")
+
+def start_async_response(messages, mode, chat_id=None, user=None):
+    """Agenda a resposta de um modo no loop assíncrono e retorna um concurrent.futures.Future de (texto, role).
+
+    Chaves, clientes e contexto são resolvidos aqui, na thread do script; o loop só faz I/O.
+    Falhas (já após retries) aparecem como ProviderError em future.result().
+    """
+    future = concurrent.futures.Future()
+    try:
+        context_messages, config = build_context(messages, mode, chat_id)
+        provider = config.get("api_provider", "groq")
+        acquire_rate_limit(user, config, context_messages)
+        
+        if provider == "gemini":
+            model, contents = build_gemini_request(context_messages, config)
+            request = lambda: get_gemini_response_async(model, contents, config)
+        elif provider == "groq":
+            client = get_async_groq_client(require_api_key("GROQ_API_KEY"))
+            request = lambda: get_groq_response_async(client, context_messages, config)
+        else: # Provedores desativados respondem (ou falham) na hora
+            future.set_result(call_provider(context_messages, config))
+            return future
+    except ProviderError as e:
+        future.set_exception(e)
+        return future
+    
+    start = time.perf_counter()
+    future = asyncio.run_coroutine_threadsafe(call_with_retries_async(provider, request), get_async_loop())
+    
+    def record_latency(done):
+        if not done.cancelled() and done.exception() is None:
+            observe("primebud_mode_seconds", time.perf_counter() - start, mode=mode)
+    
+    future.add_done_callback(record_latency)
+    return future
+
+def generate_compare_responses(messages, modes, chat_id=None, user=None):
+    """Dispara o mesmo prompt para vários modos ao mesmo tempo. Retorna {future: modo}.
+
+    O tempo total é o do provedor mais lento, não a soma; use concurrent.futures.as_completed
+    para exibir cada resposta assim que ela chega.
+    """
+    return {start_async_response(messages, mode, chat_id, user): mode for mode in modes}
+
+def compare_deadline(modes):
+    """Prazo total da comparação: o prazo de uma requisição mais a última tentativa do provedor mais lento."""
+    return REQUEST_DEADLINE + max(
+        PROVIDER_TIMEOUTS.get(MODES_CONFIG[mode].get("api_provider", "groq"), DEFAULT_PROVIDER_TIMEOUT)
+        for mode in modes
+    )
+
+def render_compare_responses(futures):
+    """Desenha as respostas lado a lado conforme cada uma termina; cancela as que estourarem o prazo.
+
+    Retorna {modo: (texto, role)} só com os modos que responderem; as falhas são exibidas na coluna.
+    """
+    modes = list(futures.values())
+    placeholders = {}
+    for column, mode in zip(st.columns(len(modes)), modes):
+        with column:
+            st.markdown(f"<span class='mode-badge'>{MODES_CONFIG[mode]['short_name']}</span>", unsafe_allow_html=True)
+            placeholders[mode] = st.empty()
+            placeholders[mode].markdown("🤔 Processando...")
+    
+    results = {}
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=compare_deadline(modes)):
+            mode = futures[future]
+            try:
+                results[mode] = future.result()
+            except ProviderError as e:
+                placeholders[mode].error(f"❌ {e}")
+                continue
+            formatted_content = format_message_with_code(results[mode][0])
+            placeholders[mode].markdown(f'<div class="chat-message assistant-message" style="max-width: 100%;"><div class="message-label">🤖 PrimeBud</div>{formatted_content}</div>', unsafe_allow_html=True)
+    except concurrent.futures.TimeoutError:
+        for future, mode in futures.items():
+            if not future.done():
+                future.cancel()
+                placeholders[mode].error("⏱️ Tempo esgotado.")
+    return results
+
+
+def render_message_images(names):
+    """Miniaturas das imagens anexadas a uma mensagem (as que ainda estão no cache em disco)."""
+    paths = [image_path(name) for name in names or () if os.path.exists(image_path(name))]
+    if paths:
+        st.image(paths, width=IMAGE_PREVIEW_WIDTH)
+
+def render_processing(placeholder):
+    """Mostra o logo animado (ou um aviso simples) enquanto a resposta não começa a chegar."""
+    if LOGO_URL:
+        placeholder.markdown(f"""
+        <div style='text-align: center; margin: 2rem 0;'>
+            <img src='{LOGO_URL}' width='80' style='border-radius: 16px; animation: pulse 1.5s infinite;'>
+            <p style='color: #ff6b35; margin-top: 1rem; font-weight: 600;'>Processando sua solicitação...</p>
+        </div>
+        """, unsafe_allow_html=True)
+    else:
+        placeholder.markdown("🤔 Processando...")
+
+def render_streaming_response(chunks):
+    """Renderiza a resposta no balão do assistente conforme os pedaços chegam e retorna o texto final."""
+    placeholder = st.empty()
+    
+    # Mostrar logo animado até chegar o primeiro pedaço
+    render_processing(placeholder)
+    
+    parts = []
+    last_render = 0.0
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            # Limita a taxa de redesenho para não inundar o websocket com respostas longas
+            now = time.monotonic()
+            if now - last_render >= STREAM_RENDER_INTERVAL:
+                formatted_content = format_message_with_code("".join(parts))
+                placeholder.markdown(f'<div class="chat-message assistant-message"><div class="message-label">🤖 PrimeBud</div>{formatted_content}▌</div>', unsafe_allow_html=True)
+                last_render = now
+    except ProviderError:
+        placeholder.empty() # Não deixa uma resposta parcial na tela
+        raise
+    
+    response_text = "".join(parts)
+    formatted_content = format_message_with_code(response_text)
+    placeholder.markdown(f'<div class="chat-message assistant-message"><div class="message-label">🤖 PrimeBud</div>{formatted_content}</div>', unsafe_allow_html=True)
+    return response_text
+
+
+# --- Geração em Segundo Plano (Jobs) ---
+# A chamada ao provedor roda num pool de threads do processo, fora da thread do script: a resposta
+# é gravada no banco quando termina, mesmo que o navegador feche ou a sessão reconecte no meio.
+# A tela só acompanha o job, relendo o texto parcial gravado (st.fragment com run_every).
+JOB_WORKERS = 8                          # Gerações simultâneas por processo
+JOB_FLUSH_INTERVAL = 0.5                 # Intervalo mínimo (s) entre gravações do texto parcial
+JOB_POLL_INTERVAL = 1                    # Intervalo (s) com que a tela relê o job
+JOB_STALE_AFTER = 3 * REQUEST_DEADLINE   # Sem heartbeat por mais que isso, o worker é dado como morto
+
+@st.cache_resource
+def get_job_executor():
+    """Pool de workers de geração compartilhado pelo processo."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="primebud-job")
+
+def load_job_context(chat_id, mode):
+    """Histórico do chat lido só do banco (o worker não tem sessão), até cobrir o orçamento do modo ou o resumo."""
+    budget = MODES_CONFIG[mode]["context_tokens"]
+    covered_id = (get_chat_summary(chat_id) or (None, 0))[1]
+    messages = []
+    while True:
+        before_id = messages[0]['id'] if messages else None
+        rows = get_chat_messages_page(chat_id, before_id=before_id, limit=CHAT_PAGE_SIZE) or []
+        messages[:0] = [{"id": msg_id, "role": role, "content": content} for msg_id, role, content, _ in rows]
+        if len(rows) < CHAT_PAGE_SIZE or messages[0]['id'] <= covered_id + 1:
+            return messages
+        if sum(message_tokens(msg) for msg in messages if msg['id'] > covered_id) > budget:
+            return messages
+
+def run_generation_job(job_id):
+    """Executa um job no pool: gera a resposta em streaming, grava parciais e, no fim, o turno completo.
+
+    Em caso de falha só a pergunta entra no histórico; o erro fica no job para a tela exibir.
+    """
+    claimed = claim_job(job_id)
+    if claimed is None:
+        return # Outro worker já pegou o job (ou o chat foi excluído)
+    chat_id, user_id, mode, prompt, images, attempt = claimed
+    parts = []
+    error = None
+    try:
+        messages = load_job_context(chat_id, mode) + [{'role': 'user', 'content': prompt, 'images': images}]
+        user = {'id': user_id, 'plan': get_user_plan(user_id)}
+        chunks, role = generate_chat_response(messages, mode, stream=True, chat_id=chat_id, user=user)
+        last_flush = time.monotonic()
+        for chunk in chunks:
+            parts.append(chunk)
+            now = time.monotonic()
+            if now - last_flush >= JOB_FLUSH_INTERVAL:
+                update_job_partial(job_id, attempt, "".join(parts))
+                last_flush = now
+    except ProviderError as e:
+        error = str(e)
+    except sqlite3.Error as e:
+        error = f"Erro no banco de dados: {e}"
+    except Exception as e: # O pool engoliria a exceção e o job ficaria "running" até ser dado como morto
+        logger.exception("Erro inesperado no job %s", job_id)
+        error = f"Erro inesperado: {e}"
+    turn = [("user", prompt, images)] if error else [("user", prompt, images), (role, "".join(parts))]
+    try:
+        finish_job(job_id, attempt, chat_id, turn, error=error)
+    except sqlite3.Error as e:
+        # O turno não pôde ser gravado: ao menos o job sai de "running" com o motivo para a tela exibir
+        fail_job(job_id, attempt, f"Erro no banco de dados: {e}")
+
+def submit_generation_job(chat_id, user_id, mode, prompt, images=()):
+    """Enfileira a geração e a entrega ao pool. Retorna o id do job ou None se o chat já tiver uma em andamento."""
+    job_id = create_job(chat_id, user_id, mode, prompt, images)
+    if job_id is not None:
+        get_job_executor().submit(run_generation_job, job_id)
+    return job_id
+
+@st.cache_resource
+def recover_jobs():
+    """Na subida do processo, retoma os jobs pendentes e os de workers mortos (ex.: reinício do servidor)."""
+    job_ids = requeue_stale_jobs(JOB_STALE_AFTER)
+    for job_id in job_ids:
+        get_job_executor().submit(run_generation_job, job_id)
+    return len(job_ids)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_job_progress(job_id):
+    """Acompanha um job: redesenha só este trecho a cada JOB_POLL_INTERVAL e recarrega a página quando termina."""
+    job = get_job(job_id)
+    if job is None or job[0] in ('done', 'error'):
+        st.rerun()
+    status, partial, _, updated_at = job
+    if status == 'running' and time.time() - updated_at > JOB_STALE_AFTER and requeue_stale_jobs(JOB_STALE_AFTER, job_id):
+        get_job_executor().submit(run_generation_job, job_id)
+    
+    placeholder = st.empty()
+    if partial:
+        formatted_content = format_message_with_code(partial)
+        placeholder.markdown(f'<div class="chat-message assistant-message"><div class="message-label">🤖 PrimeBud</div>{formatted_content}▌</div>', unsafe_allow_html=True)
+    else:
+        render_processing(placeholder)
+
+
+METRICS_DASHBOARD = [ # (título, métrica, rótulo, escala)
+    ("⏱️ Latência por modo (ms)", "primebud_mode_seconds", "mode", 1000),
+    ("⚡ Tempo até o primeiro pedaço por modo (ms)", "primebud_mode_ttft_seconds", "mode", 1000),
+    ("📥 Tokens de entrada por modo", "primebud_prompt_tokens", "mode", 1),
+    ("📤 Tokens de saída por modo", "primebud_completion_tokens", "mode", 1),
+    ("🌐 Chamadas aos provedores (ms)", "primebud_provider_seconds", "function", 1000),
+    ("🚦 Espera no limite de taxa (ms)", "primebud_rate_limit_wait_seconds", "provider", 1000),
+    ("🗄️ Funções de banco (ms)", "primebud_db_seconds", "function", 1000),
+    ("🎨 Formatação de mensagens (ms)", "primebud_render_seconds", "function", 1000),
+    ("📦 Conteúdo enviado ao provedor por modo (KiB)", "primebud_request_payload_bytes", "mode", 1 / 1024),
+    ("🖼️ Imagens recebidas no upload (KiB)", "primebud_image_upload_bytes", "format", 1 / 1024),
+    ("🗜️ Imagens depois de reduzidas (KiB)", "primebud_image_bytes", "format", 1 / 1024),
+    ("⚙️ Preparação de imagens (ms)", "primebud_image_seconds", "cache", 1000),
+]
+
+def render_metrics_dashboard():
+    """Painel de admin: histogramas acumulados (banco + memória) e a exportação no formato do Prometheus."""
+    st.markdown("### 📊 Métricas")
+    rows = load_metrics()
+    if not rows:
+        st.info("Nenhuma métrica registrada ainda.")
+        return
+    for title, name, label, scale in METRICS_DASHBOARD:
+        table = metrics_table(rows, name, label, scale)
+        if table:
+            st.markdown(f"#### {title}")
+            st.dataframe(table, use_container_width=True, hide_index=True)
+    with st.expander("Formato Prometheus"):
+        text = format_prometheus_metrics(rows)
+        st.download_button("📥 Baixar metrics.prom", text, file_name="primebud_metrics.prom", mime="text/plain")
+        st.code(text, language="text")
 
 
 # 7. Função de Usuário Convidado
 def create_guest_user():
-    import random
-    guest_id = f"guest_{random.randint(10000, 99999)}"
+    # 64 bits aleatórios (secrets): colisão entre convidados é praticamente impossível, ao contrário de randint(10000, 99999)
+    guest_id = f"guest_{secrets.token_hex(8)}"
     return {
         'id': guest_id,
-        'username': f'Convidado #{guest_id.split("_")[1]}',
+        'username': f'Convidado #{guest_id[6:11].upper()}',
         'plan': 'free',
         'is_guest': True
     }
 
+# --- Armazenamento dos Convidados ---
+# Os chats dos convidados ficam num LRU do processo, fora do st.session_state: cada convidado tem um
+# teto de bytes (as mensagens mais antigas saem primeiro), o total do processo também, e sessões
+# paradas há mais de GUEST_IDLE_TTL são apagadas por uma thread de limpeza. Assim a memória do
+# servidor fica estável num pico de convidados, em vez de crescer com cada aba aberta.
+GUEST_MAX_SESSIONS = 5000
+GUEST_MAX_BYTES = 64 * 1024 * 1024        # Teto de todos os convidados juntos
+GUEST_SESSION_MAX_BYTES = 256 * 1024      # Teto por convidado
+GUEST_MESSAGE_OVERHEAD = 200              # Custo aproximado (bytes) de cada mensagem além do texto
+GUEST_IDLE_TTL = 2 * 3600                 # Sessões sem uso há mais que isso (s) são apagadas
+GUEST_SWEEP_INTERVAL = 60
+
+class GuestSession:
+    __slots__ = ("chats", "messages", "bytes", "last_seen")
+    
+    def __init__(self):
+        self.chats = {}    # chat_id -> {'name': ..., 'mode': ...}, na ordem de criação
+        self.messages = {} # chat_id -> deque de {'role': ..., 'content': ...}
+        self.bytes = 0
+        self.last_seen = time.monotonic()
+
+def guest_message_size(content):
+    return len(content) + GUEST_MESSAGE_OVERHEAD
+
+class GuestStore:
+    """LRU dos chats de convidados, limitado em sessões e bytes (total e por sessão), com expiração."""
+    
+    def __init__(self, max_sessions=GUEST_MAX_SESSIONS, max_bytes=GUEST_MAX_BYTES,
+                 session_max_bytes=GUEST_SESSION_MAX_BYTES, idle_ttl=GUEST_IDLE_TTL):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict() # guest_id -> GuestSession; a ordem é a do último uso
+        self._bytes = 0
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.session_max_bytes = session_max_bytes
+        self.idle_ttl = idle_ttl
+    
+    def _touch(self, guest_id, create=False):
+        session = self._sessions.get(guest_id)
+        if session is None:
+            if not create:
+                return None
+            session = self._sessions[guest_id] = GuestSession()
+        self._sessions.move_to_end(guest_id)
+        session.last_seen = time.monotonic()
+        return session
+    
+    def _drop(self, guest_id):
+        session = self._sessions.pop(guest_id, None)
+        if session:
+            self._bytes -= session.bytes
+    
+    def _evict(self):
+        while self._sessions and (len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._sessions)))
+    
+    def create_chat(self, guest_id, name, mode):
+        chat_id = f"guest_chat_{secrets.token_hex(6)}"
+        with self._lock:
+            session = self._touch(guest_id, create=True)
+            session.chats[chat_id] = {'name': name, 'mode': mode}
+            session.messages[chat_id] = deque()
+            self._evict()
+        return chat_id
+    
+    def list_chats(self, guest_id):
+        """[(chat_id, nome, modo)] do mais antigo para o mais novo."""
+        with self._lock:
+            session = self._touch(guest_id)
+            if session is None:
+                return []
+            return [(chat_id, chat['name'], chat['mode']) for chat_id, chat in session.chats.items()]
+    
+    def get_chat(self, guest_id, chat_id):
+        """(nome, modo) do chat, ou None se não existe (ou a sessão expirou)."""
+        with self._lock:
+            session = self._touch(guest_id)
+            chat = session and session.chats.get(chat_id)
+            return (chat['name'], chat['mode']) if chat else None
+    
+    def set_chat_mode(self, guest_id, chat_id, mode):
+        with self._lock:
+            session = self._touch(guest_id)
+            if session and chat_id in session.chats:
+                session.chats[chat_id]['mode'] = mode
+    
+    def delete_chat(self, guest_id, chat_id):
+        with self._lock:
+            session = self._touch(guest_id)
+            if session and chat_id in session.chats:
+                del session.chats[chat_id]
+                freed = sum(guest_message_size(m['content']) for m in session.messages.pop(chat_id))
+                session.bytes -= freed
+                self._bytes -= freed
+    
+    def drop_session(self, guest_id):
+        with self._lock:
+            self._drop(guest_id)
+    
+    def get_messages(self, guest_id, chat_id):
+        """Cópia das mensagens do chat ([{'role': ..., 'content': ...}])."""
+        with self._lock:
+            session = self._touch(guest_id)
+            return list(session.messages.get(chat_id, ())) if session else []
+    
+    def append_message(self, guest_id, chat_id, role, content, images=()):
+        with self._lock:
+            session = self._touch(guest_id)
+            if session is None or chat_id not in session.chats:
+                return
+            size = guest_message_size(content)
+            session.messages[chat_id].append({'role': role, 'content': content, 'images': list(images)})
+            session.bytes += size
+            self._bytes += size
+            # Acima do teto da sessão, descarta as mensagens mais antigas (dos chats mais antigos primeiro)
+            for messages in session.messages.values():
+                while session.bytes > self.session_max_bytes and len(messages) > 1:
+                    freed = guest_message_size(messages.popleft()['content'])
+                    session.bytes -= freed
+                    self._bytes -= freed
+            self._evict()
+    
+    def sweep(self):
+        """Apaga as sessões paradas há mais de idle_ttl. Retorna quantas saíram."""
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            expired = []
+            for guest_id, session in self._sessions.items():
+                if session.last_seen > cutoff:
+                    break # Ordem de último uso: as demais são mais recentes
+                expired.append(guest_id)
+            for guest_id in expired:
+                self._drop(guest_id)
+            return len(expired)
+    
+    def stats(self):
+        with self._lock:
+            return len(self._sessions), self._bytes
+
+@st.cache_resource
+def get_guest_store():
+    return GuestStore()
+
+def run_guest_sweeper(store):
+    while True:
+        time.sleep(GUEST_SWEEP_INTERVAL)
+        try:
+            store.sweep()
+        except Exception: # A limpeza não pode derrubar a thread
+            pass
+
+@st.cache_resource
+def start_guest_sweeper():
+    """Dispara a limpeza periódica das sessões de convidados uma vez por processo."""
+    thread = threading.Thread(target=run_guest_sweeper, args=(get_guest_store(),), name="primebud-guests", daemon=True)
+    thread.start()
+    return thread
+
 # 8. Inicialização da Aplicação
 init_db() # Garante que as tabelas existem
+start_fts_backfill() # Indexa em segundo plano mensagens de bancos anteriores ao FTS
+start_embedding_backfill() # Gera em segundo plano os vetores da busca semântica das mensagens antigas
+recover_jobs() # Retoma gerações interrompidas por um reinício
+start_metrics_flusher() # Descarrega as métricas no banco periodicamente
+start_guest_sweeper() # Apaga os chats de convidados inativos
+guest_store = get_guest_store()
 
 if 'user' not in st.session_state:
     st.session_state.user = None
 if 'current_chat_id' not in st.session_state:
     st.session_state.current_chat_id = None
-if 'guest_chats' not in st.session_state:
-    st.session_state.guest_chats = {}
-if 'guest_messages' not in st.session_state:
-    st.session_state.guest_messages = {}
+if 'message_cache' not in st.session_state:
+    st.session_state.message_cache = {}
+if 'compare_results' not in st.session_state:
+    st.session_state.compare_results = {}
+if 'visible_messages' not in st.session_state:
+    st.session_state.visible_messages = {}
+if 'show_metrics' not in st.session_state:
+    st.session_state.show_metrics = False
+if 'watched_jobs' not in st.session_state:
+    st.session_state.watched_jobs = {} # chat_id -> último job acompanhado (para exibir o erro ao terminar)
+if 'session_cookie_js' not in st.session_state:
+    st.session_state.session_cookie_js = None # Script pendente que grava/apaga o cookie de sessão
+
+# Login lembrado: um cookie de sessão válido entra direto, sem rodar o KDF da senha
+if st.session_state.user is None and not st.session_state.get('logged_out'):
+    session_user = get_session_user(st.context.cookies.get(SESSION_COOKIE))
+    if session_user:
+        st.session_state.session_cookie = st.context.cookies.get(SESSION_COOKIE)
+        st.session_state.user = {
+            'id': session_user[0],
+            'username': session_user[1],
+            'plan': session_user[2],
+            'is_guest': False
+        }
+if st.session_state.session_cookie_js:
+    st.html(st.session_state.session_cookie_js, unsafe_allow_javascript=True)
+    st.session_state.session_cookie_js = None
 
 # 9. Lógica Principal da UI
 
@@ -681,10 +3300,10 @@ if st.session_state.user is None:
     
     with col2:
         # Logo e Título
-        if LOGO_BASE64:
+        if LOGO_URL:
             st.markdown(f"""
             <div style='text-align: center; margin-bottom: 1rem;'>
-                <img src='data:image/png;base64,{LOGO_BASE64}' width='120' style='border-radius: 20px; box-shadow: 0 4px 12px rgba(255, 107, 53, 0.3);'>
+                <img src='{LOGO_URL}' width='120' style='border-radius: 20px; box-shadow: 0 4px 12px rgba(255, 107, 53, 0.3);'>
             </div>
             """, unsafe_allow_html=True)
         st.markdown("<h1 style='text-align: center;'>PrimeBud 2.0</h1>", unsafe_allow_html=True)
@@ -697,9 +3316,14 @@ if st.session_state.user is None:
             st.markdown("#### Entre com sua conta")
             login_username = st.text_input("Usuário", key="login_user", placeholder="Digite seu usuário")
             login_password = st.text_input("Senha", type="password", key="login_pass", placeholder="Digite sua senha")
+            remember_login = st.checkbox("Manter conectado", value=True, key="login_remember")
             
             if st.button("🚀 Entrar", key="login_btn", use_container_width=True):
-                user = verify_user(login_username, login_password)
+                try:
+                    user = verify_user(login_username, login_password)
+                except TimeoutError:
+                    st.warning("⏳ Muitos acessos ao mesmo tempo. Tente novamente em alguns segundos.")
+                    st.stop()
                 if user:
                     st.session_state.user = {
                         'id': user[0],
@@ -707,6 +3331,9 @@ if st.session_state.user is None:
                         'plan': user[2],
                         'is_guest': False
                     }
+                    if remember_login:
+                        st.session_state.session_cookie = create_session(user[0])
+                        st.session_state.session_cookie_js = session_cookie_script(st.session_state.session_cookie, SESSION_TTL)
                     st.rerun()
                 else:
                     st.error("❌ Usuário ou senha incorretos")
@@ -753,10 +3380,10 @@ else:
     # --- SIDEBAR (Barra Lateral) ---
     with st.sidebar:
         # Logo na sidebar
-        if LOGO_BASE64:
+        if LOGO_URL:
             st.markdown(f"""
             <div style='text-align: center; margin-bottom: 0.5rem;'>
-                <img src='data:image/png;base64,{LOGO_BASE64}' width='60' style='border-radius: 12px;'>
+                <img src='{LOGO_URL}' width='60' style='border-radius: 12px;'>
             </div>
             """, unsafe_allow_html=True)
         st.markdown("### PrimeBud 2.0")
@@ -766,31 +3393,35 @@ else:
         
         if st.button("➕ Novo Chat", use_container_width=True, key="new_chat"):
             if st.session_state.user.get('is_guest'):
-                import random
-                chat_id = f"guest_chat_{random.randint(10000, 99999)}"
-                st.session_state.guest_chats[chat_id] = {
-                    'name': f"Chat {len(st.session_state.guest_chats) + 1}",
-                    'mode': 'primebud_1_5'
-                }
-                st.session_state.guest_messages[chat_id] = []
-                st.session_state.current_chat_id = chat_id
+                guest_id = st.session_state.user['id']
+                chat_name = f"Chat {len(guest_store.list_chats(guest_id)) + 1}"
+                st.session_state.current_chat_id = guest_store.create_chat(guest_id, chat_name, 'primebud_1_5')
             else:
-                chats = get_user_chats(st.session_state.user['id'])
-                chat_name = f"Chat {len(chats) + 1}"
+                chat_name = f"Chat {(count_user_chats(st.session_state.user['id']) or 0) + 1}"
                 chat_id = create_chat(st.session_state.user['id'], chat_name)
                 st.session_state.current_chat_id = chat_id
             st.rerun()
         
         st.markdown("#### 💬 Seus Chats")
+        chat_search = st.text_input(
+            "Buscar chats", key="chat_search", placeholder="🔎 Buscar pelo título...", label_visibility="collapsed"
+        ).strip()
         
+        # Lista paginada: carrega CHATS_PAGE_SIZE por vez (+1 para saber se há mais)
+        chat_list_limit = st.session_state.get('chat_list_limit', CHATS_PAGE_SIZE)
         if st.session_state.user.get('is_guest'):
-            chats = [(k, v['name'], v['mode'], '') for k, v in st.session_state.guest_chats.items()]
+            chats = [(chat_id, name, mode, '') for chat_id, name, mode in guest_store.list_chats(st.session_state.user['id'])
+                     if name.lower().startswith(chat_search.lower())]
             chats.reverse()
+            chats = chats[:chat_list_limit + 1]
         else:
-            chats = get_user_chats(st.session_state.user['id'])
+            chats = get_user_chats(st.session_state.user['id'], limit=chat_list_limit + 1, search=chat_search) or []
+        generating_chats = set() if st.session_state.user.get('is_guest') else get_active_job_chats(st.session_state.user['id'])
+        has_more_chats = len(chats) > chat_list_limit
+        chats = chats[:chat_list_limit]
         
         if not chats:
-            st.caption("Nenhum chat ainda")
+            st.caption("Nenhum chat encontrado" if chat_search else "Nenhum chat ainda")
         else:
             for chat in chats:
                 chat_id, chat_name, chat_mode, _ = chat
@@ -798,7 +3429,7 @@ else:
                 
                 with col1:
                     is_current = (chat_id == st.session_state.current_chat_id)
-                    button_label = f"{'📌 ' if is_current else ''}{chat_name}"
+                    button_label = f"{'📌 ' if is_current else ''}{'⏳ ' if chat_id in generating_chats else ''}{chat_name}"
                     if st.button(button_label, key=f"chat_{chat_id}", use_container_width=True):
                         st.session_state.current_chat_id = chat_id
                         st.rerun()
@@ -806,29 +3437,71 @@ else:
                 with col2:
                     if st.button("🗑️", key=f"del_{chat_id}", help="Excluir chat"):
                         if st.session_state.user.get('is_guest'):
-                            del st.session_state.guest_chats[chat_id]
-                            if chat_id in st.session_state.guest_messages:
-                                del st.session_state.guest_messages[chat_id]
+                            guest_store.delete_chat(st.session_state.user['id'], chat_id)
                         else:
                             delete_chat(chat_id)
+                            forget_chat_messages(chat_id)
                         
                         if st.session_state.current_chat_id == chat_id:
                             st.session_state.current_chat_id = None
                         st.rerun()
         
+        if has_more_chats and st.button("⬇️ Carregar mais chats", key="more_chats", use_container_width=True):
+            st.session_state.chat_list_limit = chat_list_limit + CHATS_PAGE_SIZE
+            st.rerun()
+        
+        if not st.session_state.user.get('is_guest'):
+            with st.expander("🔎 Buscar nas mensagens"):
+                message_search = st.text_input(
+                    "Buscar nas mensagens", key="message_search", placeholder="Palavras (use * para prefixo)...", label_visibility="collapsed"
+                )
+                if message_search.strip():
+                    search_start = time.perf_counter()
+                    results = search_messages(st.session_state.user['id'], message_search) or []
+                    st.caption(f"{len(results)} resultado(s) em {(time.perf_counter() - search_start) * 1000:.0f} ms")
+                    for message_id, chat_id, chat_name, role, snippet in results:
+                        snippet_html = html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+                        author = "Você" if role == "user" else "PrimeBud"
+                        st.markdown(f"<small><b>{html.escape(chat_name)}</b> · {author}</small><br><small>{snippet_html}</small>",
+                                    unsafe_allow_html=True)
+                        if st.button("Abrir chat", key=f"search_{message_id}", use_container_width=True):
+                            st.session_state.current_chat_id = chat_id
+                            st.rerun()
+        
         st.markdown("---")
+        cache_stats = get_response_cache_stats()
+        if cache_stats.hits or cache_stats.misses:
+            st.caption(f"⚡ Cache de respostas: {cache_stats.hits} acertos / {cache_stats.misses} falhas")
+        is_admin = not st.session_state.user.get('is_guest') and st.session_state.user['username'] in ADMIN_USERS
+        if is_admin and st.button("💬 Voltar ao chat" if st.session_state.show_metrics else "📊 Métricas",
+                                  use_container_width=True, key="toggle_metrics"):
+            st.session_state.show_metrics = not st.session_state.show_metrics
+            st.rerun()
         if st.button("🚪 Sair", use_container_width=True):
+            if st.session_state.user.get('is_guest'):
+                guest_store.drop_session(st.session_state.user['id'])
+            else:
+                if st.session_state.get('session_cookie'):
+                    delete_session(st.session_state.pop('session_cookie'))
+                st.session_state.session_cookie_js = session_cookie_script("", 0)
+                st.session_state.logged_out = True # Os cookies lidos na conexão não mudam até recarregar a página
             st.session_state.user = None
             st.session_state.current_chat_id = None
+            st.session_state.message_cache = {}
+            st.session_state.visible_messages = {}
+            st.session_state.show_metrics = False
             st.rerun()
 
     # --- ÁREA PRINCIPAL ---
-    if st.session_state.current_chat_id is None:
+    if is_admin and st.session_state.show_metrics:
+        render_metrics_dashboard()
+    
+    elif st.session_state.current_chat_id is None:
         # Tela de Boas-Vindas (com exemplos)
-        if LOGO_BASE64:
+        if LOGO_URL:
             st.markdown(f"""
             <div style='text-align: center; margin-bottom: 1rem;'>
-                <img src='data:image/png;base64,{LOGO_BASE64}' width='100' style='border-radius: 20px; box-shadow: 0 4px 12px rgba(255, 107, 53, 0.3);'>
+                <img src='{LOGO_URL}' width='100' style='border-radius: 20px; box-shadow: 0 4px 12px rgba(255, 107, 53, 0.3);'>
             </div>
             """, unsafe_allow_html=True)
         st.markdown("<h1 style='text-align: center;'>👋 Bem-vindo ao PrimeBud 2.0</h1>", unsafe_allow_html=True)
@@ -873,8 +3546,11 @@ else:
     else:
         # --- TELA DE CHAT ATIVO ---
         if st.session_state.user.get('is_guest'):
-            chat = st.session_state.guest_chats[st.session_state.current_chat_id]
-            chat_info = (chat['name'], chat['mode'])
+            chat_info = guest_store.get_chat(st.session_state.user['id'], st.session_state.current_chat_id)
+            if chat_info is None:
+                # Sessão de convidado expirada (ou descartada pelo limite de memória)
+                st.session_state.current_chat_id = None
+                st.rerun()
         else:
             chat_info = get_chat_info(st.session_state.current_chat_id)
         
@@ -885,7 +3561,7 @@ else:
             
             with col1:
                 mode_name = MODES_CONFIG[current_mode]['short_name']
-                st.markdown(f"### 💬 {chat_name} <span class='mode-badge'>{mode_name}</span>", unsafe_allow_html=True)
+                st.markdown(f"### 💬 {html.escape(chat_name)} <span class='mode-badge'>{mode_name}</span>", unsafe_allow_html=True)
             
             with col2:
                 mode_options = {k: v["name"] for k, v in MODES_CONFIG.items()}
@@ -900,7 +3576,7 @@ else:
                 
                 if selected_mode != current_mode:
                     if st.session_state.user.get('is_guest'):
-                        st.session_state.guest_chats[st.session_state.current_chat_id]['mode'] = selected_mode
+                        guest_store.set_chat_mode(st.session_state.user['id'], st.session_state.current_chat_id, selected_mode)
                     else:
                         update_chat_mode(st.session_state.current_chat_id, selected_mode)
                     st.rerun()
@@ -908,28 +3584,56 @@ else:
             # Obter mensagens formatadas para a API
             messages_for_api = []
             if st.session_state.user.get('is_guest'):
-                messages_for_api = st.session_state.guest_messages.get(st.session_state.current_chat_id, [])
+                messages_for_api = guest_store.get_messages(st.session_state.user['id'], st.session_state.current_chat_id)
             else:
-                db_messages = get_chat_messages(st.session_state.current_chat_id)
-                # Formato para API: [{'role': ..., 'content': ...}]
-                messages_for_api = [{"role": m[0], "content": m[1]} for m in db_messages]
+                # Formato para API: [{'id': ..., 'role': ..., 'content': ...}], carregado incrementalmente
+                messages_for_api = load_chat_messages(st.session_state.current_chat_id)
+            # Geração em andamento neste chat (pode ter sido iniciada antes de uma reconexão)
+            active_job = None if st.session_state.user.get('is_guest') else get_active_job(st.session_state.current_chat_id)
 
             with col3:
                 if messages_for_api:
-                    chat_text = export_chat_to_text(messages_for_api, chat_name)
-                    st.download_button(
-                        label="📥 Exportar",
-                        data=chat_text,
-                        file_name=f"{chat_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                        mime="text/plain",
-                        use_container_width=True
-                    )
+                    with st.popover("📥 Exportar", use_container_width=True):
+                        export_format = st.radio(
+                            "Formato",
+                            list(EXPORT_FORMATS),
+                            format_func=lambda x: EXPORT_FORMATS[x][0],
+                            key="export_format"
+                        )
+                        _, _, _, export_mime = EXPORT_FORMATS[export_format]
+                        # A exportação precisa do chat inteiro (não só da janela), então só é gerada no clique
+                        if st.session_state.user.get('is_guest'):
+                            guest_rows = [(m['role'], m['content'], m.get('created_at')) for m in messages_for_api]
+                            export_data = lambda: export_chat_bytes(guest_rows, chat_name, export_format)
+                        else:
+                            export_chat_id = st.session_state.current_chat_id
+                            export_data = lambda: export_chat_bytes(iter_chat_messages(export_chat_id), chat_name,
+                                                                    export_format)
+                        st.download_button(
+                            label="💬 Este chat",
+                            data=export_data,
+                            file_name=export_file_name(f"{chat_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                                                       export_format),
+                            mime=export_mime,
+                            use_container_width=True,
+                            on_click="ignore"
+                        )
+                        if not st.session_state.user.get('is_guest'):
+                            export_user_id = st.session_state.user['id']
+                            st.download_button(
+                                label="🗂️ Todos os chats (.zip)",
+                                data=lambda: export_user_chats_zip(export_user_id, export_format),
+                                file_name=f"primebud_chats_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+                                mime="application/zip",
+                                use_container_width=True,
+                                on_click="ignore"
+                            )
             
             st.caption(MODES_CONFIG[current_mode]['description'])
             st.markdown("---")
             
             # Container de Mensagens
-            if not messages_for_api:
+            if not messages_for_api and not active_job:
                 st.markdown("""
                 <div style='text-align: center; padding: 3rem; color: #aaa;'>
                     <h2>🤖</h2>
@@ -937,16 +3641,49 @@ else:
                 </div>
                 """, unsafe_allow_html=True)
             else:
-                for msg in messages_for_api:
+                # Só as últimas N mensagens vão para o navegador; as anteriores vêm sob demanda
+                visible = st.session_state.visible_messages.get(st.session_state.current_chat_id, CHAT_PAGE_SIZE)
+                has_older = len(messages_for_api) > visible or (
+                    not st.session_state.user.get('is_guest')
+                    and get_message_window(st.session_state.current_chat_id)['has_more']
+                )
+                if has_older and st.button("⬆️ Carregar mensagens anteriores", key="load_older", use_container_width=True):
+                    st.session_state.visible_messages[st.session_state.current_chat_id] = visible + CHAT_PAGE_SIZE
+                    if not st.session_state.user.get('is_guest') and len(messages_for_api) < visible + CHAT_PAGE_SIZE:
+                        load_older_chat_messages(st.session_state.current_chat_id)
+                    st.rerun()
+                
+                for msg in attach_message_images(messages_for_api[-visible:]):
                     role, content = msg['role'], msg['content']
                     
                     if role == "user":
-                        st.markdown(f'<div class="chat-message user-message"><div class="message-label">Você</div>{content}</div>', unsafe_allow_html=True)
+                        st.markdown(f'<div class="chat-message user-message"><div class="message-label">Você</div>{html.escape(content)}</div>', unsafe_allow_html=True)
+                        render_message_images(msg.get('images'))
                     else:
                         # role == 'assistant' ou 'model'
-                        formatted_content = format_message_with_code(content)
+                        formatted_content = render_message_html(content, msg.get('id'))
                         st.markdown(f'<div class="chat-message assistant-message"><div class="message-label">🤖 PrimeBud</div>{formatted_content}</div>', unsafe_allow_html=True)
             
+            if active_job:
+                job_id, job_prompt, job_images = active_job
+                st.markdown(f'<div class="chat-message user-message"><div class="message-label">Você</div>{html.escape(job_prompt)}</div>', unsafe_allow_html=True)
+                render_message_images(job_images)
+                st.session_state.watched_jobs[st.session_state.current_chat_id] = job_id
+                render_job_progress(job_id)
+            elif st.session_state.current_chat_id in st.session_state.watched_jobs:
+                finished_job = get_job(st.session_state.watched_jobs.pop(st.session_state.current_chat_id))
+                if finished_job and finished_job[0] == 'error':
+                    st.error(f"❌ {finished_job[2]}")
+            
+            # Última comparação de modos (a resposta do modo do chat já está no histórico)
+            compare_results = st.session_state.compare_results.get(st.session_state.current_chat_id)
+            if compare_results:
+                with st.expander("🆚 Comparação de modos", expanded=True):
+                    for column, (mode, text) in zip(st.columns(len(compare_results)), compare_results.items()):
+                        with column:
+                            st.markdown(f"<span class='mode-badge'>{MODES_CONFIG[mode]['short_name']}</span>", unsafe_allow_html=True)
+                            st.markdown(f'<div class="chat-message assistant-message" style="max-width: 100%;">{render_message_html(text)}</div>', unsafe_allow_html=True)
+            
             # Input de Mensagem
             with st.form(key="message_form", clear_on_submit=True):
                 user_input = st.text_area(
@@ -955,50 +3692,102 @@ else:
                     placeholder="Digite sua mensagem... (Ctrl+Enter para enviar)",
                     label_visibility="collapsed"
                 )
+                compare_modes = st.multiselect(
+                    "🆚 Comparar com outros modos",
+                    options=[k for k in MODES_CONFIG if k != current_mode],
+                    format_func=lambda x: MODES_CONFIG[x]["name"],
+                    max_selections=MAX_COMPARE_MODES - 1,
+                    key="compare_modes",
+                    placeholder="🆚 Comparar com outros modos (opcional)",
+                    label_visibility="collapsed"
+                )
+                uploads = []
+                if MODES_CONFIG[current_mode].get("multimodal"):
+                    uploads = st.file_uploader(
+                        "🖼️ Imagens",
+                        type=IMAGE_UPLOAD_TYPES,
+                        accept_multiple_files=True,
+                        key="image_upload",
+                        help=f"Até {IMAGE_MAX_FILES} imagens de até {IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+                    ) or []
                 
                 submitted = st.form_submit_button("📤 Enviar", use_container_width=True)
                 
-                if submitted and user_input.strip():
+                if submitted and (user_input.strip() or uploads):
+                    # Anexos: reduzidos e recodificados no pool de imagens (ou reaproveitados do cache)
+                    images = []
+                    if uploads:
+                        if len(uploads) > IMAGE_MAX_FILES or any(up.size > IMAGE_MAX_UPLOAD_BYTES for up in uploads):
+                            st.error(f"❌ Envie até {IMAGE_MAX_FILES} imagens de até {IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} MB cada.")
+                            st.stop()
+                        try:
+                            with st.spinner("🖼️ Preparando imagens..."):
+                                images = prepare_images([up.getvalue() for up in uploads])
+                        except ValueError as e:
+                            st.error(f"❌ {e}")
+                            st.stop()
+                    
                     # Salva a mensagem do usuário
                     if st.session_state.user.get('is_guest'):
-                        if st.session_state.current_chat_id not in st.session_state.guest_messages:
-                            st.session_state.guest_messages[st.session_state.current_chat_id] = []
-                        st.session_state.guest_messages[st.session_state.current_chat_id].append({
-                            'role': 'user', 'content': user_input
-                        })
-                        messages_for_api = st.session_state.guest_messages[st.session_state.current_chat_id]
-                    else:
-                        save_message(st.session_state.current_chat_id, "user", user_input)
-                        db_messages = get_chat_messages(st.session_state.current_chat_id)
-                        messages_for_api = [{"role": m[0], "content": m[1]} for m in db_messages]
-
-                    # Chama o roteador de API 
-                    # Mostrar logo animado durante processamento
-                    if LOGO_BASE64:
-                        with st.spinner(""):
-                            st.markdown(f"""
-                            <div style='text-align: center; margin: 2rem 0;'>
-                                <img src='data:image/png;base64,{LOGO_BASE64}' width='80' style='border-radius: 16px; animation: pulse 1.5s infinite;'>
-                                <p style='color: #ff6b35; margin-top: 1rem; font-weight: 600;'>Processando sua solicitação...</p>
-                            </div>
-                            <style>
-                            @keyframes pulse {{
-                                0%, 100% {{ opacity: 1; transform: scale(1); }}
-                                50% {{ opacity: 0.7; transform: scale(1.05); }}
-                            }}
-                            </style>
-                            """, unsafe_allow_html=True)
-                            response_text, response_role = generate_chat_response(messages_for_api, current_mode)
+                        guest_store.append_message(st.session_state.user['id'], st.session_state.current_chat_id,
+                                                   'user', user_input, images)
+                        messages_for_api = guest_store.get_messages(st.session_state.user['id'],
+                                                                    st.session_state.current_chat_id)
+                    elif not compare_modes:
+                        # A resposta é gerada no pool de jobs; a tela acompanha pelo render_job_progress
+                        st.session_state.compare_results.pop(st.session_state.current_chat_id, None)
+                        job_id = submit_generation_job(st.session_state.current_chat_id, st.session_state.user['id'],
+                                                       current_mode, user_input, images)
+                        if job_id is None:
+                            st.warning("⏳ Aguarde a resposta anterior terminar antes de enviar outra mensagem.")
+                            st.stop()
+                        st.session_state.watched_jobs[st.session_state.current_chat_id] = job_id
+                        st.rerun()
                     else:
-                        with st.spinner("🤔 Processando..."):
-                            response_text, response_role = generate_chat_response(messages_for_api, current_mode)
+                        # A pergunta só é gravada junto com a resposta (um commit por turno)
+                        messages_for_api = load_context_messages(st.session_state.current_chat_id, current_mode) + [
+                            {'role': 'user', 'content': user_input, 'images': images}
+                        ]
+
+                    chat_id_for_context = None if st.session_state.user.get('is_guest') else st.session_state.current_chat_id
+                    st.session_state.compare_results.pop(st.session_state.current_chat_id, None)
+                    try:
+                        if compare_modes:
+                            # Comparação: todos os modos em paralelo; só a resposta do modo do chat entra no histórico
+                            futures = generate_compare_responses(
+                                messages_for_api, [current_mode] + compare_modes, chat_id=chat_id_for_context,
+                                user=st.session_state.user
+                            )
+                            results = render_compare_responses(futures)
+                            st.session_state.compare_results[st.session_state.current_chat_id] = {
+                                mode: text for mode, (text, _) in results.items()
+                            }
+                            if current_mode not in results:
+                                raise ProviderError(f"{MODES_CONFIG[current_mode]['short_name']} não respondeu; nada foi salvo no histórico.")
+                            response_text, response_role = results[current_mode]
+                        else:
+                            # Chama o roteador de API em modo streaming e desenha a resposta conforme chega
+                            response_chunks, response_role = generate_chat_response(
+                                messages_for_api, current_mode, stream=True, chat_id=chat_id_for_context,
+                                user=st.session_state.user
+                            )
+                            response_text = render_streaming_response(response_chunks)
+                    except ProviderError as e:
+                        # Erros de provedor não entram no histórico (poluiriam o contexto das próximas mensagens)
+                        if not st.session_state.user.get('is_guest'):
+                            turn = [("user", user_input, images)]
+                            append_saved_turn(st.session_state.current_chat_id,
+                                              persist_turn(st.session_state.current_chat_id, turn), turn)
+                        st.error(f"❌ {e}")
+                        st.stop()
                     
                     # Salva a resposta (convidado ou usuário)
                     if st.session_state.user.get('is_guest'):
-                        st.session_state.guest_messages[st.session_state.current_chat_id].append({
-                            'role': response_role, 'content': response_text
-                        })
+                        guest_store.append_message(st.session_state.user['id'], st.session_state.current_chat_id,
+                                                   response_role, response_text)
                     else:
-                        save_message(st.session_state.current_chat_id, response_role, response_text)
+                        turn = [("user", user_input, images), (response_role, response_text)]
+                        append_saved_turn(st.session_state.current_chat_id,
+                                          persist_turn(st.session_state.current_chat_id, turn), turn)
                     
                     st.rerun()